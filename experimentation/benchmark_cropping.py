@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+
+import pandas as pd
+
+from sqlalchemy import create_engine
+
+# specify paths
+DIR_BASE = os.path.abspath('..')
+if DIR_BASE not in sys.path:
+    sys.path.append(DIR_BASE)
+
+import config as config
+from src.pointcloud_functions import crop_and_fetch_pointclouds_per_building, \
+    create_footprints_in_area_materialized_view, create_footprint_links_table, _building_pointcloud_queries
+from utils.utils import pointcloud_to_numpy
+
+########################################################################################################################
+#
+# The following code benchmarks the cropping and fetching of building point clouds from the database.
+# It requires a database prepared by building_pointcloud_main.py for the area of interest, i.e. imported LiDAR data and
+# the materialized view of footprints in the area of interest.
+# For the first chunks of the area of interest, the fetch modes are compared by end-to-end time per chunk (query,
+# transfer and conversion to numpy arrays) and by the number of bytes of the point clouds transferred by the database.
+# Part 2 recreates the materialized view of footprints with every footprint order and compares the number of distinct
+# lidar patches read per chunk and the time per chunk. The materialized view is left with the last footprint order.
+# Part 3 compares the time per chunk with the footprint - uprn - epc links matched per chunk and read from the link
+# table of the area of interest, which is created (again) for this purpose.
+#
+########################################################################################################################
+
+AREA_OF_INTEREST_CODE = 'E06000014'
+BUILDING_BUFFER_METERS = 0.5
+POINT_COUNT_THRESHOLD = 100
+NUM_FOOTPRINTS_CHUNK_SIZE = 500
+NUM_CHUNKS = 3
+FETCH_MODES = ['multipoint', 'packed', 'chunk_patches']
+FOOTPRINT_ORDERS = ['id', 'spatial']
+
+DB_TABLE_NAME_LIDAR = 'uk_lidar_data'
+DB_TABLE_NAME_UPRN = 'uprn'
+DB_TABLE_NAME_EPC = 'epc'
+DB_TABLE_NAME_FOOTPRINTS = 'footprints_verisk'
+DB_TABLE_NAME_AREA_OF_INTEREST = 'local_authority_boundaries'
+
+engine = create_engine(config.DATABASE_URL, echo=False)
+
+
+def transferred_pointcloud_bytes(fp_num_start, fp_num_end, fetch_mode):
+    # size of the point clouds as transferred by the database, measured on the raw query results before decoding:
+    # wkb of the multipoints, packed float64 values per building ('packed') or per patch ('chunk_patches') before
+    # duplicate points are removed on the client
+    sql_query_grouped_points, sql_query_links, sql_query_chunk_points = _building_pointcloud_queries(
+        fp_num_start, fp_num_end, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS, 1000000000, POINT_COUNT_THRESHOLD,
+        DB_TABLE_NAME_UPRN, DB_TABLE_NAME_EPC, DB_TABLE_NAME_LIDAR, fetch_mode, None
+    )
+    if fetch_mode == 'chunk_patches':
+        return sum(len(packed_points) for packed_points in pd.read_sql(sql_query_chunk_points, engine).geom_pc)
+    df_pc = pd.read_sql(sql_query_grouped_points, engine)
+    if fetch_mode == 'multipoint':
+        # geometries are returned as hex encoded wkb
+        return sum(len(geom) // 2 for geom in df_pc.geom)
+    return sum(len(packed_points) for packed_points in df_pc.geom)
+
+
+# Part 1: fetch modes
+benchmark_results = []
+for fetch_mode in FETCH_MODES:
+    for n_chunk in range(NUM_CHUNKS):
+        start_time = time.time()
+        gdf_pc, gdf_links = crop_and_fetch_pointclouds_per_building(
+            n_chunk * NUM_FOOTPRINTS_CHUNK_SIZE, (n_chunk + 1) * NUM_FOOTPRINTS_CHUNK_SIZE, AREA_OF_INTEREST_CODE,
+            BUILDING_BUFFER_METERS, 1000000000, POINT_COUNT_THRESHOLD, DB_TABLE_NAME_UPRN, DB_TABLE_NAME_EPC,
+            DB_TABLE_NAME_LIDAR, engine, fetch_mode=fetch_mode
+        )
+        lidar_numpy_list = [pointcloud_to_numpy(pointcloud) for pointcloud in gdf_pc.geom]
+        duration = time.time() - start_time
+
+        num_points = sum([len(lidar_numpy) for lidar_numpy in lidar_numpy_list])
+        # measured with a separate query, outside of the timed fetch
+        num_bytes = transferred_pointcloud_bytes(
+            n_chunk * NUM_FOOTPRINTS_CHUNK_SIZE, (n_chunk + 1) * NUM_FOOTPRINTS_CHUNK_SIZE, fetch_mode)
+        benchmark_results.append((fetch_mode, n_chunk, len(gdf_pc), num_points, num_bytes, duration))
+
+print('fetch mode | chunk | point clouds | points | point cloud MB | duration [s]')
+for fetch_mode, n_chunk, num_pointclouds, num_points, num_bytes, duration in benchmark_results:
+    print('%10s | %5s | %12s | %6s | %14.2f | %12.2f' % (
+        fetch_mode, n_chunk, num_pointclouds, num_points, num_bytes / 1e6, duration))
+
+# Part 2: footprint order
+def count_patches_per_chunk(fp_num_start, fp_num_end):
+    # number of distinct lidar patches intersecting the buffered footprints of a chunk
+    sql_query_patches = (
+            """
+            with fp_buffer as (
+                select st_buffer(geom_fp, %s) geom_fp
+                from "%s" aoi
+                where aoi.id_fp_chunks > %s and aoi.id_fp_chunks <= %s
+            )
+            select count(distinct lp.id)
+            from %s lp
+            inner join fp_buffer fpb on pc_intersects(lp.pa, fpb.geom_fp)
+            """ % (BUILDING_BUFFER_METERS, AREA_OF_INTEREST_CODE, fp_num_start, fp_num_end, DB_TABLE_NAME_LIDAR)
+    )
+    with engine.connect() as con:
+        return con.execute(sql_query_patches).fetchall()[0][0]
+
+
+order_results = []
+for footprint_order in FOOTPRINT_ORDERS:
+    create_footprints_in_area_materialized_view(
+        config.DATABASE_URL, AREA_OF_INTEREST_CODE, 1000000000, DB_TABLE_NAME_AREA_OF_INTEREST,
+        DB_TABLE_NAME_FOOTPRINTS, footprint_order=footprint_order
+    )
+    for n_chunk in range(NUM_CHUNKS):
+        fp_num_start, fp_num_end = n_chunk * NUM_FOOTPRINTS_CHUNK_SIZE, (n_chunk + 1) * NUM_FOOTPRINTS_CHUNK_SIZE
+        num_patches = count_patches_per_chunk(fp_num_start, fp_num_end)
+        start_time = time.time()
+        gdf_pc, gdf_links = crop_and_fetch_pointclouds_per_building(
+            fp_num_start, fp_num_end, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS, 1000000000,
+            POINT_COUNT_THRESHOLD, DB_TABLE_NAME_UPRN, DB_TABLE_NAME_EPC, DB_TABLE_NAME_LIDAR, engine,
+            fetch_mode='packed'
+        )
+        duration = time.time() - start_time
+        order_results.append((footprint_order, n_chunk, num_patches, len(gdf_pc), duration))
+
+print('footprint order | chunk | patches | point clouds | duration [s]')
+for footprint_order, n_chunk, num_patches, num_pointclouds, duration in order_results:
+    print('%15s | %5s | %7s | %12s | %12.2f' % (footprint_order, n_chunk, num_patches, num_pointclouds, duration))
+
+# Part 3: link table
+table_name_links = create_footprint_links_table(
+    config.DATABASE_URL, AREA_OF_INTEREST_CODE, DB_TABLE_NAME_UPRN, DB_TABLE_NAME_EPC)
+link_results = []
+for link_source, TABLE_NAME_LINKS in [('per chunk', None), ('link table', table_name_links)]:
+    for n_chunk in range(NUM_CHUNKS):
+        start_time = time.time()
+        gdf_pc, gdf_links = crop_and_fetch_pointclouds_per_building(
+            n_chunk * NUM_FOOTPRINTS_CHUNK_SIZE, (n_chunk + 1) * NUM_FOOTPRINTS_CHUNK_SIZE, AREA_OF_INTEREST_CODE,
+            BUILDING_BUFFER_METERS, 1000000000, POINT_COUNT_THRESHOLD, DB_TABLE_NAME_UPRN, DB_TABLE_NAME_EPC,
+            DB_TABLE_NAME_LIDAR, engine, fetch_mode='packed', TABLE_NAME_LINKS=TABLE_NAME_LINKS
+        )
+        duration = time.time() - start_time
+        link_results.append((link_source, n_chunk, len(gdf_links), duration))
+
+print('links      | chunk | links | duration [s]')
+for link_source, n_chunk, num_links, duration in link_results:
+    print('%10s | %5s | %5s | %12.2f' % (link_source, n_chunk, num_links, duration))
@@ -0,0 +1,163 @@
+import os
+import sys
+import time
+
+import geopandas as gpd
+import laspy
+import numpy as np
+import shapely
+import shapely.affinity
+import shapely.geometry
+import shapely.ops
+
+# specify paths
+DIR_BASE = os.path.abspath('..')
+if DIR_BASE not in sys.path:
+    sys.path.append(DIR_BASE)
+
+from src.pointcloud_functions import add_floor_points_to_points_in_gdf, add_floor_points_to_pointcloud, \
+    floor_point_worker_pool
+from utils.pointcloud_batch import PointCloudBatch
+from utils.pointcloud_cropping import crop_points_to_polygons
+from utils.utils import create_tile_bounding_box
+
+########################################################################################################################
+#
+# The following code benchmarks adding floor points to building point clouds on the bundled example tiles
+# (assets/cropped_*.las). Every example tile gets footprints of several shapes (rectangle, L-shape, rotated rectangle,
+# circle), whose point clouds are cropped from the tile. The footprints are repeated NUM_REPEATS times.
+# The floor points are added with the previous point-by-point implementation (reference) and with the current
+# implementation, serially, with NUM_FLOOR_POINT_WORKERS processes and on a PointCloudBatch (flat point array). The
+# resulting point sets are compared for numpy array and multipoint point clouds.
+# The PointCloudBatch is also split into NUM_BATCHES batches (like streamed chunks), whose floor points are added with
+# NUM_FLOOR_POINT_WORKERS processes, with a new process pool per batch and with one pool for all batches.
+#
+########################################################################################################################
+
+FOOTPRINT_INSET_METERS = 2
+BUILDING_BUFFER_METERS = 0.5
+NUM_REPEATS = 10
+NUM_FLOOR_POINT_WORKERS = 4
+NUM_BATCHES = 20
+
+DIR_ASSETS = os.path.join(DIR_BASE, 'assets')
+example_tiles = sorted([os.path.join(DIR_ASSETS, file) for file in os.listdir(DIR_ASSETS)
+                        if file[:8] == 'cropped_' and file[-4:] == '.las'])
+
+
+def add_floor_points_to_pointcloud_reference(building_footprint, pointcloud, z_min):
+    # previous implementation, tests every grid point with its own shapely point
+    resolution = 0.5
+    lonmin, latmin, lonmax, latmax = building_footprint.bounds
+    x, y = np.round(np.meshgrid(np.arange(lonmin, lonmax, resolution), np.arange(latmin, latmax, resolution)), 4)
+    points = list(zip(x.flatten(), y.flatten()))
+    valid_points = [(point[0], point[1], z_min) for point in points if
+                    building_footprint.contains(shapely.geometry.Point(point))]
+
+    if isinstance(pointcloud, np.ndarray):
+        floor_points = np.array(valid_points, dtype=np.float64).reshape(-1, 3)
+        return np.unique(np.concatenate([pointcloud, floor_points]), axis=0)
+
+    footprint_multipoint = shapely.geometry.MultiPoint(valid_points)
+    return shapely.ops.unary_union([pointcloud, footprint_multipoint])
+
+
+def example_footprints(tile_box):
+    # footprints of several shapes within the tile
+    rectangle = tile_box.buffer(-FOOTPRINT_INSET_METERS, join_style=2)
+    min_x, min_y, max_x, max_y = rectangle.bounds
+    l_shape = rectangle.difference(shapely.geometry.box((min_x + max_x) / 2, (min_y + max_y) / 2, max_x, max_y))
+    rotated = shapely.affinity.rotate(rectangle.buffer(-(max_x - min_x) / 6, join_style=2), 30)
+    circle = rectangle.centroid.buffer(min(max_x - min_x, max_y - min_y) / 2)
+    return [rectangle, l_shape, rotated, circle]
+
+
+# example building point clouds
+footprints = []
+pointclouds = []
+for tile in example_tiles:
+    las = laspy.read(tile)
+    xyz = np.column_stack((las.x, las.y, las.z))
+    tile_footprints = example_footprints(create_tile_bounding_box(tile))
+    tile_pointclouds = crop_points_to_polygons(
+        xyz, [footprint.buffer(BUILDING_BUFFER_METERS) for footprint in tile_footprints])
+    footprints += tile_footprints
+    pointclouds += tile_pointclouds
+footprints = footprints * NUM_REPEATS
+pointclouds = pointclouds * NUM_REPEATS
+gdf = gpd.GeoDataFrame({'id_fp': np.arange(len(footprints)),
+                        'geom_fp': gpd.GeoSeries(footprints),
+                        'geom': pointclouds,
+                        'z_min': [pointcloud[:, 2].min() for pointcloud in pointclouds]},
+                       geometry='geom_fp', crs=27700)
+print('%s building point clouds, %s points' % (len(gdf), sum(len(pointcloud) for pointcloud in pointclouds)))
+
+# numpy array point clouds
+time_start = time.time()
+reference = [add_floor_points_to_pointcloud_reference(row.geom_fp, row.geom, row.z_min) for row in gdf.iloc]
+time_reference = time.time() - time_start
+
+time_start = time.time()
+serial = add_floor_points_to_points_in_gdf(gdf).geom
+time_serial = time.time() - time_start
+
+time_start = time.time()
+parallel = add_floor_points_to_points_in_gdf(gdf, num_workers=NUM_FLOOR_POINT_WORKERS).geom
+time_parallel = time.time() - time_start
+
+pc_batch = PointCloudBatch.from_gdf(gdf)
+time_start = time.time()
+batch = add_floor_points_to_points_in_gdf(pc_batch).pointclouds()
+time_batch = time.time() - time_start
+
+is_identical = all(np.array_equal(a, b) and np.array_equal(a, c) and np.array_equal(a, d)
+                   for a, b, c, d in zip(reference, serial, parallel, batch))
+print('numpy arrays: reference %.2fs, serial %.2fs (%.1fx), %s workers %.2fs (%.1fx), batch %.2fs (%.1fx), '
+      'identical: %s' % (time_reference, time_serial, time_reference / time_serial, NUM_FLOOR_POINT_WORKERS,
+                         time_parallel, time_reference / time_parallel, time_batch, time_reference / time_batch,
+                         is_identical))
+
+# batches with several worker processes
+pc_batches = [PointCloudBatch.from_gdf(gdf_batch) for gdf_batch in np.array_split(gdf, NUM_BATCHES)]
+time_start = time.time()
+batch_serial = [add_floor_points_to_points_in_gdf(pc_batch) for pc_batch in pc_batches]
+time_batch_serial = time.time() - time_start
+
+time_start = time.time()
+batch_pool_per_batch = [add_floor_points_to_points_in_gdf(pc_batch, num_workers=NUM_FLOOR_POINT_WORKERS)
+                        for pc_batch in pc_batches]
+time_pool_per_batch = time.time() - time_start
+
+time_start = time.time()
+executor = floor_point_worker_pool(NUM_FLOOR_POINT_WORKERS)
+batch_pool_per_run = [add_floor_points_to_points_in_gdf(pc_batch, num_workers=NUM_FLOOR_POINT_WORKERS,
+                                                        executor=executor) for pc_batch in pc_batches]
+executor.shutdown()
+time_pool_per_run = time.time() - time_start
+
+is_identical = all(np.array_equal(a, b) and np.array_equal(a, c)
+                   for batch_a, batch_b, batch_c in zip(batch_serial, batch_pool_per_batch, batch_pool_per_run)
+                   for a, b, c in zip(batch_a.pointclouds(), batch_b.pointclouds(), batch_c.pointclouds()))
+print('%s batches: serial %.2fs, %s workers with a pool per batch %.2fs (%.1fx), with one pool %.2fs (%.1fx), '
+      'identical: %s' % (NUM_BATCHES, time_batch_serial, NUM_FLOOR_POINT_WORKERS, time_pool_per_batch,
+                         time_batch_serial / time_pool_per_batch, time_pool_per_run,
+                         time_batch_serial / time_pool_per_run, is_identical))
+
+# multipoint point clouds (first repeat only)
+num_multipoint = len(footprints) // NUM_REPEATS
+multipoints = [shapely.geometry.MultiPoint(pointcloud.tolist()) for pointcloud in pointclouds[:num_multipoint]]
+time_start = time.time()
+reference = [add_floor_points_to_pointcloud_reference(footprint, multipoint, z_min) for footprint, multipoint, z_min
+             in zip(footprints, multipoints, gdf.z_min)]
+time_reference = time.time() - time_start
+
+time_start = time.time()
+current = [add_floor_points_to_pointcloud(footprint, multipoint, z_min) for footprint, multipoint, z_min
+           in zip(footprints, multipoints, gdf.z_min)]
+time_current = time.time() - time_start
+
+is_identical = all(np.array_equal(np.unique([(pt.x, pt.y, pt.z) for pt in a.geoms], axis=0),
+                                  np.unique([(pt.x, pt.y, pt.z) for pt in b.geoms], axis=0))
+                   for a, b in zip(reference, current))
+print('multipoints: reference %.2fs, current %.2fs (%.1fx), identical: %s' % (
+    time_reference, time_current, time_reference / time_current, is_identical))
@@ -0,0 +1,163 @@
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+import laspy
+import psycopg2
+
+# specify paths
+DIR_BASE = os.path.abspath('..')
+if DIR_BASE not in sys.path:
+    sys.path.append(DIR_BASE)
+
+import config as config
+from utils.utils import create_tile_bounding_box
+from src.pointcloud_functions import load_laz_pointcloud_into_database, pointcloud_table_storage_report, \
+    COMPACT_LIDAR_SCHEMA
+
+########################################################################################################################
+#
+# The following code benchmarks the import of LiDAR tiles into the database.
+# The bundled example tiles (assets/cropped_*.las) are compressed to .laz and copied several times into a temporary
+# directory, so that there are enough tiles to keep all workers busy. Every setting imports the tiles into its own
+# benchmark table, which is dropped afterwards.
+# Part 1 compares the serial import with the import by several workers.
+# Part 2 compares the storage size of the full point schema with the compact ingestion schema.
+# Part 3 imports the tiles with several patch capacities and times a footprint cropping query for each of them.
+# The footprints are the bounding boxes of the example tiles, shrunk by FOOTPRINT_INSET_METERS.
+#
+########################################################################################################################
+
+# number of copies of every example tile
+NUM_TILE_COPIES = 8
+# number of workers to compare. 1 is the serial import
+NUM_WORKERS_LIST = [1, 2, 4]
+# ingestion schemas to compare
+INGESTION_SCHEMAS = {'full': None, 'compact': COMPACT_LIDAR_SCHEMA}
+# patch capacities to compare. 'auto' chooses the capacity per tile from the tile's point density
+PATCH_CAPACITIES = [100, 200, 400, 800, 'auto']
+# number of repetitions of the cropping query per patch capacity
+NUM_QUERY_REPETITIONS = 10
+FOOTPRINT_INSET_METERS = 2
+# prefix of the benchmark tables
+DB_TABLE_NAME_BENCHMARK = 'uk_lidar_data_benchmark'
+
+DIR_ASSETS = os.path.join(DIR_BASE, 'assets')
+example_tiles = sorted([file for file in os.listdir(DIR_ASSETS) if file[:8] == 'cropped_' and file[-4:] == '.las'])
+
+
+def prepare_benchmark_tiles(dir_tiles):
+    # write every example tile as several .laz copies
+    for example_tile in example_tiles:
+        las = laspy.read(os.path.join(DIR_ASSETS, example_tile))
+        for n_copy in range(NUM_TILE_COPIES):
+            las.write(os.path.join(dir_tiles, '%s_%s.laz' % (example_tile[:-4], n_copy)))
+    return
+
+
+def drop_benchmark_table(table_name):
+    connection_psycopg2 = psycopg2.connect(config.DATABASE_URL)
+    connection_psycopg2.autocommit = True
+    cursor = connection_psycopg2.cursor()
+    cursor.execute('DROP TABLE IF EXISTS "%s"' % table_name)
+    connection_psycopg2.close()
+    return
+
+
+# Part 1: number of workers
+def time_cropping_query(table_name, footprint_wkts):
+    # crops the point clouds of all footprints like the building point cloud query
+    sql_query_crop = (
+            """
+            with footprints as (
+                select st_geomfromtext(wkt, 27700) geom_fp
+                from unnest(array[%s]) wkt
+            )
+            select count(distinct lp.id), sum(pc_numpoints(pc_intersection(lp.pa, fps.geom_fp)))
+            from "%s" lp
+            inner join footprints fps on pc_intersects(lp.pa, fps.geom_fp)
+            """ % (','.join(["'%s'" % wkt for wkt in footprint_wkts]), table_name)
+    )
+    connection_psycopg2 = psycopg2.connect(config.DATABASE_URL)
+    cursor = connection_psycopg2.cursor()
+    durations = []
+    for n_repetition in range(NUM_QUERY_REPETITIONS):
+        start_time = time.time()
+        cursor.execute(sql_query_crop)
+        num_patches, num_points = cursor.fetchall()[0]
+        durations.append(time.time() - start_time)
+    connection_psycopg2.close()
+    return num_patches, num_points, min(durations), sum(durations) / len(durations)
+
+
+benchmark_results = []
+for num_workers in NUM_WORKERS_LIST:
+    # every run starts from fresh tiles, because imported tiles are skipped
+    dir_tiles = tempfile.mkdtemp()
+    prepare_benchmark_tiles(dir_tiles)
+    table_name = '%s_%s' % (DB_TABLE_NAME_BENCHMARK, num_workers)
+    drop_benchmark_table(table_name)
+
+    start_time = time.time()
+    tile_results = load_laz_pointcloud_into_database(dir_tiles, table_name, num_workers=num_workers)
+    duration = time.time() - start_time
+
+    num_failed = len([tile_result for tile_result in tile_results if not tile_result['success']])
+    benchmark_results.append((num_workers, len(tile_results), num_failed, duration))
+
+    drop_benchmark_table(table_name)
+    shutil.rmtree(dir_tiles)
+
+print('workers | tiles | failed | duration [s] | speedup')
+for num_workers, num_tiles, num_failed, duration in benchmark_results:
+    print('%7s | %5s | %6s | %12.2f | %7.2f' % (
+        num_workers, num_tiles, num_failed, duration, benchmark_results[0][3] / duration))
+
+# Part 2: ingestion schema
+storage_reports = {}
+for schema_name, ingestion_schema in INGESTION_SCHEMAS.items():
+    dir_tiles = tempfile.mkdtemp()
+    prepare_benchmark_tiles(dir_tiles)
+    table_name = '%s_%s' % (DB_TABLE_NAME_BENCHMARK, schema_name)
+    drop_benchmark_table(table_name)
+
+    load_laz_pointcloud_into_database(dir_tiles, table_name, ingestion_schema=ingestion_schema)
+    storage_reports[schema_name] = pointcloud_table_storage_report(config.DATABASE_URL, table_name)
+
+    drop_benchmark_table(table_name)
+    shutil.rmtree(dir_tiles)
+
+print('schema  | points | patch bytes/point | table bytes/point')
+for schema_name, storage_report in storage_reports.items():
+    print('%7s | %6s | %17.2f | %17.2f' % (
+        schema_name, storage_report['num_points'], storage_report['patch_bytes_per_point'],
+        storage_report['table_bytes_per_point']))
+
+# Part 3: patch capacity
+footprint_wkts = [create_tile_bounding_box(os.path.join(DIR_ASSETS, example_tile)).buffer(
+    -FOOTPRINT_INSET_METERS, join_style=2).wkt for example_tile in example_tiles]
+capacity_results = []
+for patch_capacity in PATCH_CAPACITIES:
+    dir_tiles = tempfile.mkdtemp()
+    prepare_benchmark_tiles(dir_tiles)
+    table_name = '%s_capacity_%s' % (DB_TABLE_NAME_BENCHMARK, patch_capacity)
+    drop_benchmark_table(table_name)
+
+    load_laz_pointcloud_into_database(dir_tiles, table_name, patch_capacity=patch_capacity)
+    connection_psycopg2 = psycopg2.connect(config.DATABASE_URL)
+    connection_psycopg2.autocommit = True
+    cursor = connection_psycopg2.cursor()
+    cursor.execute('CREATE INDEX ON "%s" USING GIST (Geometry(pa))' % table_name)
+    cursor.execute('VACUUM ANALYZE "%s"' % table_name)
+    connection_psycopg2.close()
+    capacity_results.append((patch_capacity, *time_cropping_query(table_name, footprint_wkts)))
+
+    drop_benchmark_table(table_name)
+    shutil.rmtree(dir_tiles)
+
+print('capacity | patches touched | points cropped | min query [s] | mean query [s]')
+for patch_capacity, num_patches, num_points, min_duration, mean_duration in capacity_results:
+    print('%8s | %15s | %14s | %13.4f | %14.4f' % (
+        patch_capacity, num_patches, num_points, min_duration, mean_duration))
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+
+import geopandas as gpd
+import laspy
+import numpy as np
+import shapely.geometry
+
+# specify paths
+DIR_BASE = os.path.abspath('..')
+if DIR_BASE not in sys.path:
+    sys.path.append(DIR_BASE)
+
+from src.pointcloud_functions import pointcloud_gdf_to_numpy
+from utils.pointcloud_batch import PointCloudBatch, normalize_pointcloud_batch
+from utils.pointcloud_cropping import crop_points_to_polygons
+from utils.utils import create_tile_bounding_box
+
+########################################################################################################################
+#
+# The following code measures the throughput (buildings per second) of the normalisation and subsampling of building
+# point clouds in pointcloud_gdf_to_numpy. The bundled example tiles (assets/cropped_*.las) are cut into footprints of
+# FOOTPRINT_SIZE_METERS, whose point clouds are repeated to NUM_BUILDINGS buildings. The point clouds are normalised
+# per building with normalize_geom (multipoints and numpy arrays in a GeoDataFrame) and at once for a PointCloudBatch.
+# The normalised points (without subsampling) are compared between normalize_geom and the batch normalisation and
+# the subsamples of two runs with SAMPLING_SEED are compared.
+#
+########################################################################################################################
+
+FOOTPRINT_SIZE_METERS = 10
+NUM_BUILDINGS = 5000
+POINT_COUNT_THRESHOLD = 100
+# seed of the subsampling, the same seed gives identical subsamples in every run
+SAMPLING_SEED = 0
+
+DIR_ASSETS = os.path.join(DIR_BASE, 'assets')
+example_tiles = sorted([os.path.join(DIR_ASSETS, file) for file in os.listdir(DIR_ASSETS)
+                        if file[:8] == 'cropped_' and file[-4:] == '.las'])
+
+# example building point clouds
+pointclouds = []
+for tile in example_tiles:
+    las = laspy.read(tile)
+    xyz = np.column_stack((las.x, las.y, las.z))
+    min_x, min_y, max_x, max_y = create_tile_bounding_box(tile).bounds
+    tile_footprints = [shapely.geometry.box(x, y, x + FOOTPRINT_SIZE_METERS, y + FOOTPRINT_SIZE_METERS)
+                       for x in np.arange(min_x, max_x - FOOTPRINT_SIZE_METERS, FOOTPRINT_SIZE_METERS)
+                       for y in np.arange(min_y, max_y - FOOTPRINT_SIZE_METERS, FOOTPRINT_SIZE_METERS)]
+    pointclouds += [points for points in crop_points_to_polygons(xyz, tile_footprints)
+                    if len(points) >= POINT_COUNT_THRESHOLD]
+pointclouds = [pointclouds[i % len(pointclouds)] for i in range(NUM_BUILDINGS)]
+gdf = gpd.GeoDataFrame({'id_fp': np.arange(NUM_BUILDINGS), 'geom': pointclouds})
+gdf_multipoint = gdf.assign(geom=gpd.GeoSeries([shapely.geometry.MultiPoint(points) for points in pointclouds]))
+pc_batch = PointCloudBatch.from_gdf(gdf)
+scaling_factor = max((points.max(axis=0) - points.min(axis=0)).max() for points in pointclouds)
+print('%s buildings, %.0f points per building' % (NUM_BUILDINGS, np.mean([len(points) for points in pointclouds])))
+
+for name, pointcloud_data in [('multipoints', gdf_multipoint), ('numpy arrays', gdf), ('batch', pc_batch)]:
+    time_start = time.time()
+    lidar_numpy_list = pointcloud_gdf_to_numpy(pointcloud_data, scaling_factor, POINT_COUNT_THRESHOLD, SAMPLING_SEED)
+    time_normalization = time.time() - time_start
+    print('%s: %.0f buildings per second' % (name, NUM_BUILDINGS / time_normalization))
+    lidar_numpy_list_rerun = pointcloud_gdf_to_numpy(pointcloud_data, scaling_factor, POINT_COUNT_THRESHOLD,
+                                                     SAMPLING_SEED)
+    print('%s: subsamples identical in a second run: %s'
+          % (name, all(np.array_equal(a, b) for a, b in zip(lidar_numpy_list, lidar_numpy_list_rerun))))
+
+# compare the normalised points without subsampling
+normalized_points = normalize_pointcloud_batch(pc_batch.points, pc_batch.offsets, scaling_factor)
+is_identical = all(np.array_equal(normalized_points[pc_batch.offsets[i]:pc_batch.offsets[i + 1]],
+                                  (points - points.min(axis=0)) / scaling_factor)
+                   for i, points in enumerate(pointclouds))
+print('normalised points identical: %s' % is_identical)
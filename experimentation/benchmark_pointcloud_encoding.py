@@ -0,0 +1,91 @@
+import os
+import sys
+import tempfile
+import time
+
+import geopandas as gpd
+import laspy
+import numpy as np
+import shapely.geometry
+
+# specify paths
+DIR_BASE = os.path.abspath('..')
+if DIR_BASE not in sys.path:
+    sys.path.append(DIR_BASE)
+
+from src.pointcloud_functions import add_floor_points_to_points_in_gdf
+from utils.pointcloud_batch import PointCloudBatch
+from utils.pointcloud_cropping import crop_points_to_polygons
+from utils.pointcloud_store import write_pointcloud_shard, PointCloudStoreReader, POINT_ENCODINGS
+from utils.utils import create_tile_bounding_box
+
+########################################################################################################################
+#
+# The following code compares the encodings of the sharded point cloud store on the bundled example tiles
+# (assets/cropped_*.las). The tiles are cut into footprints of FOOTPRINT_SIZE_METERS, whose point clouds (with floor
+# points) are repeated NUM_REPEATS times and written to shards of BUILDINGS_PER_SHARD buildings with every encoding.
+# For every encoding, the size on disk, the write and load time of all point clouds, the maximum coordinate error
+# and whether the decoded points equal the original points at the precision of the encoding are reported.
+#
+########################################################################################################################
+
+FOOTPRINT_SIZE_METERS = 10
+BUILDING_BUFFER_METERS = 0.5
+NUM_REPEATS = 100
+BUILDINGS_PER_SHARD = 500
+
+DIR_ASSETS = os.path.join(DIR_BASE, 'assets')
+example_tiles = sorted([os.path.join(DIR_ASSETS, file) for file in os.listdir(DIR_ASSETS)
+                        if file[:8] == 'cropped_' and file[-4:] == '.las'])
+
+# example building point clouds
+footprints = []
+pointclouds = []
+for tile in example_tiles:
+    las = laspy.read(tile)
+    xyz = np.column_stack((las.x, las.y, las.z))
+    min_x, min_y, max_x, max_y = create_tile_bounding_box(tile).bounds
+    tile_footprints = [shapely.geometry.box(x, y, x + FOOTPRINT_SIZE_METERS, y + FOOTPRINT_SIZE_METERS)
+                       for x in np.arange(min_x, max_x - FOOTPRINT_SIZE_METERS, FOOTPRINT_SIZE_METERS)
+                       for y in np.arange(min_y, max_y - FOOTPRINT_SIZE_METERS, FOOTPRINT_SIZE_METERS)]
+    footprints += tile_footprints
+    pointclouds += crop_points_to_polygons(
+        xyz, [footprint.buffer(BUILDING_BUFFER_METERS) for footprint in tile_footprints])
+is_kept = [len(pointcloud) > 0 for pointcloud in pointclouds]
+footprints = [footprint for footprint, keep in zip(footprints, is_kept) if keep] * NUM_REPEATS
+pointclouds = [pointcloud for pointcloud, keep in zip(pointclouds, is_kept) if keep] * NUM_REPEATS
+gdf = gpd.GeoDataFrame({'id_fp': np.arange(len(footprints)),
+                        'geom_fp': gpd.GeoSeries(footprints),
+                        'geom': pointclouds,
+                        'z_min': [pointcloud[:, 2].min() for pointcloud in pointclouds]},
+                       geometry='geom_fp', crs=27700)
+pc_batch = add_floor_points_to_points_in_gdf(PointCloudBatch.from_gdf(gdf))
+file_names = ['%s.npy' % id_fp for id_fp in pc_batch.info.id_fp]
+print('%s building point clouds, %s points' % (len(pc_batch), len(pc_batch.points)))
+
+for encoding, (storage_dtype, scale) in POINT_ENCODINGS.items():
+    dir_store = tempfile.mkdtemp()
+    time_start = time.time()
+    for shard_start in range(0, len(pc_batch), BUILDINGS_PER_SHARD):
+        shard_stop = min(shard_start + BUILDINGS_PER_SHARD, len(pc_batch))
+        offsets = pc_batch.offsets[shard_start:shard_stop + 1]
+        write_pointcloud_shard(dir_store, 'shard_%s' % shard_start, pc_batch.points[offsets[0]:offsets[-1]],
+                               offsets - offsets[0], pc_batch.info.id_fp[shard_start:shard_stop],
+                               file_names[shard_start:shard_stop], encoding)
+    time_write = time.time() - time_start
+    num_bytes = sum(os.path.getsize(os.path.join(dir_store, file)) for file in os.listdir(dir_store))
+
+    time_start = time.time()
+    pointcloud_store = PointCloudStoreReader(dir_store)
+    decoded = [np.array(pointcloud_store.pointcloud_by_file_name(file_name)) for file_name in file_names]
+    time_load = time.time() - time_start
+
+    max_error = max(np.abs(decoded_points - original_points).max()
+                    for decoded_points, original_points in zip(decoded, pc_batch.pointclouds()))
+    # float64 points are stored as they are, the other encodings are compared at the decimals of their scale
+    is_lossless = all(np.array_equal(decoded_points, original_points if scale is None else
+                                     np.round(original_points, int(round(-np.log10(scale)))))
+                      for decoded_points, original_points in zip(decoded, pc_batch.pointclouds()))
+    print('%s: %.1f MB (%.1f bytes per point), write %.2fs, load %.2fs, max error %.2e m, lossless: %s' % (
+        encoding, num_bytes / 2 ** 20, num_bytes / len(pc_batch.points), time_write, time_load, max_error,
+        is_lossless))
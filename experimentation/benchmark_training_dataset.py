@@ -0,0 +1,95 @@
+import os
+import sys
+import tempfile
+import time
+
+import laspy
+import numpy as np
+import pandas as pd
+import shapely.geometry
+
+# specify paths
+DIR_BASE = os.path.abspath('..')
+if DIR_BASE not in sys.path:
+    sys.path.append(DIR_BASE)
+
+from utils.pointcloud_cropping import crop_points_to_polygons
+from utils.pointcloud_store import write_pointcloud_shard
+from utils.training_dataset import PointCloudDataset, EPC_RATINGS
+from utils.utils import create_tile_bounding_box
+
+########################################################################################################################
+#
+# The following code measures the throughput (buildings per second) of the training dataset reader.
+# The bundled example tiles (assets/cropped_*.las) are cut into footprints of FOOTPRINT_SIZE_METERS, whose point
+# clouds are repeated to NUM_BUILDINGS buildings with random EPC labels. The buildings are written as one .npy file per
+# building (npy_raw) and as a sharded store with int32 encoding (npy_shards) together with a filename mapping.
+# One epoch is read from both with different numbers of worker processes. The batches are compared across the numbers
+# of workers to check, that they do not depend on them.
+#
+########################################################################################################################
+
+FOOTPRINT_SIZE_METERS = 10
+NUM_BUILDINGS = 20000
+BUILDINGS_PER_SHARD = 5000
+NUM_POINTS = 1024
+BATCH_SIZE = 64
+NUM_WORKERS_LIST = [0, 2, 4]
+
+DIR_ASSETS = os.path.join(DIR_BASE, 'assets')
+example_tiles = sorted([os.path.join(DIR_ASSETS, file) for file in os.listdir(DIR_ASSETS)
+                        if file[:8] == 'cropped_' and file[-4:] == '.las'])
+
+# the data is created in the main process only, the worker processes import this file
+if __name__ == '__main__':
+    # example building point clouds
+    pointclouds = []
+    for tile in example_tiles:
+        las = laspy.read(tile)
+        xyz = np.column_stack((las.x, las.y, las.z))
+        min_x, min_y, max_x, max_y = create_tile_bounding_box(tile).bounds
+        tile_footprints = [shapely.geometry.box(x, y, x + FOOTPRINT_SIZE_METERS, y + FOOTPRINT_SIZE_METERS)
+                           for x in np.arange(min_x, max_x - FOOTPRINT_SIZE_METERS, FOOTPRINT_SIZE_METERS)
+                           for y in np.arange(min_y, max_y - FOOTPRINT_SIZE_METERS, FOOTPRINT_SIZE_METERS)]
+        pointclouds += [points for points in crop_points_to_polygons(xyz, tile_footprints) if len(points) > 0]
+    pointclouds = [pointclouds[i % len(pointclouds)] for i in range(NUM_BUILDINGS)]
+    file_names = ['%s.0_%s.0.npy' % (i, i) for i in range(NUM_BUILDINGS)]
+
+    # outputs of an area of interest
+    rng = np.random.default_rng(0)
+    dir_aoi_output = tempfile.mkdtemp()
+    file_path_filename_mapping = os.path.join(dir_aoi_output, 'filename_mapping.json')
+    pd.DataFrame({'id_fp': np.arange(NUM_BUILDINGS),
+                  'num_p_in_pc': [len(points) for points in pointclouds],
+                  'epc_rating': rng.choice(EPC_RATINGS, NUM_BUILDINGS),
+                  'epc_efficiency': rng.integers(1, 100, NUM_BUILDINGS),
+                  'file_name': file_names}).to_json(file_path_filename_mapping, orient='index')
+    dir_npy_raw = os.path.join(dir_aoi_output, 'npy_raw')
+    dir_npy_shards = os.path.join(dir_aoi_output, 'npy_shards')
+    os.makedirs(dir_npy_raw)
+    os.makedirs(dir_npy_shards)
+    for file_name, points in zip(file_names, pointclouds):
+        np.save(os.path.join(dir_npy_raw, file_name), points)
+    for shard_start in range(0, NUM_BUILDINGS, BUILDINGS_PER_SHARD):
+        shard_pointclouds = pointclouds[shard_start:shard_start + BUILDINGS_PER_SHARD]
+        offsets = np.concatenate([[0], np.cumsum([len(points) for points in shard_pointclouds])])
+        write_pointcloud_shard(dir_npy_shards, 'shard_%s' % shard_start, np.concatenate(shard_pointclouds), offsets,
+                               np.arange(shard_start, shard_start + len(shard_pointclouds)),
+                               file_names[shard_start:shard_start + BUILDINGS_PER_SHARD], encoding='int32')
+    print('%s buildings, %.0f points per building' % (NUM_BUILDINGS, np.mean([len(points) for points in pointclouds])))
+
+    for dir_pointclouds in [dir_npy_raw, dir_npy_shards]:
+        dataset = PointCloudDataset(dir_pointclouds, file_path_filename_mapping, num_points=NUM_POINTS)
+        first_batches = []
+        for num_workers in NUM_WORKERS_LIST:
+            time_start = time.time()
+            num_buildings = 0
+            for n_batch, batch in enumerate(dataset.iterate_batches(BATCH_SIZE, num_workers=num_workers)):
+                num_buildings += len(batch['points'])
+                if n_batch == 0:
+                    first_batches.append(batch['points'])
+            time_epoch = time.time() - time_start
+            print('%s, %s workers: %.0f buildings per second' % (
+                os.path.basename(dir_pointclouds), num_workers, num_buildings / time_epoch))
+        print('batches independent of the number of workers: %s' % all(
+            np.array_equal(first_batches[0], points) for points in first_batches))
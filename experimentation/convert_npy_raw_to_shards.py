@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+# specify paths
+DIR_BASE = os.path.abspath('..')
+if DIR_BASE not in sys.path:
+    sys.path.append(DIR_BASE)
+
+from utils.pointcloud_store import convert_npy_raw_to_shards, PointCloudStoreReader
+
+########################################################################################################################
+#
+# The following code converts the "npy_raw" folder (one .npy file per building) of an area of interest output folder
+# into a sharded point cloud store ("npy_shards") and checks, that all point clouds of the store are identical to the
+# .npy files. The id_fp of the buildings is taken from the stitched filename mapping of the area of interest.
+# Finally, the time of random access by file name is compared for the .npy files and the store.
+#
+########################################################################################################################
+
+AREA_OF_INTEREST_CODE = 'E06000014'
+DIR_OUTPUTS = os.path.join('/home/vagrant/data_share', 'outputs')
+BUILDINGS_PER_SHARD = 10000
+NUM_RANDOM_ACCESSES = 1000
+
+DIR_AOI_OUTPUT = os.path.join(DIR_OUTPUTS, AREA_OF_INTEREST_CODE)
+DIR_NPY_RAW = os.path.join(DIR_AOI_OUTPUT, 'npy_raw')
+DIR_NPY_SHARDS = os.path.join(DIR_AOI_OUTPUT, 'npy_shards')
+FILE_PATH_FILENAME_MAPPING = os.path.join(DIR_AOI_OUTPUT, 'filename_mapping_' + AREA_OF_INTEREST_CODE + '.json')
+
+if not os.path.isfile(FILE_PATH_FILENAME_MAPPING):
+    FILE_PATH_FILENAME_MAPPING = None
+num_shards = convert_npy_raw_to_shards(DIR_NPY_RAW, DIR_NPY_SHARDS, FILE_PATH_FILENAME_MAPPING, BUILDINGS_PER_SHARD)
+
+# validate the store
+pointcloud_store = PointCloudStoreReader(DIR_NPY_SHARDS)
+npy_file_names = sorted(file for file in os.listdir(DIR_NPY_RAW) if file[-4:] == '.npy')
+is_identical = all(np.array_equal(np.load(os.path.join(DIR_NPY_RAW, file)).reshape(-1, 3),
+                                  pointcloud_store.pointcloud_by_file_name(file)) for file in npy_file_names)
+print('%s point clouds in %s shards, identical: %s, %s without id_fp' % (
+    len(pointcloud_store), num_shards, is_identical, int((pointcloud_store.id_fp == -1).sum())))
+
+# random access by file name
+rng = np.random.default_rng(0)
+sample_file_names = list(rng.choice(npy_file_names, size=min(NUM_RANDOM_ACCESSES, len(npy_file_names))))
+time_start = time.time()
+for file in sample_file_names:
+    np.load(os.path.join(DIR_NPY_RAW, file)).sum()
+time_npy = time.time() - time_start
+time_start = time.time()
+for file in sample_file_names:
+    pointcloud_store.pointcloud_by_file_name(file).sum()
+time_store = time.time() - time_start
+print('random access of %s point clouds: npy files %.3fs, store %.3fs' % (len(sample_file_names), time_npy,
+                                                                            time_store))
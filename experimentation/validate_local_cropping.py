@@ -0,0 +1,101 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import geopandas as gpd
+import laspy
+import numpy as np
+import pandas as pd
+import shapely
+import shapely.affinity
+
+# specify paths
+DIR_BASE = os.path.abspath('..')
+if DIR_BASE not in sys.path:
+    sys.path.append(DIR_BASE)
+
+from src.local_pointcloud_functions import load_local_footprints, load_local_uprn, load_local_epc, \
+    link_local_footprints, crop_pointclouds_per_building_local
+from utils.tile_catalog import build_tile_catalog
+from utils.utils import create_tile_bounding_box, pointcloud_to_numpy
+
+########################################################################################################################
+#
+# The following code validates the database-free cropping backend on the bundled example tiles (assets/cropped_*.las).
+# Every example tile gets a footprint (tile bounding box shrunk by FOOTPRINT_INSET_METERS), a UPRN at the footprint
+# centroid and an EPC entry. The point clouds cropped by the backend are compared with a point-by-point reference
+# cropping with shapely.
+# One additional footprint (outside the tiles) has no UPRN, and the UPRN and EPC inputs contain an entry with a blank
+# UPRN. Like in the database (fpu.uprn = e."UPRN" never matches NULL), the footprint must be linked to neither of them.
+# The tile catalog of a directory with a LAS file next to the LAZ file of the same tile (unpacked by earlier versions
+# of the LiDAR import) must contain the tile only once.
+#
+########################################################################################################################
+
+FOOTPRINT_INSET_METERS = 2
+BUILDING_BUFFER_METERS = 0.5
+POINT_COUNT_THRESHOLD = 100
+AREA_OF_INTEREST_CODE = 'E00000000'
+
+DIR_ASSETS = os.path.join(DIR_BASE, 'assets')
+example_tiles = sorted([os.path.join(DIR_ASSETS, file) for file in os.listdir(DIR_ASSETS)
+                        if file[:8] == 'cropped_' and file[-4:] == '.las'])
+
+# create input files of the local backend
+dir_inputs = tempfile.mkdtemp()
+footprints = [create_tile_bounding_box(tile).buffer(-FOOTPRINT_INSET_METERS, join_style=2) for tile in example_tiles]
+footprint_without_uprn = shapely.affinity.translate(footprints[0], xoff=1000)
+id_fp_without_uprn = len(footprints)
+gpd.GeoDataFrame({'gid': np.arange(len(footprints) + 1)}, geometry=footprints + [footprint_without_uprn],
+                 crs=27700).to_file(os.path.join(dir_inputs, 'footprints.geojson'), driver='GeoJSON')
+# the UPRN with blank UPRN lies outside of all footprints
+pd.DataFrame({'UPRN': list(np.arange(len(footprints))) + [None],
+              'X_COORDINATE': [fp.centroid.x for fp in footprints] + [footprint_without_uprn.centroid.x + 1000],
+              'Y_COORDINATE': [fp.centroid.y for fp in footprints] + [footprint_without_uprn.centroid.y]}).to_csv(
+    os.path.join(dir_inputs, 'uprn.csv'), index=False)
+pd.DataFrame({'LMK_KEY': ['lmk_%s' % i for i in range(len(footprints))] + ['lmk_without_uprn'],
+              'UPRN': list(np.arange(len(footprints))) + [None],
+              'LOCAL_AUTHORITY': AREA_OF_INTEREST_CODE,
+              'CURRENT_ENERGY_RATING': 'C',
+              'CURRENT_ENERGY_EFFICIENCY': 70}).to_csv(
+    os.path.join(dir_inputs, AREA_OF_INTEREST_CODE + '.csv'), index=False)
+
+# crop with the local backend
+gdf_footprints = load_local_footprints(
+    os.path.join(dir_inputs, 'footprints.geojson'), None, AREA_OF_INTEREST_CODE, len(footprints) + 1)
+gdf_links_all = link_local_footprints(gdf_footprints, load_local_uprn(os.path.join(dir_inputs, 'uprn.csv')),
+                                      load_local_epc(dir_inputs, AREA_OF_INTEREST_CODE))
+gdf_tile_catalog = build_tile_catalog(DIR_ASSETS, os.path.join(dir_inputs, 'tile_catalog.json'))
+gdf_pc, gdf_links = crop_pointclouds_per_building_local(0, len(footprints) + 1, BUILDING_BUFFER_METERS,
+                                                        POINT_COUNT_THRESHOLD, gdf_footprints, gdf_links_all,
+                                                        gdf_tile_catalog)
+
+# compare with reference cropping
+for i, tile in enumerate(example_tiles):
+    las = laspy.read(tile)
+    xyz = np.column_stack((las.x, las.y, las.z))
+    fp_buffer = footprints[i].buffer(BUILDING_BUFFER_METERS)
+    is_inside = np.array([fp_buffer.contains(shapely.geometry.Point(point[:2])) for point in xyz])
+    xyz_reference = np.unique(xyz[is_inside], axis=0)
+
+    row = gdf_pc[gdf_pc.id_fp == i].iloc[0]
+    row_link = gdf_links[gdf_links.id_fp == i].iloc[0]
+    xyz_local = pointcloud_to_numpy(row.geom)
+    is_equal = np.array_equal(np.unique(xyz_local, axis=0), xyz_reference)
+    print('%s: %s points (reference %s), uprn %s, epc %s, identical: %s' % (
+        os.path.basename(tile), row.num_p_in_pc, len(xyz_reference), row_link.uprn, row_link.id_epc_lmk_key, is_equal))
+
+# footprint without UPRN: one link without uprn, uprn geometry and epc entry
+gdf_links_without_uprn = gdf_links[gdf_links.id_fp == id_fp_without_uprn]
+print('footprint without uprn: %s links, linked to uprn or epc: %s' % (
+    len(gdf_links_without_uprn), gdf_links_without_uprn[['uprn', 'geom_uprn', 'id_epc_lmk_key']].notna().any().any()))
+
+# LAS file next to the LAZ file of the same tile: the tile is catalogued once
+dir_tiles = os.path.join(dir_inputs, 'tiles')
+os.mkdir(dir_tiles)
+for tile_file in ['tile_a.laz', 'tile_a.las', 'tile_b.las']:
+    shutil.copy(example_tiles[0], os.path.join(dir_tiles, tile_file))
+gdf_duplicate_catalog = build_tile_catalog(dir_tiles)
+print('tile catalog with las and laz file of a tile: %s (expected tile_a.laz, tile_b.las)'
+      % sorted(gdf_duplicate_catalog.file_name))
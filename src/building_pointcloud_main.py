@@ -15,11 +15,32 @@ if DIR_BASE not in sys.path:
 
 # Import functions from own .py scripts
 from pointcloud_functions import *
-from utils.utils import convert_multipoint_to_numpy, check_directory_paths, file_name_from_polygon_list
+from local_pointcloud_functions import load_local_footprints, load_local_uprn, load_local_epc, \
+    link_local_footprints, crop_pointclouds_per_building_local
+from utils.tile_catalog import build_tile_catalog, estimate_points_per_footprint
+from utils.chunk_pipeline import run_chunk_pipeline, prefetch_batches, point_budget_chunk_bounds
+from utils.chunk_jobs import default_worker_id, chunk_job_name, create_chunk_jobs, claim_chunk_jobs, \
+    chunk_lease_heartbeat, complete_chunk_job, release_chunk_jobs, chunk_job_progress, wait_for_chunk_jobs
+from utils.pointcloud_batch import PointCloudBatch
+from utils.pointcloud_store import PointCloudStoreReader, remove_pointcloud_shards
+from utils.utils import check_directory_paths, file_name_from_polygon_list
 from utils.visualization import batch_visualization
 from utils.aerial_image import get_aerial_image_lat_lon
 
 ######################   Configuration   #####################################
+# Cropping backend: 'database' crops the point clouds in the pgpointcloud database,
+# 'local' crops them from the LAS/LAZ files directly and reads footprints, UPRN and EPC data from files
+CROPPING_BACKEND = 'database'
+# Format of the point clouds fetched from the database: 'multipoint' (PostGIS multipoint),
+# 'packed' (binary float arrays decoded with numpy, faster and less data to transfer) or
+# 'chunk_patches' (points of every patch fetched once per chunk and cropped per building in python)
+FETCH_MODE = 'packed'
+# number of buildings per batch when streaming point clouds from the database with a server-side cursor.
+# Buildings are processed while the query is running and the memory usage no longer depends on the chunk size.
+# None fetches the whole chunk at once (required for FETCH_MODE 'chunk_patches')
+STREAM_FETCH_SIZE = None
+# number of batches of a streamed chunk read in advance, while the previous chunks are processed (see PREFETCH_CHUNKS)
+STREAM_PREFETCH_BATCHES = 2
 # Define point cloud parameters
 # UK local authority boundary code to specify area of interest (AOI)
 AREA_OF_INTEREST_CODE = 'E06000014'
@@ -29,18 +50,64 @@ RESULTS_PUBLIC = False
 BUILDING_BUFFER_METERS = 0.5
 # define how many footprints should be created. Use "None" to use all footprints in AOI
 MAX_NUMBER_OF_FOOTPRINTS = None
+# order of the footprints in the chunks: 'spatial' (Hilbert curve of footprint centroids, every chunk covers a compact
+# area and reads less LiDAR data, the same order in both cropping backends) or 'id' (footprint id)
+FOOTPRINT_ORDER = 'spatial'
 # number of footprints per query (size of data requires processing in chunks)
 NUM_FOOTPRINTS_CHUNK_SIZE = 500
+# size chunks by the estimated number of points instead of the number of footprints. None uses chunks of
+# NUM_FOOTPRINTS_CHUNK_SIZE footprints. Otherwise chunks are cut, so that all chunks held in memory at the same time
+# (see PREFETCH_CHUNKS and NUM_CHUNK_PROCESSING_WORKERS) fit into MAX_CHUNK_MEMORY_MB
+MAX_CHUNK_MEMORY_MB = None
+# estimated memory per point while a chunk is fetched and processed (point clouds, floor points, numpy arrays)
+CHUNK_BYTES_PER_POINT = 400
+# maximum number of footprints per chunk if chunks are sized by MAX_CHUNK_MEMORY_MB
+MAX_FOOTPRINTS_PER_CHUNK = 5000
+# estimation of points per footprint: 'tile_density' (buffered footprint area x point density of the LiDAR tiles) or
+# 'patches' (point counts of the intersecting database patches, only for the database backend)
+CHUNK_POINT_ESTIMATE = 'tile_density'
 # define minimum points in point cloud, smaller point clouds are dismissed
 POINT_COUNT_THRESHOLD = 100
+# output format of the building point clouds: 'npy' (one .npy file per building in "npy_raw") or 'shards' (the point
+# clouds of a chunk packed into one file with an index in "npy_shards", see utils/pointcloud_store.py)
+POINTCLOUD_OUTPUT_FORMAT = 'npy'
+# encoding of the points in the shards: 'float64', 'float32' (relative to a per-building origin), 'int32' or 'int16'
+# (quantised relative to a per-building origin, like in LAS files). 'int32' and 'float32' are lossless and store 12
+# instead of 24 bytes per point, 'int16' stores 6 bytes per point and rounds floor points to centimetres
+POINTCLOUD_STORAGE_ENCODING = 'float64'
 # define how many example 3D plots should be created
 NUMBER_EXAMPLE_VISUALIZATIONS = 20
 # define if google aerial images should be downloaded for evaluation purposes.
 # Make sure to add a google key in the config file if this is set to True!
 ENABLE_AERIAL_IMAGE_DOWNLOAD = False
-# Enable starting from a specific iteration.
-# Default: 0. Only adapt if necessary! (e.g. to continue an interrupted run)
-START_ITERATION = 0
+# number of parallel worker processes used to import LiDAR tiles into the database
+NUM_LAZ_IMPORT_WORKERS = 4
+# import only LiDAR points within the buffered building footprints of the AOI into the database.
+# Reduces database size and query time, but the lidar table then only serves this AOI
+PRE_CROP_LIDAR_TO_FOOTPRINTS = False
+# dimensions and coordinate encoding of the LiDAR patches in the database.
+# None stores all dimensions of the LAZ files, COMPACT_LIDAR_SCHEMA only the dimensions used by the pipeline.
+# Changing the schema requires a new (empty) lidar table
+LIDAR_INGESTION_SCHEMA = None
+# number of LiDAR points per database patch. 'auto' chooses the number per tile from the tile's point density,
+# so that every patch covers about PATCH_TARGET_AREA_M2
+PATCH_CAPACITY = 400
+PATCH_TARGET_AREA_M2 = 25.0
+# number of chunks fetched in advance while the previous chunks are processed (bounds the memory usage)
+PREFETCH_CHUNKS = 1
+# number of threads processing fetched chunks (floor points, numpy conversion, saving)
+NUM_CHUNK_PROCESSING_WORKERS = 1
+# number of processes adding floor points to the building point clouds (one process pool for all batches of the run)
+NUM_FLOOR_POINT_WORKERS = 1
+# Job table for processing the chunks with several workers (processes or machines sharing the output directory).
+# None processes all chunks in this process. Otherwise the database url (config.DATABASE_URL) or a SQLite file path.
+# Done chunks are recorded in the job table and not processed again. Failed chunks are processed again in the next run
+CHUNK_JOB_STORE = None
+# additional workers skip the data preparation (LiDAR import, materialized view) and the final result files.
+# Start them with the same configuration, they wait until the first worker has created the chunk jobs
+RUN_AS_ADDITIONAL_WORKER = False
+# time after which chunks of crashed workers are processed by other workers
+CHUNK_LEASE_SECONDS = 900
 
 # Define project base directory and paths
 DIR_ASSETS = os.path.join(DIR_BASE, 'assets')
@@ -48,106 +115,266 @@ DIR_LAZ_FILES = os.path.join(DIR_ASSETS, "uk_lidar_data")
 DIR_EPC = os.path.join(DIR_ASSETS, "epc")
 DIR_VISUALIZATION = os.path.join(DIR_ASSETS, "example_pointclouds")
 DIR_AERIAL_IMAGES = os.path.join(DIR_ASSETS, "aerial_image_examples")
+# Input files of the local cropping backend
+FILE_PATH_LOCAL_FOOTPRINTS = os.path.join(DIR_ASSETS, "footprints", "footprints.gpkg")
+FILE_PATH_LOCAL_UPRN = os.path.join(DIR_ASSETS, "uprn", "osopenuprn.csv")
+FILE_PATH_LOCAL_AOI_BOUNDARY = os.path.join(DIR_ASSETS, "local_authority_boundaries", "local_authority_boundaries.shp")
 
 # Create a new output folder for the defined area of interest
 DIR_OUTPUTS = os.path.join('/home/vagrant/data_share', 'outputs')
 SUB_FOLDER_LIST = ['npy_raw', 'footprints', 'uprn', 'epc', 'filename_mapping']
 DIR_AOI_OUTPUT = output_folder_setup(DIR_OUTPUTS, AREA_OF_INTEREST_CODE, SUB_FOLDER_LIST)
+DIR_NPY_SHARDS = os.path.join(DIR_AOI_OUTPUT, 'npy_shards')
+if POINTCLOUD_OUTPUT_FORMAT == 'shards':
+    os.makedirs(DIR_NPY_SHARDS, exist_ok=True)
 
 # Check that all required directories exist
 check_directory_paths([DIR_ASSETS, DIR_OUTPUTS, DIR_LAZ_FILES, DIR_VISUALIZATION, DIR_AERIAL_IMAGES, DIR_AOI_OUTPUT])
 
-# Define database table names
-DB_TABLE_NAME_LIDAR = 'uk_lidar_data'
-DB_TABLE_NAME_FOOTPRINTS = 'footprints_verisk'
-DB_TABLE_NAME_UPRN = 'uprn'
-DB_TABLE_NAME_EPC = 'epc'
-DB_TABLE_NAME_AREA_OF_INTEREST = 'local_authority_boundaries'
-
-# Initialize connection to database
-DB_CONNECTION_URL = config.DATABASE_URL
-engine = create_engine(DB_CONNECTION_URL, echo=False)
-
-# Test connection to database
-with engine.connect() as con:
-    res = con.execute('SELECT * FROM footprints_verisk LIMIT 1')
-print(res.all())
-
-# Load footprint geojsons into database (only required if they haven't already been uploaded already)
-# STANDARD_CRS = 27700
-# DIR_BUILDING_FOOTPRINTS = os.path.join(DIR_ASSETS, "aoi")
-# gdf_footprints = load_geojson_footprints_into_database(
-#     DIR_BUILDING_FOOTPRINTS, DB_TABLE_NAME_FOOTPRINTS, engine, STANDARD_CRS
-# )
-
-# Load point cloud data into database
-# Unpacks LAZ-files and inserts all newly unpacked LAS-files into the database
-# Existing LAS-files in directory are considered to be in the database already
-print("Starting LAZ to DB", datetime.now().strftime("%H:%M:%S"))
-load_laz_pointcloud_into_database(DIR_LAZ_FILES, DB_TABLE_NAME_LIDAR)
-
-# Load EPC data into database
-file_path = os.path.join(DIR_EPC, AREA_OF_INTEREST_CODE + '.csv')
-df_epc = pd.read_csv(file_path)
-with engine.connect() as con:
-    df_epc.to_sql('epc', con=con, if_exists='replace', index=False)
-
-# Add geoindex to footprint and lidar tables and vacuum table
-print("Starting geoindexing", datetime.now().strftime("%H:%M:%S"))
-db_table_names = [DB_TABLE_NAME_LIDAR, DB_TABLE_NAME_FOOTPRINTS, DB_TABLE_NAME_UPRN, DB_TABLE_NAME_AREA_OF_INTEREST]
-db_is_lidar = [1, 0, 0, 0]
-add_geoindex_to_databases(config.DATABASE_URL, db_table_names, db_is_lidar)
-
 # Adapt NUMBER_OF_FOOTPRINTS to use all footprints if None
 if MAX_NUMBER_OF_FOOTPRINTS == None:
     MAX_NUMBER_OF_FOOTPRINTS = 1000000000  # 1 billion, which is more than UKs building stock
 
-# Create materialized view of footprints in area of interest (required for processing in chunks)
-num_footprints = create_footprints_in_area_materialized_view(
-    DB_CONNECTION_URL, AREA_OF_INTEREST_CODE, MAX_NUMBER_OF_FOOTPRINTS, DB_TABLE_NAME_AREA_OF_INTEREST,
-    DB_TABLE_NAME_FOOTPRINTS
-)
+if CROPPING_BACKEND == 'database':
+    # Define database table names
+    DB_TABLE_NAME_LIDAR = 'uk_lidar_data'
+    DB_TABLE_NAME_FOOTPRINTS = 'footprints_verisk'
+    DB_TABLE_NAME_UPRN = 'uprn'
+    DB_TABLE_NAME_EPC = 'epc'
+    DB_TABLE_NAME_AREA_OF_INTEREST = 'local_authority_boundaries'
+    DB_TABLE_NAME_LINKS = AREA_OF_INTEREST_CODE + '_links'
+
+    # Initialize connection to database
+    DB_CONNECTION_URL = config.DATABASE_URL
+    engine = create_engine(DB_CONNECTION_URL, echo=False)
+
+    # Test connection to database
+    with engine.connect() as con:
+        res = con.execute('SELECT * FROM footprints_verisk LIMIT 1')
+    print(res.all())
+
+    if not RUN_AS_ADDITIONAL_WORKER:
+        # Load footprint geojsons into database (only required if they haven't already been uploaded already)
+        # STANDARD_CRS = 27700
+        # DIR_BUILDING_FOOTPRINTS = os.path.join(DIR_ASSETS, "aoi")
+        # gdf_footprints = load_geojson_footprints_into_database(
+        #     DIR_BUILDING_FOOTPRINTS, DB_TABLE_NAME_FOOTPRINTS, engine, STANDARD_CRS
+        # )
+
+        # Load point cloud data into database
+        # Streams all new or changed LAZ-files into the database
+        # Imported LAZ-files are recorded in an ingestion manifest in the LAZ directory and skipped if unchanged
+        print("Starting LAZ to DB", datetime.now().strftime("%H:%M:%S"))
+        gdf_aoi_footprints = None
+        if PRE_CROP_LIDAR_TO_FOOTPRINTS:
+            gdf_aoi_footprints = fetch_buffered_aoi_footprints(
+                engine, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS, DB_TABLE_NAME_AREA_OF_INTEREST,
+                DB_TABLE_NAME_FOOTPRINTS
+            )
+        load_laz_pointcloud_into_database(DIR_LAZ_FILES, DB_TABLE_NAME_LIDAR, num_workers=NUM_LAZ_IMPORT_WORKERS,
+                                          aoi_footprints=gdf_aoi_footprints, ingestion_schema=LIDAR_INGESTION_SCHEMA,
+                                          patch_capacity=PATCH_CAPACITY, target_patch_area_m2=PATCH_TARGET_AREA_M2)
+
+        # Load EPC data into database
+        file_path = os.path.join(DIR_EPC, AREA_OF_INTEREST_CODE + '.csv')
+        df_epc = pd.read_csv(file_path)
+        with engine.connect() as con:
+            df_epc.to_sql('epc', con=con, if_exists='replace', index=False)
+
+        # Add geoindex to footprint and lidar tables and vacuum table
+        print("Starting geoindexing", datetime.now().strftime("%H:%M:%S"))
+        db_table_names = [DB_TABLE_NAME_LIDAR, DB_TABLE_NAME_FOOTPRINTS, DB_TABLE_NAME_UPRN,
+                          DB_TABLE_NAME_AREA_OF_INTEREST]
+        db_is_lidar = [1, 0, 0, 0]
+        add_geoindex_to_databases(config.DATABASE_URL, db_table_names, db_is_lidar)
+
+        # Create materialized view of footprints in area of interest (required for processing in chunks)
+        num_footprints = create_footprints_in_area_materialized_view(
+            DB_CONNECTION_URL, AREA_OF_INTEREST_CODE, MAX_NUMBER_OF_FOOTPRINTS, DB_TABLE_NAME_AREA_OF_INTEREST,
+            DB_TABLE_NAME_FOOTPRINTS, footprint_order=FOOTPRINT_ORDER
+        )
+        # Link footprints with uprn and epc data once for the area of interest
+        print("Starting footprint linking", datetime.now().strftime("%H:%M:%S"))
+        create_footprint_links_table(DB_CONNECTION_URL, AREA_OF_INTEREST_CODE, DB_TABLE_NAME_UPRN, DB_TABLE_NAME_EPC)
+    else:
+        # the first worker has already prepared the database
+        num_footprints = pd.read_sql('select count(*) from "%s"' % AREA_OF_INTEREST_CODE, engine).iloc[0, 0]
+elif CROPPING_BACKEND == 'local':
+    # Load footprints, UPRN and EPC data from files and create a catalog of the LiDAR tiles
+    gdf_local_footprints = load_local_footprints(
+        FILE_PATH_LOCAL_FOOTPRINTS, FILE_PATH_LOCAL_AOI_BOUNDARY, AREA_OF_INTEREST_CODE, MAX_NUMBER_OF_FOOTPRINTS,
+        footprint_order=FOOTPRINT_ORDER
+    )
+    gdf_local_links = link_local_footprints(
+        gdf_local_footprints, load_local_uprn(FILE_PATH_LOCAL_UPRN), load_local_epc(DIR_EPC, AREA_OF_INTEREST_CODE)
+    )
+    gdf_tile_catalog = build_tile_catalog(DIR_LAZ_FILES)
+    num_footprints = len(gdf_local_footprints)
 
 print("Starting point cloud cropping", datetime.now().strftime("%H:%M:%S"))
 # processing the cropping in chunks
-num_iterations = np.ceil(num_footprints / NUM_FOOTPRINTS_CHUNK_SIZE)
-# initialize loop's variables, because they are deleted at beginning of every loop to avoid memory overflow
-gdf = gpd.GeoDataFrame()
-gdf_pc = gpd.GeoDataFrame()
-lidar_numpy_list = []
-for n_iteration in np.arange(START_ITERATION, num_iterations):
-    # delete gdf manually to avoid memory overflow
-    del gdf, gdf_pc, lidar_numpy_list
+if MAX_CHUNK_MEMORY_MB is None:
+    chunk_bounds = [(n_chunk * NUM_FOOTPRINTS_CHUNK_SIZE, (n_chunk + 1) * NUM_FOOTPRINTS_CHUNK_SIZE)
+                    for n_chunk in range(int(np.ceil(num_footprints / NUM_FOOTPRINTS_CHUNK_SIZE)))]
+else:
+    # estimate the points per footprint and cut chunks to fit the point budget
+    if CROPPING_BACKEND == 'database' and CHUNK_POINT_ESTIMATE == 'patches':
+        estimated_points = estimate_points_per_footprint_database(
+            engine, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS, DB_TABLE_NAME_LIDAR)
+    elif CROPPING_BACKEND == 'database':
+        estimated_points = estimate_points_per_footprint(
+            fetch_footprints_in_area_materialized_view(engine, AREA_OF_INTEREST_CODE),
+            build_tile_catalog(DIR_LAZ_FILES), BUILDING_BUFFER_METERS)
+    elif CROPPING_BACKEND == 'local':
+        estimated_points = estimate_points_per_footprint(
+            gdf_local_footprints, gdf_tile_catalog, BUILDING_BUFFER_METERS)
+    num_chunks_in_memory = PREFETCH_CHUNKS + NUM_CHUNK_PROCESSING_WORKERS + 1
+    max_points_per_chunk = MAX_CHUNK_MEMORY_MB * 1e6 / CHUNK_BYTES_PER_POINT / num_chunks_in_memory
+    chunk_bounds = point_budget_chunk_bounds(estimated_points, max_points_per_chunk, MAX_FOOTPRINTS_PER_CHUNK)
+    print("%s chunks of up to %s estimated points" % (len(chunk_bounds), int(max_points_per_chunk)))
+num_iterations = len(chunk_bounds)
+# chunks with a completion marker of the same settings are skipped, so that an interrupted run continues automatically
+CHUNK_SETTINGS = {
+    'cropping_backend': CROPPING_BACKEND,
+    'num_footprints': int(num_footprints),
+    'footprint_order': FOOTPRINT_ORDER,
+    'chunk_bounds': [[int(fp_num_start), int(fp_num_end)] for fp_num_start, fp_num_end in chunk_bounds],
+    'building_buffer_meters': BUILDING_BUFFER_METERS,
+    'point_count_threshold': POINT_COUNT_THRESHOLD,
+    'pointcloud_output_format': POINTCLOUD_OUTPUT_FORMAT,
+    'pointcloud_storage_encoding': POINTCLOUD_STORAGE_ENCODING
+}
+completed_chunks = completed_chunk_ids(DIR_AOI_OUTPUT, CHUNK_SETTINGS)
+chunk_ids = [n_iteration for n_iteration in np.arange(num_iterations) if int(n_iteration) not in completed_chunks]
+print("%s of %s chunks already completed" % (len(completed_chunks), num_iterations))
+if CHUNK_JOB_STORE is None:
+    remove_temporary_output_files(DIR_AOI_OUTPUT)
 
+
+def fetch_chunk(n_iteration):
+    # Fetch cropped point clouds (one row per footprint) and footprint - uprn - epc links from database or crop them
+    # from the LiDAR tiles. Point clouds are returned as batches (GeoDataFrames), streamed if STREAM_FETCH_SIZE is set
     print("Prcoessing footprints - chunk %s out of %s - " % (n_iteration, num_iterations),
           datetime.now().strftime("%H:%M:%S"))
-    fp_num_start = n_iteration * NUM_FOOTPRINTS_CHUNK_SIZE
-    fp_num_end = (n_iteration + 1) * NUM_FOOTPRINTS_CHUNK_SIZE
+    fp_num_start, fp_num_end = chunk_bounds[int(n_iteration)]
+    if CROPPING_BACKEND == 'database' and STREAM_FETCH_SIZE is not None:
+        gdf_pc_batches, gdf_links = stream_pointclouds_per_building(
+            fp_num_start, fp_num_end, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS, MAX_NUMBER_OF_FOOTPRINTS,
+            POINT_COUNT_THRESHOLD, DB_TABLE_NAME_UPRN, DB_TABLE_NAME_EPC, DB_TABLE_NAME_LIDAR, engine,
+            fetch_mode=FETCH_MODE, TABLE_NAME_LINKS=DB_TABLE_NAME_LINKS, fetch_size=STREAM_FETCH_SIZE
+        )
+        # the query starts now and the first batches are read before the chunk is processed
+        return prefetch_batches(gdf_pc_batches, STREAM_PREFETCH_BATCHES), gdf_links
+    if CROPPING_BACKEND == 'database':
+        gdf_pc, gdf_links = crop_and_fetch_pointclouds_per_building(
+            fp_num_start, fp_num_end, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS, MAX_NUMBER_OF_FOOTPRINTS,
+            POINT_COUNT_THRESHOLD, DB_TABLE_NAME_UPRN, DB_TABLE_NAME_EPC, DB_TABLE_NAME_LIDAR, engine,
+            fetch_mode=FETCH_MODE, TABLE_NAME_LINKS=DB_TABLE_NAME_LINKS
+        )
+    elif CROPPING_BACKEND == 'local':
+        gdf_pc, gdf_links = crop_pointclouds_per_building_local(
+            fp_num_start, fp_num_end, BUILDING_BUFFER_METERS, POINT_COUNT_THRESHOLD, gdf_local_footprints,
+            gdf_local_links, gdf_tile_catalog
+        )
+    return [gdf_pc], gdf_links
 
-    # Fetch cropped point clouds from database
-    gdf = crop_and_fetch_pointclouds_per_building(
-        fp_num_start, fp_num_end, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS, MAX_NUMBER_OF_FOOTPRINTS,
-        POINT_COUNT_THRESHOLD, DB_TABLE_NAME_UPRN, DB_TABLE_NAME_EPC, DB_TABLE_NAME_LIDAR, engine
-    )
-    # Add floor points to building pointcloud
-    print("Floor point adding - chunk %s out of %s - " % (n_iteration, num_iterations),
-          datetime.now().strftime("%H:%M:%S"))
-    gdf_pc = gdf[gdf.geom != None].copy()
-    gdf_pc = add_floor_points_to_points_in_gdf(gdf_pc)
 
-    # Save raw point cloud without threshold or scaling
-    print("Numpy list creation - chunk %s out of %s - " % (n_iteration, num_iterations),
-          datetime.now().strftime("%H:%M:%S"))
-    lidar_numpy_list = list(gdf_pc.geom.apply(convert_multipoint_to_numpy))
-    # Save building point clouds as npy
-    print("Numpy saving - chunk %s out of %s - " % (n_iteration, num_iterations), datetime.now().strftime("%H:%M:%S"))
-    dir_npy = os.path.join(DIR_AOI_OUTPUT, 'npy_raw')
-    save_lidar_numpy_list(lidar_numpy_list, gdf_pc, dir_npy)
+def process_chunk(n_iteration, fetched_chunk):
+    gdf_pc_batches, gdf_links = fetched_chunk
+    # point cloud information of all batches, required for the file mapping
+    df_pc_info_list = []
+    if POINTCLOUD_OUTPUT_FORMAT == 'shards':
+        # shards of an earlier, interrupted run of the chunk
+        remove_pointcloud_shards(DIR_NPY_SHARDS, 'shard_%s_' % n_iteration)
+    for n_batch, gdf_pc in enumerate(gdf_pc_batches):
+        # Add floor points to building pointcloud
+        print("Floor point adding - chunk %s out of %s, batch %s - " % (n_iteration, num_iterations, n_batch),
+              datetime.now().strftime("%H:%M:%S"))
+        # the point clouds of the batch are held in one flat array from here on
+        pc_batch = PointCloudBatch.from_gdf(gdf_pc)
+        del gdf_pc
+        pc_batch = add_floor_points_to_points_in_gdf(pc_batch, num_workers=NUM_FLOOR_POINT_WORKERS,
+                                                     executor=floor_point_executor)
+
+        # Save raw point cloud without threshold or scaling
+        # Save building point clouds as npy
+        print("Numpy saving - chunk %s out of %s, batch %s - " % (n_iteration, num_iterations, n_batch),
+              datetime.now().strftime("%H:%M:%S"))
+        if POINTCLOUD_OUTPUT_FORMAT == 'shards':
+            save_pointcloud_batch_shard(pc_batch, DIR_NPY_SHARDS, 'shard_%s_%s' % (n_iteration, n_batch),
+                                        encoding=POINTCLOUD_STORAGE_ENCODING)
+        else:
+            lidar_numpy_list = pc_batch.pointclouds()
+            dir_npy = os.path.join(DIR_AOI_OUTPUT, 'npy_raw')
+            save_lidar_numpy_list(lidar_numpy_list, pc_batch, dir_npy)
+        df_pc_info_list.append(pd.DataFrame({'id_fp': pc_batch.info.id_fp, 'num_p_in_pc': pc_batch.info.num_p_in_pc}))
+    df_pc_info = pd.concat(df_pc_info_list) if len(df_pc_info_list) > 0 else \
+        pd.DataFrame({'id_fp': [], 'num_p_in_pc': []})
 
     # Save raw information of footprints, epc label, uprn, file mapping
     print("Save additional data - chunk %s out of %s - " % (n_iteration, num_iterations),
           datetime.now().strftime("%H:%M:%S"))
-    save_raw_input_information(n_iteration, gdf, DIR_AOI_OUTPUT, AREA_OF_INTEREST_CODE)
+    save_raw_input_information(n_iteration, gdf_links, df_pc_info, DIR_AOI_OUTPUT, AREA_OF_INTEREST_CODE)
+
+    # Mark chunk as complete after all outputs are written
+    write_chunk_completion_marker(DIR_AOI_OUTPUT, n_iteration, CHUNK_SETTINGS, {'num_pointclouds': len(df_pc_info)})
+    return
+
+
+# worker processes adding floor points, used for all batches of the run. Started before the chunk pipeline starts its
+# threads
+floor_point_executor = floor_point_worker_pool(NUM_FLOOR_POINT_WORKERS)
+# the next chunks are fetched while the previous chunks are processed. Only PREFETCH_CHUNKS fetched chunks wait for
+# processing, which keeps the memory usage bounded
+if CHUNK_JOB_STORE is None:
+    run_chunk_pipeline(chunk_ids, fetch_chunk, process_chunk,
+                       prefetch_depth=PREFETCH_CHUNKS, num_workers=NUM_CHUNK_PROCESSING_WORKERS)
+else:
+    # chunks are claimed from the job table under a lease, which is renewed while the worker is running.
+    # The jobs are specific to the chunk settings, jobs of chunks without completion marker are processed (again)
+    worker_id = default_worker_id()
+    job_name = chunk_job_name(AREA_OF_INTEREST_CODE, CHUNK_SETTINGS)
+    if not RUN_AS_ADDITIONAL_WORKER:
+        create_chunk_jobs(CHUNK_JOB_STORE, job_name, chunk_ids)
+    elif len(chunk_ids) > 0:
+        wait_for_chunk_jobs(CHUNK_JOB_STORE, job_name)
+
+
+    def process_chunk_job(n_iteration, fetched_chunk):
+        process_chunk(n_iteration, fetched_chunk)
+        complete_chunk_job(CHUNK_JOB_STORE, job_name, n_iteration, worker_id)
+        return
+
+
+    try:
+        with chunk_lease_heartbeat(CHUNK_JOB_STORE, job_name, worker_id, CHUNK_LEASE_SECONDS):
+            run_chunk_pipeline(
+                claim_chunk_jobs(CHUNK_JOB_STORE, job_name, worker_id, CHUNK_LEASE_SECONDS),
+                fetch_chunk, process_chunk_job, prefetch_depth=PREFETCH_CHUNKS,
+                num_workers=NUM_CHUNK_PROCESSING_WORKERS
+            )
+    finally:
+        release_chunk_jobs(CHUNK_JOB_STORE, job_name, worker_id)
+    chunk_jobs_status = chunk_job_progress(CHUNK_JOB_STORE, job_name)
+    print("Chunk jobs: %s" % chunk_jobs_status)
+    # the results are only stitched if all chunks are done
+    if not RUN_AS_ADDITIONAL_WORKER and any(status != 'done' for status in chunk_jobs_status):
+        raise RuntimeError('not all chunk jobs are done (%s). Run again to process the failed chunks'
+                           % chunk_jobs_status)
+
+if floor_point_executor is not None:
+    floor_point_executor.shutdown()
+
+# the final result files are created by the first worker, after all chunks are done
+if RUN_AS_ADDITIONAL_WORKER:
+    sys.exit(0)
+
+# all chunks must be completed with the current settings, outputs of chunks of other settings are not stitched
+missing_chunks = set(range(num_iterations)) - completed_chunk_ids(DIR_AOI_OUTPUT, CHUNK_SETTINGS)
+if len(missing_chunks) > 0:
+    raise RuntimeError('%s of %s chunks are not completed, e.g. chunk %s. Run again to process them'
+                       % (len(missing_chunks), num_iterations, min(missing_chunks)))
+remove_stale_chunk_outputs(DIR_AOI_OUTPUT, CHUNK_SETTINGS, SUB_FOLDER_LIST)
 
 # stitch all raw input information jsons to create one result json
 stitch_raw_input_information(DIR_OUTPUTS, AREA_OF_INTEREST_CODE, SUB_FOLDER_LIST)
@@ -164,13 +391,19 @@ generate_final_geojson(DIR_EPC, DIR_OUTPUTS, AREA_OF_INTEREST_CODE, gdf_fm, is_p
 
 # Visualization for evaluation of results
 # Visualize example building point cloud data
-DIR_POINT_CLOUDS = os.path.join(DIR_OUTPUTS, AREA_OF_INTEREST_CODE, SUB_FOLDER_LIST[0])
+if POINTCLOUD_OUTPUT_FORMAT == 'shards':
+    DIR_POINT_CLOUDS = DIR_NPY_SHARDS
+else:
+    DIR_POINT_CLOUDS = os.path.join(DIR_OUTPUTS, AREA_OF_INTEREST_CODE, SUB_FOLDER_LIST[0])
 batch_visualization(DIR_POINT_CLOUDS, DIR_VISUALIZATION,
                     format='html', status_update=False, number_examples=NUMBER_EXAMPLE_VISUALIZATIONS)
 
 # Download aerial image for the building examples
 if ENABLE_AERIAL_IMAGE_DOWNLOAD:
-    pc_file_names = os.listdir(DIR_POINT_CLOUDS)
+    if POINTCLOUD_OUTPUT_FORMAT == 'shards':
+        pc_file_names = PointCloudStoreReader(DIR_POINT_CLOUDS).file_names
+    else:
+        pc_file_names = os.listdir(DIR_POINT_CLOUDS)
     pc_file_names = pc_file_names[:NUMBER_EXAMPLE_VISUALIZATIONS]
     pc_file_names = [fn[:-4] for fn in pc_file_names]
     center_point_list = [Point(float(fn[0:fn.find("_"):]), float(fn[fn.find("_") + 1:])) for fn in pc_file_names]
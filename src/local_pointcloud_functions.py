@@ -0,0 +1,133 @@
+import os
+
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+import shapely
+
+from utils.pointcloud_cropping import read_tile_points_in_bounds, crop_points_to_polygons, \
+    building_pointcloud_information
+from utils.tile_catalog import tiles_intersecting_geometry
+from utils.utils import hilbert_curve_order
+
+# Database-free alternative to the cropping in pointcloud_functions.py. Footprints, UPRN and EPC data are read from
+# files and the LiDAR points are read from the LAS/LAZ tiles directly. The results (point clouds per footprint and
+# footprint - uprn - epc links) have the same columns as the results of crop_and_fetch_pointclouds_per_building.
+
+
+def load_local_footprints(FILE_PATH_FOOTPRINTS: str, FILE_PATH_AOI_BOUNDARY: str, AREA_OF_INTEREST_CODE: str,
+                          NUMBER_OF_FOOTPRINTS: int, footprint_order: str = 'id'):
+    # loads footprints within the area of interest and numbers them like the footprint materialized view.
+    # footprint_order 'id': order by footprint id, 'spatial': order by the position of the footprint centroid on a
+    # Hilbert curve, so that every chunk covers a compact area and reads points from few tiles (the same order as in
+    # create_footprints_in_area_materialized_view)
+    gdf_footprints = gpd.read_file(FILE_PATH_FOOTPRINTS)
+    if gdf_footprints.crs != 27700:
+        gdf_footprints = gdf_footprints.to_crs(27700)
+    if FILE_PATH_AOI_BOUNDARY is not None:
+        gdf_boundary = gpd.read_file(FILE_PATH_AOI_BOUNDARY)
+        gdf_boundary = gdf_boundary[gdf_boundary.lad21cd == AREA_OF_INTEREST_CODE].to_crs(27700)
+        aoi_geom = shapely.ops.unary_union(list(gdf_boundary.geometry))
+        gdf_footprints = gdf_footprints[gdf_footprints.intersects(aoi_geom)]
+
+    # use the footprint id of the file if available (gid in the verisk footprints)
+    id_fp = gdf_footprints.gid if 'gid' in gdf_footprints.columns else gdf_footprints.index
+    gdf_footprints = gpd.GeoDataFrame(
+        {'id_fp': np.asarray(id_fp), 'geom_fp': list(gdf_footprints.geometry)}, geometry='geom_fp', crs=27700)
+    gdf_footprints = gdf_footprints.sort_values('id_fp').iloc[:NUMBER_OF_FOOTPRINTS].reset_index(drop=True)
+    if footprint_order == 'spatial':
+        gdf_footprints = gdf_footprints.iloc[hilbert_curve_order(gdf_footprints.geom_fp)].reset_index(drop=True)
+    elif footprint_order != 'id':
+        raise ValueError('unknown footprint_order %s' % footprint_order)
+    gdf_footprints['id_fp_chunks'] = np.arange(1, len(gdf_footprints) + 1)
+    return gdf_footprints
+
+
+def load_local_uprn(FILE_PATH_UPRN: str):
+    # loads UPRN points either from the OS Open UPRN csv (X_COORDINATE, Y_COORDINATE) or from a vector file
+    if FILE_PATH_UPRN[-4:] == '.csv':
+        df_uprn = pd.read_csv(FILE_PATH_UPRN, usecols=['UPRN', 'X_COORDINATE', 'Y_COORDINATE'])
+        gdf_uprn = gpd.GeoDataFrame(
+            {'uprn': df_uprn.UPRN.astype(float)},
+            geometry=gpd.points_from_xy(df_uprn.X_COORDINATE, df_uprn.Y_COORDINATE), crs=27700)
+    else:
+        gdf_uprn = gpd.read_file(FILE_PATH_UPRN)
+        if gdf_uprn.crs != 27700:
+            gdf_uprn = gdf_uprn.to_crs(27700)
+        uprn_column = 'uprn' if 'uprn' in gdf_uprn.columns else 'UPRN'
+        gdf_uprn = gpd.GeoDataFrame({'uprn': gdf_uprn[uprn_column].astype(float)},
+                                    geometry=gdf_uprn.geometry, crs=27700)
+    return gdf_uprn
+
+
+def load_local_epc(DIR_EPC: str, AREA_OF_INTEREST_CODE: str):
+    # loads the EPC csv of the area of interest, which is also imported into the database in the database backend
+    file_path = os.path.join(DIR_EPC, AREA_OF_INTEREST_CODE + '.csv')
+    df_epc = pd.read_csv(file_path, low_memory=False)
+    df_epc = df_epc[df_epc.LOCAL_AUTHORITY == AREA_OF_INTEREST_CODE]
+    df_epc = df_epc.assign(UPRN=df_epc.UPRN.astype(float))
+    return df_epc
+
+
+def link_local_footprints(gdf_footprints: gpd.GeoDataFrame, gdf_uprn: gpd.GeoDataFrame, df_epc: pd.DataFrame):
+    # links all footprints with uprn (intersection) and epc (uprn) in one pass, like the link table of the database.
+    # Returns one row per footprint and uprn / epc entry, including the chunk number (id_fp_chunks) of the footprint
+    gdf_uprn = gdf_uprn.reset_index(drop=True)
+    gdf_fp_uprn = gpd.sjoin(gdf_footprints[['id_fp_chunks', 'id_fp', 'geom_fp']], gdf_uprn, how='left',
+                            op='intersects')
+    # geometry of the intersecting uprn point itself (like u.geom in the database), not looked up by the uprn value
+    is_linked = gdf_fp_uprn.index_right.notna().to_numpy()
+    geom_uprn = np.full(len(gdf_fp_uprn), None, dtype=object)
+    geom_uprn[is_linked] = gdf_uprn.geometry.to_numpy()[gdf_fp_uprn.index_right[is_linked].astype(np.int64)]
+    gdf_fp_uprn = gdf_fp_uprn.drop(columns='index_right').assign(geom_uprn=geom_uprn)
+    # pandas matches missing keys with each other, the database join never matches NULL. Only epc entries with a uprn
+    # are merged, so that footprints without uprn are not linked to epc entries without uprn
+    df_fp_uprn_epc = gdf_fp_uprn.merge(df_epc[df_epc.UPRN.notna()], left_on='uprn', right_on='UPRN', how='left')
+    df_fp_uprn_epc = df_fp_uprn_epc.sort_values(['id_fp_chunks', 'uprn'], kind='stable')
+    df_fp_uprn_epc['id_query'] = np.arange(1, len(df_fp_uprn_epc) + 1)
+
+    gdf_links = gpd.GeoDataFrame({
+        'id_query': df_fp_uprn_epc.id_query,
+        'id_fp_chunks': df_fp_uprn_epc.id_fp_chunks,
+        'id_fp': df_fp_uprn_epc.id_fp,
+        'uprn': df_fp_uprn_epc.uprn,
+        'id_epc_lmk_key': df_fp_uprn_epc.LMK_KEY,
+        'geom_fp': df_fp_uprn_epc.geom_fp,
+        'geom_uprn': df_fp_uprn_epc.geom_uprn,
+        'energy_rating': df_fp_uprn_epc.CURRENT_ENERGY_RATING,
+        'energy_efficiency': df_fp_uprn_epc.CURRENT_ENERGY_EFFICIENCY
+    }).reset_index(drop=True)
+    return gdf_links
+
+
+def crop_pointclouds_per_building_local(FP_NUM_START, FP_NUM_END, BUILDING_BUFFER_METERS, POINT_COUNT_THRESHOLD,
+                                        gdf_footprints: gpd.GeoDataFrame, gdf_links: gpd.GeoDataFrame,
+                                        gdf_tile_catalog: gpd.GeoDataFrame):
+    # crops the point clouds of one chunk of footprints from the LiDAR tiles.
+    # Returns the point clouds (one row per footprint) and the links of the chunk's footprints with uprn and epc data
+    # (gdf_links of all footprints, see link_local_footprints)
+    gdf_fp_chunk = gdf_footprints[(gdf_footprints.id_fp_chunks > FP_NUM_START) &
+                                  (gdf_footprints.id_fp_chunks <= FP_NUM_END)]
+    fp_buffer_list = list(gdf_fp_chunk.geom_fp.buffer(BUILDING_BUFFER_METERS))
+
+    # read points of all tiles intersecting the chunk within the bounding box of the buffered footprints
+    chunk_bounds = shapely.geometry.MultiPolygon(fp_buffer_list).bounds if len(fp_buffer_list) > 0 else None
+    xyz_list = []
+    if chunk_bounds is not None:
+        gdf_tiles = tiles_intersecting_geometry(gdf_tile_catalog, shapely.geometry.box(*chunk_bounds))
+        xyz_list = [read_tile_points_in_bounds(file_path, chunk_bounds) for file_path in gdf_tiles.file_path]
+    xyz = np.concatenate(xyz_list) if len(xyz_list) > 0 else np.empty((0, 3))
+
+    # crop points per building and calculate point cloud information
+    cropped_points_list = crop_points_to_polygons(xyz, fp_buffer_list)
+    # the point clouds (geom) stay numpy arrays, like the packed point clouds fetched from the database
+    df_pc = building_pointcloud_information(list(gdf_fp_chunk.id_fp), cropped_points_list, POINT_COUNT_THRESHOLD,
+                                            as_multipoint=False)
+
+    gdf_pc = gpd.GeoDataFrame(
+        df_pc.merge(gdf_fp_chunk[['id_fp', 'geom_fp']], on='id_fp', how='left')[
+            ['id_fp', 'geom_fp', 'geom', 'delta_x', 'delta_y', 'delta_z', 'z_min', 'scaling_factor', 'num_p_in_pc']],
+        geometry='geom_fp', crs=27700).reset_index(drop=True)
+    gdf_links_chunk = gdf_links[(gdf_links.id_fp_chunks > FP_NUM_START) & (gdf_links.id_fp_chunks <= FP_NUM_END)]
+    gdf_links_chunk = gdf_links_chunk.drop(columns='id_fp_chunks').reset_index(drop=True)
+    return gdf_pc, gdf_links_chunk
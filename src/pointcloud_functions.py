@@ -1,18 +1,36 @@
 import pdal
 import psycopg2
+import psycopg2.extras
 import shapely
 import json
+import hashlib
 import laspy
 import os
-import pdal
+import time
 
 import config as config
 import geopandas as gpd
 import pandas as pd
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from geoalchemy2 import Geometry
-from utils.utils import normalize_geom, gdf_geometries_wkb_to_shape, file_name_from_polygon_list
+from utils.utils import normalize_geom, wkb_columns_to_shape, file_name_from_polygon_list, \
+    read_las_header_info, file_sha256, pointcloud_to_numpy, atomic_output_path, hilbert_curve_order
+from utils.pointcloud_cropping import crop_points_to_polygons, building_pointcloud_information, points_in_polygon
+from utils.pointcloud_batch import PointCloudBatch, unique_points_per_building, normalize_pointcloud_batch
+from utils.pointcloud_store import write_pointcloud_shard
+
+# Compact point cloud schema for the lidar table. Only dimensions used by the pipeline are stored, coordinates are
+# stored as 32-bit integers with centimetre precision (the precision of the UK LiDAR data)
+COMPACT_LIDAR_SCHEMA = {
+    'dimensions': ['X', 'Y', 'Z', 'Intensity', 'Classification', 'ScanAngleRank'],
+    'scale': [0.01, 0.01, 0.01],
+    'offset': [0, 0, 0]
+}
+# lower and upper limit of the number of points per patch for density-aware patch sizing
+PATCH_CAPACITY_LIMITS = (50, 2000)
 
 
 def load_geojson_footprints_into_database(DIR_BUILDING_FOOTPRINTS, DB_TABLE_NAME_FOOTRPINTS, engine, STANDARD_CRS):
@@ -48,65 +66,403 @@ def load_geojson_footprints_into_database(DIR_BUILDING_FOOTPRINTS, DB_TABLE_NAME
 
 
 # Load point cloud data into database
-def load_laz_pointcloud_into_database(DIR_LAS_FILES, DB_TABLE_NAME_LIDAR):
-    # get files in directory
+def load_laz_pointcloud_into_database(DIR_LAS_FILES, DB_TABLE_NAME_LIDAR, num_workers: int = 1,
+                                      aoi_footprints: gpd.GeoDataFrame = None, ingestion_schema: dict = None,
+                                      patch_capacity=400, target_patch_area_m2: float = 25.0):
+    # Tiles are tracked in an ingestion manifest per lidar table, which stores file hash, header bounds,
+    # point count, patch count and import status of every tile. Only new, changed, failed or interrupted tiles
+    # and tiles with changed ingestion settings are imported. Every tile is written to a staging table first and then
+    # moved into the lidar table in a single transaction, which also replaces previously imported patches of the tile.
+    # If aoi_footprints (buffered building footprints) are given, only points within those footprints are imported.
+    # If an ingestion_schema (see COMPACT_LIDAR_SCHEMA) is given, only its dimensions are stored, with X, Y, Z
+    # encoded as integers with the given scale and offset. Otherwise all dimensions of the source tiles are stored.
+    # patch_capacity is the number of points per patch. If it is 'auto', the capacity is chosen per tile from the
+    # tile's point density, so that a patch covers about target_patch_area_m2.
     files_uk_lidar = os.listdir(DIR_LAS_FILES)
+    laz_files = sorted([file for file in files_uk_lidar if file[-4:] == ".laz"])
+
+    manifest = _load_ingestion_manifest(DIR_LAS_FILES, DB_TABLE_NAME_LIDAR)
+    tile_settings = {laz_file: _tile_ingestion_settings(DIR_LAS_FILES, laz_file, aoi_footprints, ingestion_schema,
+                                                        patch_capacity, target_patch_area_m2)
+                     for laz_file in laz_files}
+    import_laz_files = [laz_file for laz_file in laz_files
+                        if _tile_requires_import(DIR_LAS_FILES, laz_file, files_uk_lidar, manifest,
+                                                 tile_settings[laz_file])]
+    num_files = len(import_laz_files)
+    print('Importing pointcloud data from laz to database. %s of %s laz files are new, changed or incomplete. '
+          'This process can take several minutes' % (num_files, len(laz_files)))
+    if num_files == 0:
+        _save_ingestion_manifest(DIR_LAS_FILES, DB_TABLE_NAME_LIDAR, manifest)
+        return []
+
+    # mark tiles as loading, so that an interrupted import is detected in the next run
+    for import_laz_file in import_laz_files:
+        manifest[import_laz_file]['status'] = 'loading'
+        manifest[import_laz_file]['settings_sha256'] = _settings_sha256(tile_settings[import_laz_file])
+    _save_ingestion_manifest(DIR_LAS_FILES, DB_TABLE_NAME_LIDAR, manifest)
+    lidar_table_exists = _prepare_lidar_table(DB_TABLE_NAME_LIDAR)
+
+    # import LAZ files. The first imported tile creates the lidar table with its point cloud schema, so tiles are
+    # imported one by one until the lidar table exists (a failed tile or a tile without points does not create it).
+    # The remaining tiles are then imported in num_workers worker processes
+    tile_results = []
+    for import_laz_file in import_laz_files:
+        if num_workers > 1 and lidar_table_exists:
+            break
+        tile_results.append(_load_laz_tile_into_database(DIR_LAS_FILES, import_laz_file, DB_TABLE_NAME_LIDAR,
+                                                         tile_settings[import_laz_file]))
+        _record_tile_import(DIR_LAS_FILES, DB_TABLE_NAME_LIDAR, manifest, tile_results[-1], len(tile_results),
+                            num_files)
+        if num_workers > 1:
+            lidar_table_exists = _lidar_table_exists(DB_TABLE_NAME_LIDAR)
+    if len(tile_results) < num_files:
+        for tile_result in _load_laz_tiles_in_worker_pool(
+                DIR_LAS_FILES, import_laz_files[len(tile_results):], DB_TABLE_NAME_LIDAR, tile_settings, num_workers):
+            tile_results.append(tile_result)
+            _record_tile_import(DIR_LAS_FILES, DB_TABLE_NAME_LIDAR, manifest, tile_results[-1], len(tile_results),
+                                num_files)
+
+    failed_laz_files = [tile_result for tile_result in tile_results if not tile_result['success']]
+    if len(failed_laz_files) > 0:
+        print('Importing failed for %s of %s laz files:' % (len(failed_laz_files), num_files))
+        for tile_result in failed_laz_files:
+            print('  %s: %s' % (tile_result['file'], tile_result['error']))
+    print('Importing data into database finished')
 
-    laz_files = [file for file in files_uk_lidar if file[-4:] == ".laz"]
-    las_files = [file for file in files_uk_lidar if file[-4:] == ".las"]
-
-    laz_file_list = [laz_file for laz_file in laz_files if not laz_file[:-4] + '.las' in las_files]
-
-    import_laz_files = laz_file_list
+    return tile_results
+
+
+def _load_laz_tiles_in_worker_pool(DIR_LAS_FILES, import_laz_files, DB_TABLE_NAME_LIDAR, tile_settings, num_workers):
+    # yields the results of the tiles imported in num_workers worker processes. At most num_workers tiles are submitted
+    # at a time. If a worker process dies (e.g. a segfault in PDAL or killed when out of memory), the pool breaks and
+    # all running tiles are lost. They are imported again one by one in a separate process, so that only the tile
+    # which kills its worker is marked as failed, and the remaining tiles are imported in a new pool
+    pending_laz_files = list(import_laz_files)
+    while len(pending_laz_files) > 0:
+        broken_laz_files = []
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            running_futures = {}
+            while len(broken_laz_files) == 0 and (len(pending_laz_files) > 0 or len(running_futures) > 0):
+                while len(pending_laz_files) > 0 and len(running_futures) < num_workers:
+                    import_laz_file = pending_laz_files.pop(0)
+                    future = executor.submit(_load_laz_tile_into_database, DIR_LAS_FILES, import_laz_file,
+                                             DB_TABLE_NAME_LIDAR, tile_settings[import_laz_file])
+                    running_futures[future] = import_laz_file
+                done_futures, _ = wait(running_futures, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    import_laz_file = running_futures.pop(future)
+                    try:
+                        yield future.result()
+                    except BrokenProcessPool:
+                        broken_laz_files.append(import_laz_file)
+            # the other running tiles of a broken pool fail as well
+            broken_laz_files += list(running_futures.values())
+
+        for import_laz_file in broken_laz_files:
+            start_time = time.time()
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(_load_laz_tile_into_database, DIR_LAS_FILES, import_laz_file,
+                                         DB_TABLE_NAME_LIDAR, tile_settings[import_laz_file])
+                try:
+                    tile_result = future.result()
+                except BrokenProcessPool as e:
+                    tile_result = {'file': import_laz_file, 'success': False,
+                                   'error': 'worker process terminated abruptly (%r)' % e,
+                                   'duration_s': time.time() - start_time}
+            yield tile_result
+    return
 
-    # unzip LAZ files, if corresponding LAS file does not exist
-    print('Importing pointcloud data from laz to database. This process can take several minutes')
-    for i, import_laz_file in enumerate(import_laz_files):
-        print('unpacking laz file %s of %s: %s' % (str(i + 1), str(len(import_laz_files)), import_laz_file))
-        # unzip laz to las (not necessary anymore - LAZ is directly imported to db)
-        in_laz = os.path.join(DIR_LAS_FILES, import_laz_file)
-        out_las = os.path.join(DIR_LAS_FILES, import_laz_file[:-4] + '.las')
-        las = laspy.read(in_laz)
-        las = laspy.convert(las)
-        las.write(out_las)
 
-        # load las files into database
-        las_to_db_pipeline = {
-            "pipeline": [
+def _tile_ingestion_settings(DIR_LAS_FILES, laz_file, aoi_footprints, ingestion_schema, patch_capacity,
+                             target_patch_area_m2):
+    # collects all settings which change the patches created from a tile
+    settings = {'crop_polygon_wkt': None, 'schema': ingestion_schema, 'patch_capacity': patch_capacity}
+    if aoi_footprints is None and patch_capacity != 'auto':
+        return settings
+    header_info = read_las_header_info(os.path.join(DIR_LAS_FILES, laz_file))
+    min_x, min_y, min_z, max_x, max_y, max_z = header_info['bounds']
+    if patch_capacity == 'auto':
+        settings['patch_capacity'] = density_aware_patch_capacity(
+            header_info['point_count'], (max_x - min_x) * (max_y - min_y), target_patch_area_m2)
+    if aoi_footprints is not None:
+        # union of all buffered footprints intersecting the tile. An empty polygon means no points are imported
+        tile_box = shapely.geometry.box(min_x, min_y, max_x, max_y)
+        candidate_idx = list(aoi_footprints.sindex.intersection(tile_box.bounds))
+        crop_polygon = shapely.ops.unary_union(list(aoi_footprints.geometry.iloc[sorted(candidate_idx)]))
+        settings['crop_polygon_wkt'] = '' if crop_polygon.is_empty else crop_polygon.wkt
+    return settings
+
+
+def density_aware_patch_capacity(point_count: int, tile_area_m2: float, target_patch_area_m2: float):
+    # number of points per patch, so that a patch covers about the target area at the tile's point density
+    point_density = point_count / max(tile_area_m2, 1.0)
+    patch_capacity = int(np.clip(np.round(point_density * target_patch_area_m2), *PATCH_CAPACITY_LIMITS))
+    return patch_capacity
+
+
+def _settings_sha256(settings):
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def _tile_requires_import(DIR_LAS_FILES, laz_file, files_uk_lidar, manifest, settings):
+    # decides if a tile has to be imported and adds new tiles to the manifest.
+    # Unchanged tiles are recognized by file size and modification time, the file hash is only calculated
+    # if those differ from the manifest entry.
+    file_stat = os.stat(os.path.join(DIR_LAS_FILES, laz_file))
+    manifest_entry = manifest.get(laz_file)
+    if manifest_entry is None:
+        manifest_entry = {'file_size': file_stat.st_size, 'file_mtime': file_stat.st_mtime, 'sha256': None,
+                          'bounds': None, 'point_count': None, 'patch_count': None, 'status': 'new'}
+        manifest[laz_file] = manifest_entry
+        # tiles imported by earlier versions of this function were unpacked to las files or listed in
+        # imported_laz_files.txt. Their patches are not linked to the tile, so they can not be replaced.
+        if laz_file[:-4] + '.las' in files_uk_lidar or laz_file in _read_imported_laz_files(DIR_LAS_FILES):
+            manifest_entry['status'] = 'legacy'
+            return False
+        return True
+    if manifest_entry['status'] not in ['loaded', 'legacy']:
+        return True
+    if manifest_entry['status'] == 'loaded' and manifest_entry.get('settings_sha256') != _settings_sha256(settings):
+        return True
+    if manifest_entry['file_size'] == file_stat.st_size and manifest_entry['file_mtime'] == file_stat.st_mtime:
+        return False
+    file_hash = file_sha256(os.path.join(DIR_LAS_FILES, laz_file))
+    manifest_entry['file_size'] = file_stat.st_size
+    manifest_entry['file_mtime'] = file_stat.st_mtime
+    if file_hash == manifest_entry['sha256']:
+        return False
+    if manifest_entry['status'] == 'legacy':
+        print('WARNING: legacy tile %s changed. Its old patches are not replaced and need to be removed by hand'
+              % laz_file)
+    return True
+
+
+def _load_laz_tile_into_database(DIR_LAS_FILES, import_laz_file, DB_TABLE_NAME_LIDAR, settings):
+    # imports a single tile. Errors are caught and returned, so that one broken tile does not stop
+    # the import of all other tiles
+    start_time = time.time()
+    in_laz = os.path.join(DIR_LAS_FILES, import_laz_file)
+    tile_result = {'file': import_laz_file, 'success': False, 'error': None}
+    try:
+        file_stat = os.stat(in_laz)
+        tile_result.update({'file_size': file_stat.st_size, 'file_mtime': file_stat.st_mtime,
+                            'sha256': file_sha256(in_laz)})
+        header_info = read_las_header_info(in_laz)
+        tile_result.update({'bounds': header_info['bounds'], 'point_count': header_info['point_count']})
+
+        if settings['crop_polygon_wkt'] == '':
+            # no footprint intersects the tile, only previously imported patches of the tile are removed
+            table_name_staging = None
+            tile_result['point_count_imported'] = 0
+        else:
+            # load laz file into a staging table. The las reader decompresses the laz file while streaming it into
+            # the pipeline, so no uncompressed copy of the tile is written to disk
+            table_name_staging = _staging_table_name(DB_TABLE_NAME_LIDAR, import_laz_file)
+            pipeline_stages = [
                 {
                     "type": "readers.las",
-                    "filename": out_las,
+                    "filename": in_laz,
                     "spatialreference": "EPSG:27700"
-                },
+                }
+            ]
+            if settings['crop_polygon_wkt'] is not None:
+                # drop points outside of the buffered footprints before patches are created
+                pipeline_stages.append(
+                    {
+                        "type": "filters.crop",
+                        "polygon": settings['crop_polygon_wkt']
+                    }
+                )
+            writer_stage = {
+                "type": "writers.pgpointcloud",
+                "connection": "host='%s' dbname='%s' user='%s' password='%s' port='%s'" %
+                              (config.POSTGRES_HOST, config.POSTGRES_DATABASE,
+                               config.POSTGRES_USER, config.POSTGRES_PASSWORD,
+                               config.POSTGRES_PORT),
+                "schema": "public",
+                "table": table_name_staging,
+                "compression": "dimensional",
+                "srid": "27700",
+                "overwrite": "true"
+            }
+            if settings['schema'] is not None:
+                # keep only selected dimensions and store X, Y, Z as scaled integers
+                writer_stage["output_dims"] = ','.join(settings['schema']['dimensions'])
+                for i, axis in enumerate(['x', 'y', 'z']):
+                    writer_stage["scale_%s" % axis] = settings['schema']['scale'][i]
+                    writer_stage["offset_%s" % axis] = settings['schema']['offset'][i]
+            pipeline_stages += [
                 {
                     "type": "filters.chipper",
-                    "capacity": 400
+                    "capacity": settings['patch_capacity']
                 },
-                {
-                    "type": "writers.pgpointcloud",
-                    "connection": "host='%s' dbname='%s' user='%s' password='%s' port='%s'" %
-                                  (config.POSTGRES_HOST, config.POSTGRES_DATABASE,
-                                   config.POSTGRES_USER, config.POSTGRES_PASSWORD,
-                                   config.POSTGRES_PORT),
-                    "schema": "public",
-                    "table": DB_TABLE_NAME_LIDAR,
-                    "compression": "dimensional",
-                    "srid": "27700",
-                    "overwrite": "false"
-                }
+                writer_stage
             ]
-        }
+            pipeline = pdal.Pipeline(json.dumps({"pipeline": pipeline_stages}))
+            tile_result['point_count_imported'] = pipeline.execute()
 
-        print('importing laz file %s of %s into database: %s' % (
-            str(i + 1), str(len(import_laz_files)), str(import_laz_file)))
-        pipeline = pdal.Pipeline(json.dumps(las_to_db_pipeline))
-        pipeline.execute()
+        # replace the patches of this tile in the lidar table within one transaction
+        tile_result['patch_count'] = _move_staging_patches_into_lidar_table(
+            table_name_staging, DB_TABLE_NAME_LIDAR, import_laz_file)
+        tile_result['success'] = True
+    except Exception as e:
+        tile_result['error'] = repr(e)
+    tile_result['duration_s'] = time.time() - start_time
+    return tile_result
 
-    print('Importing data into database finished')
 
+def _staging_table_name(DB_TABLE_NAME_LIDAR, laz_file):
+    return '%s_staging_%s' % (DB_TABLE_NAME_LIDAR, hashlib.md5(laz_file.encode()).hexdigest()[:12])
+
+
+def _prepare_lidar_table(DB_TABLE_NAME_LIDAR):
+    # lidar tables created by earlier versions of this function have no tile_name column.
+    # Returns if the lidar table exists
+    connection_psycopg2 = psycopg2.connect(config.DATABASE_URL)
+    cursor = connection_psycopg2.cursor()
+    cursor.execute("select to_regclass('public.\"%s\"') is not null" % DB_TABLE_NAME_LIDAR)
+    lidar_table_exists = cursor.fetchall()[0][0]
+    if lidar_table_exists:
+        cursor.execute('alter table "%s" add column if not exists tile_name text' % DB_TABLE_NAME_LIDAR)
+        cursor.execute('create index if not exists "%s_tile_name_idx" on "%s" (tile_name)'
+                       % (DB_TABLE_NAME_LIDAR, DB_TABLE_NAME_LIDAR))
+    connection_psycopg2.commit()
+    connection_psycopg2.close()
+    return lidar_table_exists
+
+
+def _lidar_table_exists(DB_TABLE_NAME_LIDAR):
+    connection_psycopg2 = psycopg2.connect(config.DATABASE_URL)
+    cursor = connection_psycopg2.cursor()
+    cursor.execute("select to_regclass('public.\"%s\"') is not null" % DB_TABLE_NAME_LIDAR)
+    lidar_table_exists = cursor.fetchall()[0][0]
+    connection_psycopg2.close()
+    return lidar_table_exists
+
+
+def _move_staging_patches_into_lidar_table(table_name_staging, DB_TABLE_NAME_LIDAR, laz_file):
+    connection_psycopg2 = psycopg2.connect(config.DATABASE_URL)
+    cursor = connection_psycopg2.cursor()
+    try:
+        cursor.execute("select to_regclass('public.\"%s\"') is not null" % DB_TABLE_NAME_LIDAR)
+        lidar_table_exists = cursor.fetchall()[0][0]
+        if table_name_staging is None:
+            # tile without points to import
+            if lidar_table_exists:
+                cursor.execute('delete from "%s" where tile_name = %%s' % DB_TABLE_NAME_LIDAR, (laz_file,))
+            connection_psycopg2.commit()
+            return 0
+        cursor.execute(
+            """select pcid from pointcloud_columns where "schema" = 'public' and "table" = '%s'"""
+            % table_name_staging)
+        pcid = cursor.fetchall()[0][0]
+        if not lidar_table_exists:
+            # the lidar table is created by one writer only, the lock is held until the end of the transaction.
+            # Other writers wait for it and then check the point cloud schema of the created table
+            cursor.execute('select pg_advisory_xact_lock(hashtext(%s))', (DB_TABLE_NAME_LIDAR,))
+            cursor.execute("select to_regclass('public.\"%s\"') is not null" % DB_TABLE_NAME_LIDAR)
+            lidar_table_exists = cursor.fetchall()[0][0]
+        if lidar_table_exists:
+            # patches of different point cloud schemas can not be stored in the same lidar table
+            cursor.execute(
+                """select pcid from pointcloud_columns where "schema" = 'public' and "table" = '%s'"""
+                % DB_TABLE_NAME_LIDAR)
+            pcid_lidar_table = cursor.fetchall()[0][0]
+            if pcid_lidar_table != pcid:
+                raise ValueError('point cloud schema of tile (pcid %s) differs from lidar table %s (pcid %s). '
+                                 'Use a new lidar table for a different ingestion schema'
+                                 % (pcid, DB_TABLE_NAME_LIDAR, pcid_lidar_table))
+        else:
+            # create lidar table with the point cloud schema of the staging table
+            cursor.execute('create table if not exists "%s" (id serial primary key, pa pcpatch(%s), tile_name text)'
+                           % (DB_TABLE_NAME_LIDAR, pcid))
+            cursor.execute('create index if not exists "%s_tile_name_idx" on "%s" (tile_name)'
+                           % (DB_TABLE_NAME_LIDAR, DB_TABLE_NAME_LIDAR))
+        cursor.execute('delete from "%s" where tile_name = %%s' % DB_TABLE_NAME_LIDAR, (laz_file,))
+        cursor.execute('insert into "%s" (pa, tile_name) select pa, %%s from "%s"'
+                       % (DB_TABLE_NAME_LIDAR, table_name_staging), (laz_file,))
+        patch_count = cursor.rowcount
+        cursor.execute('drop table "%s"' % table_name_staging)
+        connection_psycopg2.commit()
+    finally:
+        connection_psycopg2.close()
+    return patch_count
+
+
+def _load_ingestion_manifest(DIR_LAS_FILES, DB_TABLE_NAME_LIDAR):
+    file_path = os.path.join(DIR_LAS_FILES, 'ingestion_manifest_%s.json' % DB_TABLE_NAME_LIDAR)
+    if not os.path.isfile(file_path):
+        return {}
+    with open(file_path, 'r') as f:
+        manifest = json.load(f)
+    return manifest
+
+
+def _save_ingestion_manifest(DIR_LAS_FILES, DB_TABLE_NAME_LIDAR, manifest):
+    # write to a temporary file first, so that an interruption never leaves a truncated manifest
+    file_path = os.path.join(DIR_LAS_FILES, 'ingestion_manifest_%s.json' % DB_TABLE_NAME_LIDAR)
+    with atomic_output_path(file_path) as tmp_file_path:
+        with open(tmp_file_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+    return
+
+
+def _read_imported_laz_files(DIR_LAS_FILES):
+    # returns the names of all laz files, which were listed as imported by earlier versions of this function
+    file_path = os.path.join(DIR_LAS_FILES, 'imported_laz_files.txt')
+    if not os.path.isfile(file_path):
+        return []
+    with open(file_path, 'r') as f:
+        imported_laz_files = [line.strip() for line in f if line.strip() != '']
+    return imported_laz_files
+
+
+def _record_tile_import(DIR_LAS_FILES, DB_TABLE_NAME_LIDAR, manifest, tile_result, num_processed, num_files):
+    # print progress and save the tile result in the manifest
+    status = 'imported' if tile_result['success'] else 'FAILED'
+    print('%s laz file %s of %s into database: %s (%.1f s)' % (
+        status, str(num_processed), str(num_files), tile_result['file'], tile_result['duration_s']))
+    manifest_entry = manifest[tile_result['file']]
+    for key in ['file_size', 'file_mtime', 'sha256', 'bounds', 'point_count', 'point_count_imported', 'patch_count']:
+        if key in tile_result:
+            manifest_entry[key] = tile_result[key]
+    manifest_entry['status'] = 'loaded' if tile_result['success'] else 'failed'
+    _save_ingestion_manifest(DIR_LAS_FILES, DB_TABLE_NAME_LIDAR, manifest)
     return
 
 
+def pointcloud_table_storage_report(db_connection_url: str, table_name: str):
+    # summarizes how many bytes are used per point in a point cloud table
+    sql_query_storage = (
+            """
+            select 
+                count(*) num_patches,
+                sum(pc_numpoints(pa)) num_points, 
+                sum(pc_memsize(pa)) patch_bytes,
+                pg_total_relation_size('"%s"') table_bytes
+            from "%s"
+            """ % (table_name, table_name)
+    )
+    connection_psycopg2 = psycopg2.connect(db_connection_url)
+    cursor = connection_psycopg2.cursor()
+    cursor.execute(sql_query_storage)
+    num_patches, num_points, patch_bytes, table_bytes = cursor.fetchall()[0]
+    connection_psycopg2.close()
+
+    storage_report = {
+        'num_patches': int(num_patches),
+        'num_points': int(num_points or 0),
+        'patch_bytes': int(patch_bytes or 0),
+        'table_bytes': int(table_bytes),
+        'patch_bytes_per_point': float(patch_bytes or 0) / max(float(num_points or 0), 1),
+        'table_bytes_per_point': float(table_bytes) / max(float(num_points or 0), 1)
+    }
+    print('table %s: %s points in %s patches, %.2f bytes per point in patches, %.2f bytes per point in table' % (
+        table_name, storage_report['num_points'], storage_report['num_patches'],
+        storage_report['patch_bytes_per_point'], storage_report['table_bytes_per_point']))
+    return storage_report
+
+
 def add_geoindex_to_databases(db_connection_url: str, db_table_name_list: list, db_is_pointcloud_table_list: list):
     # Add geoindex to tables while treating lidar tables differently than 2D geom tables
     # Use psycopg2 for the sql query, because the VACUUM function does not work with sqlalchemy
@@ -156,78 +512,70 @@ def add_geoindex_to_databases(db_connection_url: str, db_table_name_list: list,
     return
 
 
-def crop_and_fetch_pointclouds_per_building(FP_NUM_START, FP_NUM_END, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS,
-                                            NUMBER_OF_FOOTPRINTS, POINT_COUNT_THRESHOLD, TABLE_NAME_UPRN,
-                                            TABLE_NAME_EPC, TABLE_NAME_LIDAR, engine):
-    # Fetch cropped point clouds from database
-
-    # Query to fetch points within building footprints as multipoint grouped by building.
-    # IMPORTANT: query with geopandas requires a geom column in database to create a GeoDataFrame
+def _building_pointcloud_queries(FP_NUM_START, FP_NUM_END, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS,
+                                 NUMBER_OF_FOOTPRINTS, POINT_COUNT_THRESHOLD, TABLE_NAME_UPRN, TABLE_NAME_EPC,
+                                 TABLE_NAME_LIDAR, fetch_mode, TABLE_NAME_LINKS):
+    # returns the queries of the point clouds per building, the footprint - uprn - epc links and the points per chunk
+    # (see crop_and_fetch_pointclouds_per_building)
 
     # SQL Query explanation:
     # with footprints: defines chunk of footprints from footprint table
     # with fp_buffer: adds a buffer to footprints
-    # with fp_uprn: adds uprn to footprints by geographically intersecting uprn points with footprint polygons
-    # with epc: selects epc data of local authority distric
-    # with fp_upern_epc: adds epc information to the footprint based on equal uprn
-    # with patch_unions: crops the point clouds and creates a pointcloud union per building
+    # with patch_unions: crops the point clouds and creates a pointcloud union per building.
+    #   Patches whose envelope lies within the buffered footprint are used as a whole without testing every point,
+    #   only patches on the footprint boundary are cropped point by point
     # with building_pc: extracts the pointcloud information from point cloud union
     #   and transforms union into multi points, grouped per building
-    # with building_pc_fp: adds footprints data to point cloud and filters out buildings with less points than threshold
-    # with building_pc_fp_epc: selects epc information and adds epc information to point cloud
-
-    # select * : selects all distinct point clouds. fetched information includes:
-    #         id_uprn_epc id_query, : a query id to differentiate between footprints with multiple uprn
-    #         id_fp, : distinct footprint id
-    #         uprn, : unique property reference number used to link footprints with epc data
-    #         "LMK_KEY" id_epc_lmk_key, : id of epc database entry
-    #         geom_fp, : geometry of footprint (polygon)
-    #         geom_uprn, : geometry of uprn (point)
-    #         geom_pc geom, : geometry of point cloud (multipoint)
-    #         delta_x, : difference between largest and smallest x value of point cloud
-    #         delta_y, : difference between largest and smallest y value of point cloud
-    #         delta_z, : difference between largest and smallest z value of point cloud
-    #         z_min, : smallest z value of point cloud
-    #         scaling_factor, : scaling factor - largest delta_x/y/z value, could be used to normalize all buildings
-    #         num_p_in_pc, : number of points per point cloud
-    #         "CURRENT_ENERGY_RATING" energy_rating, : epc rating of building, from epc database
-    #         "CURRENT_ENERGY_EFFICIENCY" energy_efficiency : epc efficiency value, from epc database
+    # select: adds footprints data to point cloud and filters out buildings with less points than threshold
+    # Link query:
+    # with fp_uprn: adds uprn to footprints by geographically intersecting uprn points with footprint polygons
+    # with epc: selects epc data of local authority distric
+    # select: adds epc information to the footprint based on equal uprn
+    # If TABLE_NAME_LINKS is given, the links are read from the link table of the area of interest instead
+    # (see create_footprint_links_table), so that uprn and epc data are matched only once per area of interest
 
     # query is dynamically adapted by the number of requested footprints (num_footprints) as well as the sample size
     # of the point clouds (POINT_COUNT_THRESHOLD)
 
-    sql_query_grouped_points = (
+    if fetch_mode == 'multipoint':
+        sql_building_pc_points = "st_union(geom) geom_pc,"
+        sql_explode = "pc_explode(pau) p, pc_explode(pau)::geometry geom"
+        sql_num_points = "st_numgeometries(geom_pc)"
+    elif fetch_mode == 'packed':
+        # point count before removing duplicates, the threshold is checked again on the client
+        sql_building_pc_points = (
+            "string_agg(float8send(pc_get(p, 'X')::float8) || float8send(pc_get(p, 'Y')::float8) || "
+            "float8send(pc_get(p, 'Z')::float8), ''::bytea) geom_pc, count(*) num_p_raw,"
+        )
+        sql_explode = "pc_explode(pau) p"
+        sql_num_points = "num_p_raw"
+    elif fetch_mode == 'chunk_patches':
+        # points are cropped per footprint on the client, the query per footprint is not used
+        sql_building_pc_points = sql_explode = sql_num_points = None
+    else:
+        raise ValueError('unknown fetch_mode %s' % fetch_mode)
+
+    sql_footprints = (
             """
-            -- select area of interest boundary 
             with footprints as (
                 select geom_fp, id_fp
                 from "%s" aoi
                 where aoi.id_fp_chunks > %s and aoi.id_fp_chunks <= %s
                 limit %s
-            ),
+            )""" % (AREA_OF_INTEREST_CODE, FP_NUM_START, FP_NUM_END, NUMBER_OF_FOOTPRINTS)
+    )
+
+    sql_query_grouped_points = sql_footprints + (
+            """,
             fp_buffer as (
                 select id_fp, st_buffer(fps.geom_fp, %s) geom_fp
                 from footprints fps
             ),
-            fp_uprn as (
-                select fps.id_fp, fps.geom_fp, u.uprn, (u.geom) geom_uprn
-                from footprints fps 
-                left join %s u 
-                on st_intersects(fps.geom_fp, u.geom)
-            ),
-            epc as (
-                select *
-                from %s e
-                where "LOCAL_AUTHORITY" = '%s'
-            ),
-            fp_uprn_epc as (
-                select row_number() over (order by fpu.id_fp) as id_uprn_epc, *
-                from fp_uprn fpu
-                left join epc e
-                on fpu.uprn=e."UPRN" 
-            ),
             patch_unions as (
-                select fpb.id_fp, pc_union(pc_intersection(pa, fpb.geom_fp)) pau
+                select fpb.id_fp, pc_union(
+                    case when st_within(pc_envelopegeometry(pa), fpb.geom_fp) then pa 
+                    else pc_intersection(pa, fpb.geom_fp) end
+                ) pau
                 from %s lp
                 inner join fp_buffer fpb on pc_intersects(lp.pa, fpb.geom_fp) 
                 group by fpb.id_fp 
@@ -235,73 +583,312 @@ def crop_and_fetch_pointclouds_per_building(FP_NUM_START, FP_NUM_END, AREA_OF_IN
             building_pc as (
                 select 
                     id_fp, 
-                    st_union(geom) geom_pc,
+                    %s
                     max(pc_get(p, 'X')) - min(pc_get(p, 'X')) delta_x,
                     max(pc_get(p, 'Y')) - min(pc_get(p, 'Y')) delta_y,
                     max(pc_get(p, 'Z')) - min(pc_get(p, 'Z')) delta_z,
                     min(pc_get(p, 'Z')) z_min
                 from (
-                    select id_fp, pc_explode(pau) p, pc_explode(pau)::geometry geom
+                    select id_fp, %s
                         from patch_unions
                     ) po
                     group by id_fp 
+            )
+            select 
+                bpc.id_fp,
+                fps.geom_fp,
+                bpc.geom_pc geom,
+                bpc.delta_x,
+                bpc.delta_y,
+                bpc.delta_z,
+                bpc.z_min,
+                greatest(bpc.delta_x, bpc.delta_y, bpc.delta_z) scaling_factor,
+                %s num_p_in_pc
+            from building_pc bpc
+            left join footprints fps on bpc.id_fp = fps.id_fp 
+            where %s > %s
+            """ % (BUILDING_BUFFER_METERS, TABLE_NAME_LIDAR, sql_building_pc_points, sql_explode, sql_num_points,
+                   sql_num_points, POINT_COUNT_THRESHOLD)
+    )
+
+    sql_query_links = sql_footprints + (
+            """,
+            fp_uprn as (
+                select fps.id_fp, fps.geom_fp, u.uprn, (u.geom) geom_uprn
+                from footprints fps 
+                left join %s u 
+                on st_intersects(fps.geom_fp, u.geom)
             ),
-            building_pc_fp as (
-                select 
-                    bpc.id_fp id_fp_bpc,
-                    bpc.geom_pc,
-                    fps.geom_fp geom_fp_bpc,
-                    bpc.delta_x,
-                    bpc.delta_y,
-                    bpc.delta_z,
-                    bpc.z_min,
-                    greatest(bpc.delta_x, bpc.delta_y, bpc.delta_z) scaling_factor,
-                    st_numgeometries(geom_pc) num_p_in_pc
-                from building_pc bpc
-                left join footprints fps on bpc.id_fp = fps.id_fp 
-                where st_numgeometries(geom_pc) > %s
-            ),
-            building_pc_fp_epc as (
-                select 
-                    id_uprn_epc id_query,
-                    id_fp,
-                    uprn,
-                    "LMK_KEY" id_epc_lmk_key,
-                    geom_fp,
-                    geom_uprn,
-                    geom_pc geom,
-                    delta_x,
-                    delta_y,
-                    delta_z,
-                    z_min,
-                    scaling_factor,
-                    num_p_in_pc,
-                    "CURRENT_ENERGY_RATING" energy_rating,		
-                    "CURRENT_ENERGY_EFFICIENCY" energy_efficiency
-                from fp_uprn_epc fps
-                left join building_pc_fp bpf 
-                on fps.id_fp = bpf.id_fp_bpc
+            epc as (
+                select "UPRN", "LMK_KEY", "CURRENT_ENERGY_RATING", "CURRENT_ENERGY_EFFICIENCY"
+                from %s e
+                where "LOCAL_AUTHORITY" = '%s'
             )
-            select distinct *
-            from building_pc_fp_epc
+            select 
+                row_number() over (order by fpu.id_fp) id_query,
+                fpu.id_fp,
+                fpu.uprn,
+                e."LMK_KEY" id_epc_lmk_key,
+                fpu.geom_fp,
+                fpu.geom_uprn,
+                e."CURRENT_ENERGY_RATING" energy_rating,
+                e."CURRENT_ENERGY_EFFICIENCY" energy_efficiency
+            from fp_uprn fpu
+            left join epc e
+            on fpu.uprn=e."UPRN" 
+            """ % (TABLE_NAME_UPRN, TABLE_NAME_EPC, AREA_OF_INTEREST_CODE)
+    )
+    if TABLE_NAME_LINKS is not None:
+        sql_query_links = (
+                """
+                select id_query, id_fp, uprn, id_epc_lmk_key, geom_fp, geom_uprn, energy_rating, energy_efficiency
+                from "%s" l
+                where l.id_fp_chunks > %s and l.id_fp_chunks <= %s
+                """ % (TABLE_NAME_LINKS, FP_NUM_START, FP_NUM_END)
+        )
 
-            """ % (AREA_OF_INTEREST_CODE, FP_NUM_START, FP_NUM_END, NUMBER_OF_FOOTPRINTS, BUILDING_BUFFER_METERS,
-                   TABLE_NAME_UPRN, TABLE_NAME_EPC, AREA_OF_INTEREST_CODE, TABLE_NAME_LIDAR, POINT_COUNT_THRESHOLD)
+    sql_query_chunk_points = sql_footprints + (
+            """,
+            chunk_area as (
+                select st_union(st_buffer(fps.geom_fp, %s)) geom
+                from footprints fps
+            )
+            select string_agg(
+                float8send(pc_get(p, 'X')::float8) || float8send(pc_get(p, 'Y')::float8) || 
+                float8send(pc_get(p, 'Z')::float8), ''::bytea) geom_pc
+            from (
+                select lp.id, pc_explode(
+                    case when st_within(pc_envelopegeometry(lp.pa), ca.geom) then lp.pa 
+                    else pc_intersection(lp.pa, ca.geom) end
+                ) p
+                from %s lp
+                inner join chunk_area ca on pc_intersects(lp.pa, ca.geom)
+            ) po
+            group by id
+            """ % (BUILDING_BUFFER_METERS, TABLE_NAME_LIDAR)
     )
 
-    # actual fetching step
-    gdf = gpd.GeoDataFrame.from_postgis(sql_query_grouped_points, engine)
+    return sql_query_grouped_points, sql_query_links, sql_query_chunk_points
+
+
+def crop_and_fetch_pointclouds_per_building(FP_NUM_START, FP_NUM_END, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS,
+                                            NUMBER_OF_FOOTPRINTS, POINT_COUNT_THRESHOLD, TABLE_NAME_UPRN,
+                                            TABLE_NAME_EPC, TABLE_NAME_LIDAR, engine, fetch_mode: str = 'multipoint',
+                                            TABLE_NAME_LINKS: str = None):
+    # Fetch cropped point clouds from database
+
+    # Results are returned as two GeoDataFrames:
+    # gdf_pc: one row per footprint with a point cloud, fetched information includes:
+    #         id_fp, : distinct footprint id
+    #         geom_fp, : geometry of footprint (polygon)
+    #         geom, : point cloud (see fetch_mode)
+    #         delta_x, : difference between largest and smallest x value of point cloud
+    #         delta_y, : difference between largest and smallest y value of point cloud
+    #         delta_z, : difference between largest and smallest z value of point cloud
+    #         z_min, : smallest z value of point cloud
+    #         scaling_factor, : scaling factor - largest delta_x/y/z value, could be used to normalize all buildings
+    #         num_p_in_pc, : number of points per point cloud
+    # gdf_links: one row per footprint and linked uprn / epc entry (also footprints without point cloud or uprn):
+    #         id_query, : a query id to differentiate between footprints with multiple uprn
+    #         id_fp, : distinct footprint id
+    #         uprn, : unique property reference number used to link footprints with epc data
+    #         id_epc_lmk_key, : id of epc database entry
+    #         geom_fp, : geometry of footprint (polygon)
+    #         geom_uprn, : geometry of uprn (point)
+    #         energy_rating, : epc rating of building, from epc database
+    #         energy_efficiency : epc efficiency value, from epc database
+    # Point clouds are fetched only once per footprint, even if a footprint is linked to several uprn / epc entries
+
+    # fetch_mode 'multipoint': point clouds are fetched as PostGIS multipoint (geom column contains shapely multipoints)
+    # fetch_mode 'packed': point clouds are fetched as packed binary float64 x, y, z values and decoded with numpy
+    #   (geom column contains numpy arrays of shape (n, 3)). This avoids creating a multipoint with st_union on the
+    #   server and parsing it with shapely on the client. Duplicate points are removed on the client instead.
+    # fetch_mode 'chunk_patches': the points of all patches intersecting the union of the buffered footprints of the
+    #   chunk are fetched once per chunk (packed like 'packed') and assigned to the buildings on the client.
+    #   Every patch is decompressed and transferred only once, even if it intersects several footprints
+    #   (geom column contains numpy arrays of shape (n, 3))
+
+    sql_query_grouped_points, sql_query_links, sql_query_chunk_points = _building_pointcloud_queries(
+        FP_NUM_START, FP_NUM_END, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS, NUMBER_OF_FOOTPRINTS,
+        POINT_COUNT_THRESHOLD, TABLE_NAME_UPRN, TABLE_NAME_EPC, TABLE_NAME_LIDAR, fetch_mode, TABLE_NAME_LINKS
+    )
 
-    # convert geom_fp and geom_uprn column from wkb to shape.
+    # actual fetching step
+    gdf_links = gpd.GeoDataFrame(pd.read_sql(sql_query_links, engine))
+    # convert geometry columns from wkb to shape.
     # those columns are wkb because gpd only loads one geom column from postgis
-    gdf = gdf_geometries_wkb_to_shape(gdf)
+    gdf_links = wkb_columns_to_shape(gdf_links, ['geom_fp', 'geom_uprn'])
+    if fetch_mode == 'multipoint':
+        gdf_pc = gpd.GeoDataFrame.from_postgis(sql_query_grouped_points, engine)
+        gdf_pc = wkb_columns_to_shape(gdf_pc, ['geom_fp'])
+    elif fetch_mode == 'packed':
+        gdf_pc = gpd.GeoDataFrame(pd.read_sql(sql_query_grouped_points, engine))
+        gdf_pc = unpack_packed_pointclouds(gdf_pc, POINT_COUNT_THRESHOLD)
+        gdf_pc = wkb_columns_to_shape(gdf_pc, ['geom_fp'])
+    elif fetch_mode == 'chunk_patches':
+        df_chunk_points = pd.read_sql(sql_query_chunk_points, engine)
+        gdf_pc = crop_chunk_points_per_building(df_chunk_points, gdf_links, BUILDING_BUFFER_METERS,
+                                                POINT_COUNT_THRESHOLD)
+
+    return gdf_pc, gdf_links
+
+
+def stream_pointclouds_per_building(FP_NUM_START, FP_NUM_END, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS,
+                                    NUMBER_OF_FOOTPRINTS, POINT_COUNT_THRESHOLD, TABLE_NAME_UPRN, TABLE_NAME_EPC,
+                                    TABLE_NAME_LIDAR, engine, fetch_mode: str = 'packed',
+                                    TABLE_NAME_LINKS: str = None, fetch_size: int = 50):
+    # Like crop_and_fetch_pointclouds_per_building, but the point clouds are read with a server-side cursor and
+    # returned as a generator of GeoDataFrames of at most fetch_size buildings. Buildings can be processed while the
+    # query is still running and the memory usage depends on fetch_size instead of the chunk size.
+    # Returns the generator of point cloud batches and the footprint - uprn - epc links (fetched at once).
+    # Only for fetch_mode 'multipoint' and 'packed', 'chunk_patches' requires all points of a chunk for cropping
+    if fetch_mode not in ['multipoint', 'packed']:
+        raise ValueError('fetch_mode %s can not be streamed' % fetch_mode)
+    sql_query_grouped_points, sql_query_links, sql_query_chunk_points = _building_pointcloud_queries(
+        FP_NUM_START, FP_NUM_END, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS, NUMBER_OF_FOOTPRINTS,
+        POINT_COUNT_THRESHOLD, TABLE_NAME_UPRN, TABLE_NAME_EPC, TABLE_NAME_LIDAR, fetch_mode, TABLE_NAME_LINKS
+    )
+    gdf_links = gpd.GeoDataFrame(pd.read_sql(sql_query_links, engine))
+    gdf_links = wkb_columns_to_shape(gdf_links, ['geom_fp', 'geom_uprn'])
+
+    def pointcloud_batches():
+        # stream_results makes sqlalchemy use a named (server-side) cursor of psycopg2
+        with engine.connect().execution_options(stream_results=True, max_row_buffer=fetch_size) as con:
+            for df_batch in pd.read_sql(sql_query_grouped_points, con, chunksize=fetch_size):
+                gdf_batch = gpd.GeoDataFrame(df_batch)
+                if fetch_mode == 'multipoint':
+                    gdf_batch = wkb_columns_to_shape(gdf_batch, ['geom', 'geom_fp'])
+                else:
+                    gdf_batch = unpack_packed_pointclouds(gdf_batch, POINT_COUNT_THRESHOLD)
+                    gdf_batch = wkb_columns_to_shape(gdf_batch, ['geom_fp'])
+                yield gdf_batch
 
-    return gdf
+    return pointcloud_batches(), gdf_links
+
+
+def crop_chunk_points_per_building(df_chunk_points, gdf_links, BUILDING_BUFFER_METERS, POINT_COUNT_THRESHOLD):
+    # decodes the packed points of all patches of a chunk and assigns them to the buffered footprints of the chunk
+    packed_points_list = [np.frombuffer(packed_points, dtype='>f8') for packed_points in df_chunk_points.geom_pc]
+    if len(packed_points_list) > 0:
+        xyz = np.concatenate(packed_points_list).reshape(-1, 3).astype(np.float64)
+    else:
+        xyz = np.empty((0, 3))
+    gdf_footprints = gdf_links[['id_fp', 'geom_fp']].drop_duplicates('id_fp')
+    fp_buffer_list = [geom_fp.buffer(BUILDING_BUFFER_METERS) for geom_fp in gdf_footprints.geom_fp]
+    cropped_points_list = crop_points_to_polygons(xyz, fp_buffer_list)
+    df_pc = building_pointcloud_information(list(gdf_footprints.id_fp), cropped_points_list, POINT_COUNT_THRESHOLD,
+                                            as_multipoint=False)
+    df_pc = df_pc.merge(gdf_footprints, on='id_fp', how='left')
+    return gpd.GeoDataFrame(
+        df_pc[['id_fp', 'geom_fp', 'geom', 'delta_x', 'delta_y', 'delta_z', 'z_min', 'scaling_factor', 'num_p_in_pc']])
+
+
+def unpack_packed_pointclouds(gdf, POINT_COUNT_THRESHOLD):
+    # decodes packed big-endian float64 x, y, z values into numpy arrays and removes duplicate points.
+    # Point clouds with too few points after removing duplicates are dismissed like in the multipoint query
+    pointcloud_list = [np.unique(np.frombuffer(packed_points, dtype='>f8').reshape(-1, 3).astype(np.float64), axis=0)
+                       for packed_points in gdf.geom]
+    gdf = gdf.assign(
+        geom=pd.Series(pointcloud_list, index=gdf.index, dtype=object),
+        num_p_in_pc=[len(points) for points in pointcloud_list]
+    )
+    return gdf[gdf.num_p_in_pc > POINT_COUNT_THRESHOLD]
+
+
+def fetch_buffered_aoi_footprints(engine, AREA_OF_INTEREST_CODE: str, BUILDING_BUFFER_METERS: float,
+                                  TABLE_NAME_LOCAL_AUTHORITY_BOUNDARY, TABLE_NAME_FOOTPRINTS):
+    # fetches all footprints in the area of interest, buffered like in the point cloud cropping
+    sql_query_buffered_footprints = (
+            """
+            with area_of_interest as (
+                select st_transform(geom, 27700) geom
+                from %s lab
+                where lab.lad21cd = '%s'
+            )
+            select fps.gid id_fp, st_buffer(fps.geom, %s) geom
+            from %s fps, area_of_interest
+            where st_intersects(fps.geom, area_of_interest.geom)
+            """ % (TABLE_NAME_LOCAL_AUTHORITY_BOUNDARY, AREA_OF_INTEREST_CODE, BUILDING_BUFFER_METERS,
+                   TABLE_NAME_FOOTPRINTS)
+    )
+    gdf_footprints = gpd.GeoDataFrame.from_postgis(sql_query_buffered_footprints, engine)
+    return gdf_footprints
+
+
+def fetch_footprints_in_area_materialized_view(engine, AREA_OF_INTEREST_CODE: str):
+    # fetches the footprints of the materialized view of the area of interest in the order of the chunks
+    sql_query_footprints = (
+            """select id_fp_chunks, id_fp, geom_fp from "%s" order by id_fp_chunks""" % AREA_OF_INTEREST_CODE
+    )
+    gdf_footprints = gpd.GeoDataFrame.from_postgis(sql_query_footprints, engine, geom_col='geom_fp')
+    return gdf_footprints
+
+
+def estimate_points_per_footprint_database(engine, AREA_OF_INTEREST_CODE: str, BUILDING_BUFFER_METERS: float,
+                                          TABLE_NAME_LIDAR: str):
+    # estimates the number of LiDAR points within every buffered footprint of the materialized view of the area of
+    # interest from the point counts of the intersecting patches, weighted by the share of the patch envelope within
+    # the buffered footprint. Much cheaper than cropping, because patches are not exploded.
+    # Returns the estimates in the order of the chunks (id_fp_chunks)
+    sql_query_estimated_points = (
+            """
+            with fp_buffer as (
+                select id_fp_chunks, st_buffer(geom_fp, %s) geom_fp
+                from "%s"
+            )
+            select 
+                fpb.id_fp_chunks, 
+                coalesce(sum(
+                    pc_numpoints(lp.pa) * st_area(st_intersection(pc_envelopegeometry(lp.pa), fpb.geom_fp)) 
+                    / nullif(st_area(pc_envelopegeometry(lp.pa)), 0)
+                ), 0) estimated_points
+            from fp_buffer fpb
+            left join %s lp on pc_intersects(lp.pa, fpb.geom_fp)
+            group by fpb.id_fp_chunks
+            order by fpb.id_fp_chunks
+            """ % (BUILDING_BUFFER_METERS, AREA_OF_INTEREST_CODE, TABLE_NAME_LIDAR)
+    )
+    df_estimated_points = pd.read_sql(sql_query_estimated_points, engine)
+    return np.asarray(df_estimated_points.estimated_points, dtype=float)
 
 
 def create_footprints_in_area_materialized_view(
         db_connection_url: str, AREA_OF_INTEREST_CODE: str, NUMBER_OF_FOOTPRINTS: str,
-        TABLE_NAME_LOCAL_AUTHORITY_BOUNDARY, TABLE_NAME_FOOTPRINTS):
+        TABLE_NAME_LOCAL_AUTHORITY_BOUNDARY, TABLE_NAME_FOOTPRINTS, footprint_order: str = 'id'):
+    # footprints are numbered (id_fp_chunks) in the order in which they are processed in chunks.
+    # footprint_order 'id': order by footprint id
+    # footprint_order 'spatial': order by the position of the footprint centroid on a Hilbert curve, so that every
+    #   chunk covers a compact area and reads fewer distinct patches of the lidar table. The order is calculated on the
+    #   client like in the local backend (load_local_footprints) and stored in the table "<AREA_OF_INTEREST_CODE>_order"
+    table_name_order = AREA_OF_INTEREST_CODE + '_order'
+    sql_join_order = ""
+    if footprint_order == 'id':
+        sql_footprint_order = "fps.gid"
+    elif footprint_order == 'spatial':
+        sql_footprint_order = "fo.n_order"
+        sql_join_order = """inner join "%s" fo on fo.id_fp = fps.gid""" % table_name_order
+    else:
+        raise ValueError('unknown footprint_order %s' % footprint_order)
+    sql_query_footprints_in_area = (
+            """
+            with area_of_interest as (
+                select st_transform(geom, 27700) geom
+                from %s lab
+                where lab.lad21cd = '%s'
+            )
+            select fps.gid, st_asbinary(fps.geom) geom
+            from %s fps, area_of_interest
+            where st_intersects(fps.geom, area_of_interest.geom)
+            order by fps.gid
+            limit %s
+    """ % (TABLE_NAME_LOCAL_AUTHORITY_BOUNDARY, AREA_OF_INTEREST_CODE, TABLE_NAME_FOOTPRINTS, NUMBER_OF_FOOTPRINTS)
+    )
+    sql_query_create_order_table = (
+            """
+            drop table if exists "%s";
+            create table "%s" (id_fp bigint primary key, n_order integer not null);
+            """ % (table_name_order, table_name_order)
+    )
     sql_query_get_existing_materialized_views = (
             """select matviewname as view_name from pg_matviews where matviewname = '%s'""" % AREA_OF_INTEREST_CODE
     )
@@ -318,19 +905,19 @@ def create_footprints_in_area_materialized_view(
                 ),
                 footprints as (
                     select 
-                        row_number() over (order by fps.gid) as id_fp_chunks,
+                        row_number() over (order by %s) as id_fp_chunks,
                         fps.geom geom_fp,
                         fps.gid id_fp,
                         fps.unique_property_number upn
-                    from %s fps, area_of_interest
+                    from %s fps %s, area_of_interest
                     where st_intersects(fps.geom, area_of_interest.geom)
                     limit %s
                 )
                 select *
                 from footprints
             )
-    """ % (AREA_OF_INTEREST_CODE, TABLE_NAME_LOCAL_AUTHORITY_BOUNDARY, AREA_OF_INTEREST_CODE,
-           TABLE_NAME_FOOTPRINTS, NUMBER_OF_FOOTPRINTS)
+    """ % (AREA_OF_INTEREST_CODE, TABLE_NAME_LOCAL_AUTHORITY_BOUNDARY, AREA_OF_INTEREST_CODE, sql_footprint_order,
+           TABLE_NAME_FOOTPRINTS, sql_join_order, NUMBER_OF_FOOTPRINTS)
     )
     sql_query_get_number_of_footprints = (
             """select count(*) from "%s" """ % AREA_OF_INTEREST_CODE
@@ -345,6 +932,17 @@ def create_footprints_in_area_materialized_view(
     # drop existing materialized view
     if len(existing_view) == 1:
         cursor.execute(sql_query_drop_existing_materialized_view)
+    if footprint_order == 'spatial':
+        # Hilbert curve order of the footprints in the area of interest (ordered by id first, like in the local backend)
+        cursor.execute(sql_query_footprints_in_area)
+        rows = cursor.fetchall()
+        id_fp_list = [row[0] for row in rows]
+        geometries = [shapely.wkb.loads(bytes(row[1])) for row in rows]
+        cursor.execute(sql_query_create_order_table)
+        psycopg2.extras.execute_values(
+            cursor, 'insert into "%s" (id_fp, n_order) values %%s' % table_name_order,
+            [(int(id_fp_list[i]), n_order) for n_order, i in enumerate(hilbert_curve_order(geometries))],
+            page_size=10000)
     # create new materialized view with footprints in area of interest
     cursor.execute(sql_query_footprint_materialzed_view)
     # get number of footprints in area of interest
@@ -357,34 +955,145 @@ def create_footprints_in_area_materialized_view(
     return num_footprints
 
 
-def add_floor_points_to_points_in_gdf(gdf):
-    pointcloud_with_floor_list = []
-    for i, row in enumerate(gdf.iloc):
-        new_pointcloud = add_floor_points_to_pointcloud(row.geom_fp, row.geom, row.z_min)
-        pointcloud_with_floor_list.append(new_pointcloud)
-        if i % 1000 == 0:
-            print('processing pointcloud %s out of %s' % (i, len(gdf)))
+def create_footprint_links_table(db_connection_url: str, AREA_OF_INTEREST_CODE: str, TABLE_NAME_UPRN: str,
+                                 TABLE_NAME_EPC: str):
+    # links all footprints of the materialized view of the area of interest with uprn and epc data in one pass and
+    # stores the links in an indexed table "<AREA_OF_INTEREST_CODE>_links", which is read per chunk.
+    # Must be created again whenever the materialized view of footprints is created
+    table_name_links = AREA_OF_INTEREST_CODE + '_links'
+    sql_query_drop_existing_table = (
+            """drop table if exists "%s";""" % table_name_links
+    )
+    sql_query_create_links_table = (
+            """
+            create table "%s" as (
+                with fp_uprn as (
+                    select fps.id_fp_chunks, fps.id_fp, fps.geom_fp, u.uprn, (u.geom) geom_uprn
+                    from "%s" fps 
+                    left join %s u 
+                    on st_intersects(fps.geom_fp, u.geom)
+                ),
+                epc as (
+                    select "UPRN", "LMK_KEY", "CURRENT_ENERGY_RATING", "CURRENT_ENERGY_EFFICIENCY"
+                    from %s e
+                    where "LOCAL_AUTHORITY" = '%s'
+                )
+                select 
+                    row_number() over (order by fpu.id_fp_chunks, fpu.uprn) id_query,
+                    fpu.id_fp_chunks,
+                    fpu.id_fp,
+                    fpu.uprn,
+                    e."LMK_KEY" id_epc_lmk_key,
+                    fpu.geom_fp,
+                    fpu.geom_uprn,
+                    e."CURRENT_ENERGY_RATING" energy_rating,
+                    e."CURRENT_ENERGY_EFFICIENCY" energy_efficiency
+                from fp_uprn fpu
+                left join epc e
+                on fpu.uprn=e."UPRN" 
+            )
+            """ % (table_name_links, AREA_OF_INTEREST_CODE, TABLE_NAME_UPRN, TABLE_NAME_EPC, AREA_OF_INTEREST_CODE)
+    )
+    sql_query_create_index = (
+            """create index on "%s" (id_fp_chunks);""" % table_name_links
+    )
+
+    # create connection and cursor
+    connection_psycopg2 = psycopg2.connect(db_connection_url)
+    cursor = connection_psycopg2.cursor()
+    cursor.execute(sql_query_drop_existing_table)
+    cursor.execute(sql_query_create_links_table)
+    cursor.execute(sql_query_create_index)
+    cursor.execute('analyze "%s";' % table_name_links)
+    # commit the transaction
+    connection_psycopg2.commit()
+    # close the database communication
+    connection_psycopg2.close()
+    return table_name_links
+
+
+def floor_point_worker_pool(num_workers: int = 1):
+    # process pool for adding floor points, created once per run and passed to add_floor_points_to_points_in_gdf for
+    # all batches. All worker processes are started right away: create the pool before threads are started (chunk
+    # pipeline, lease heartbeat), forking a process with running threads can deadlock. None for num_workers <= 1
+    if num_workers <= 1:
+        return None
+    executor = ProcessPoolExecutor(max_workers=num_workers)
+    list(executor.map(abs, range(num_workers)))
+    return executor
+
+
+def _map_floor_points(function, num_workers, executor, *iterables):
+    # maps function over the buildings in the worker pool executor, in a pool for this call without executor
+    num_buildings = len(iterables[0])
+    if executor is None and num_workers > 1 and num_buildings > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            return _map_floor_points(function, num_workers, executor, *iterables)
+    if executor is None or num_buildings <= 1:
+        return [function(*args) for args in zip(*iterables)]
+    chunksize = max(1, num_buildings // (max(num_workers, 1) * 4))
+    return list(executor.map(function, *iterables, chunksize=chunksize))
+
+
+def add_floor_points_to_points_in_gdf(gdf, num_workers: int = 1, executor: ProcessPoolExecutor = None):
+    # adds floor points to all building point clouds. gdf is a (geo)dataframe with one point cloud per row or a
+    # PointCloudBatch, the result has the same type. The buildings are distributed to the processes of executor
+    # (see floor_point_worker_pool) or, without executor and with num_workers > 1, to a process pool of this call
+    if isinstance(gdf, PointCloudBatch):
+        return add_floor_points_to_pointcloud_batch(gdf, num_workers, executor)
+    if executor is not None or num_workers > 1:
+        pointcloud_with_floor_list = _map_floor_points(add_floor_points_to_pointcloud, num_workers, executor,
+                                                       list(gdf.geom_fp), list(gdf.geom), list(gdf.z_min))
+    else:
+        pointcloud_with_floor_list = []
+        for i, (building_footprint, pointcloud, z_min) in enumerate(zip(gdf.geom_fp, gdf.geom, gdf.z_min)):
+            new_pointcloud = add_floor_points_to_pointcloud(building_footprint, pointcloud, z_min)
+            pointcloud_with_floor_list.append(new_pointcloud)
+            if i % 1000 == 0:
+                print('processing pointcloud %s out of %s' % (i, len(gdf)))
     gdf = gdf.assign(geom=pointcloud_with_floor_list)
     print('list added to gdf')
     return gdf
 
 
-def add_floor_points_to_pointcloud(building_footprint: shapely.geometry.Polygon,
-                                   pointcloud: shapely.geometry.MultiPoint,
-                                   z_min):
-    # Grid spacing in meters
-    resolution = 0.5
+def add_floor_points_to_pointcloud_batch(pc_batch: PointCloudBatch, num_workers: int = 1,
+                                         executor: ProcessPoolExecutor = None):
+    # the floor points of all buildings are appended to the flat point array and duplicate points are removed for all
+    # buildings at once. The result equals add_floor_points_to_pointcloud per building
+    footprints, z_mins = list(pc_batch.info.geom_fp), list(pc_batch.info.z_min)
+    floor_points_list = _map_floor_points(floor_points_of_footprint, num_workers, executor, footprints, z_mins)
+    num_floor_points = [len(floor_points) for floor_points in floor_points_list]
+    floor_building_index = np.repeat(np.arange(len(pc_batch)), num_floor_points)
+    points = np.concatenate([pc_batch.points] + floor_points_list)
+    building_index = np.concatenate([pc_batch.building_index(), floor_building_index])
+    points, offsets = unique_points_per_building(points, building_index, len(pc_batch))
+    return PointCloudBatch(points, offsets, pc_batch.info)
+
+
+def floor_points_of_footprint(building_footprint: shapely.geometry.Polygon, z_min, resolution: float = 0.5):
+    # grid of points (spacing resolution in meters) within the footprint at the height z_min, shape (n, 3)
     lonmin, latmin, lonmax, latmax = building_footprint.bounds
 
     # construct rectangle of points
     x, y = np.round(np.meshgrid(np.arange(lonmin, lonmax, resolution), np.arange(latmin, latmax, resolution)), 4)
-    points = list(zip(x.flatten(), y.flatten()))
+    x, y = x.ravel(), y.ravel()
+
+    # keep the points within the footprint, tested for all points at once
+    is_inside = points_in_polygon(building_footprint, x, y)
+    floor_x, floor_y = x[is_inside], y[is_inside]
+    return np.column_stack((floor_x, floor_y, np.full(len(floor_x), z_min, dtype=np.float64)))
+
 
-    # validate each point falls inside shapes and add minimum z-vale of lidar point cloud as floor level
-    valid_points = [(point[0], point[1], z_min) for point in points if
-                    building_footprint.contains(shapely.geometry.Point(point))]
+def add_floor_points_to_pointcloud(building_footprint: shapely.geometry.Polygon,
+                                   pointcloud,
+                                   z_min):
+    # pointcloud is a shapely multipoint or a numpy array of shape (n, 3). The result has the same type
+    floor_points = floor_points_of_footprint(building_footprint, z_min)
+
+    if isinstance(pointcloud, np.ndarray):
+        return np.unique(np.concatenate([pointcloud, floor_points]), axis=0)
 
-    footprint_multipoint = shapely.geometry.MultiPoint(valid_points)
+    footprint_multipoint = shapely.geometry.MultiPoint(floor_points.tolist())
     new_multipoint = shapely.ops.unary_union([pointcloud, footprint_multipoint])
     return new_multipoint
 
@@ -395,49 +1104,72 @@ def get_scaling_factor(gdf):
     return scaling_factor
 
 
-def pointcloud_gdf_to_numpy(gdf, scaling_factor, POINT_COUNT_THRESHOLD):
-    # Convert fetched building point clouds to numpy
+def pointcloud_gdf_to_numpy(gdf, scaling_factor, POINT_COUNT_THRESHOLD, seed=0):
+    # Convert fetched building point clouds (gdf or PointCloudBatch) to numpy
+    # seed: seed of the subsampling, the same seed gives the same samples in every run (None: new samples every run)
     # make sure all building point clouds have enough points,
     # although sql query should already ensure this
-    do_pointclouds_have_enough_points = \
-        (np.array([len(g.geoms) for g in gdf.geom]) >= POINT_COUNT_THRESHOLD).all()
+    if isinstance(gdf, PointCloudBatch):
+        num_points = gdf.num_points()
+    else:
+        pointcloud_list = list(gdf.geom)
+        num_points = np.array([len(pointcloud_to_numpy(g)) for g in pointcloud_list])
+    do_pointclouds_have_enough_points = (num_points >= POINT_COUNT_THRESHOLD).all()
     assert do_pointclouds_have_enough_points, \
         'not all gdf entries have the required amount of points'
 
-    # apply normalization function to entire dataframe
-    lidar_numpy_list = list(
-        gdf.geom.apply(
-            normalize_geom,
-            args=[scaling_factor, POINT_COUNT_THRESHOLD])
-    )
+    if isinstance(gdf, PointCloudBatch):
+        # normalize and subsample all point clouds of the batch at once
+        return list(normalize_pointcloud_batch(gdf.points, gdf.offsets, scaling_factor, POINT_COUNT_THRESHOLD, seed))
+
+    # apply normalization function to all point clouds, samples are drawn from one generator
+    rng = np.random.default_rng(seed)
+    lidar_numpy_list = [normalize_geom(pointcloud, scaling_factor, POINT_COUNT_THRESHOLD, rng)
+                        for pointcloud in pointcloud_list]
     return lidar_numpy_list
 
 
 # Save building point clouds as npy
 def save_lidar_numpy_list(lidar_numpy_list, gdf, dir_npy):
-    # IMPORTANT: lidar_numpy_list order must be the same as gdf to ensure correct naming of .npy
-    for i, lidar_pc in enumerate(lidar_numpy_list):
-        npy_file_name = str(gdf.iloc[i].geom_fp.centroid.x) + "_" + \
-                        str(gdf.iloc[i].geom_fp.centroid.y) + ".npy"
+    # IMPORTANT: lidar_numpy_list order must be the same as gdf (or PointCloudBatch) to ensure correct naming of .npy
+    if isinstance(gdf, PointCloudBatch):
+        gdf = gdf.info
+    npy_file_names = file_name_from_polygon_list(gdf.geom_fp, '.npy')
+    for npy_file_name, lidar_pc in zip(npy_file_names, lidar_numpy_list):
         npy_file_path = os.path.join(dir_npy, npy_file_name)
-        with open(npy_file_path, 'wb') as f:
-            np.save(f, arr=lidar_pc)
+        with atomic_output_path(npy_file_path) as tmp_file_path:
+            with open(tmp_file_path, 'wb') as f:
+                np.save(f, arr=lidar_pc)
     return
 
 
-def save_raw_input_information(n_iteration, gdf: gpd.GeoDataFrame, DIR_AOI_OUTPUT: str, AOI_CODE: str):
+def save_pointcloud_batch_shard(pc_batch: PointCloudBatch, dir_store: str, shard_name: str, encoding: str = 'float64'):
+    # saves the building point clouds of the batch as one shard of the point cloud store, named like the .npy files.
+    # encoding of the points: 'float64', 'float32', 'int32' or 'int16' (see utils/pointcloud_store.py)
+    file_names = file_name_from_polygon_list(pc_batch.info.geom_fp, '.npy')
+    write_pointcloud_shard(dir_store, shard_name, pc_batch.points, pc_batch.offsets, pc_batch.info.id_fp, file_names,
+                           encoding=encoding)
+    return
+
+
+def save_raw_input_information(n_iteration, gdf: gpd.GeoDataFrame, gdf_pc: pd.DataFrame, DIR_AOI_OUTPUT: str,
+                               AOI_CODE: str):
     # saves information required for creating building point clouds except point cloud data itself
+    # gdf: footprint - uprn - epc link table, gdf_pc: point clouds per footprint (only id_fp and num_p_in_pc are used)
+    gdf = gdf.merge(pd.DataFrame({"id_fp": gdf_pc.id_fp, "num_p_in_pc": gdf_pc.num_p_in_pc}), on='id_fp', how='left')
     # footprints
     gdf_footprints = gpd.GeoDataFrame({"id_fp": gdf.id_fp, "geometry": gdf.geom_fp})
-    gdf_footprints = gdf_footprints.drop_duplicates()
+    gdf_footprints = gdf_footprints.drop_duplicates('id_fp')
     save_path = os.path.join(
         DIR_AOI_OUTPUT, 'footprints', str('footprints_' + AOI_CODE + '_' + str(int(n_iteration)) + ".geojson"))
-    gdf_footprints.to_file(save_path, driver="GeoJSON")
+    with atomic_output_path(save_path) as tmp_save_path:
+        gdf_footprints.to_file(tmp_save_path, driver="GeoJSON")
     # uprn
     gdf_uprn = gpd.GeoDataFrame({"uprn": gdf.uprn, "geometry": gdf.geom_uprn})
     gdf_uprn = gdf_uprn.drop_duplicates()
     save_path = os.path.join(DIR_AOI_OUTPUT, 'uprn', str('uprn_' + AOI_CODE + '_' + str(int(n_iteration)) + ".geojson"))
-    gdf_uprn.to_file(save_path, driver="GeoJSON")
+    with atomic_output_path(save_path) as tmp_save_path:
+        gdf_uprn.to_file(tmp_save_path, driver="GeoJSON")
     # epc label
     gdf_epc = pd.DataFrame(
         {"id_epc_lmk_key": gdf.id_epc_lmk_key,
@@ -446,7 +1178,8 @@ def save_raw_input_information(n_iteration, gdf: gpd.GeoDataFrame, DIR_AOI_OUTPU
     )
     gdf_epc = gdf_epc.drop_duplicates()
     save_path = os.path.join(DIR_AOI_OUTPUT, 'epc', str('epc_' + AOI_CODE + '_' + str(int(n_iteration)) + ".json"))
-    gdf_epc.to_json(save_path, orient='records')
+    with atomic_output_path(save_path) as tmp_save_path:
+        gdf_epc.to_json(tmp_save_path, orient='records')
     # label - filename mapping
     file_names = file_name_from_polygon_list(list(gdf.geom_fp), file_extension='.npy')
     gdf_mapping = pd.DataFrame(
@@ -462,7 +1195,85 @@ def save_raw_input_information(n_iteration, gdf: gpd.GeoDataFrame, DIR_AOI_OUTPU
     save_path = os.path.join(DIR_AOI_OUTPUT, 'filename_mapping',
                              str('label_filename_mapping_' + AOI_CODE + '_' + str(int(n_iteration)) + ".json")
                              )
-    gdf_mapping.to_json(save_path, orient='index')
+    with atomic_output_path(save_path) as tmp_save_path:
+        gdf_mapping.to_json(tmp_save_path, orient='index')
+    return
+
+
+def write_chunk_completion_marker(DIR_AOI_OUTPUT: str, n_iteration, chunk_settings: dict, chunk_info: dict):
+    # marks a chunk as complete. Must be called after all outputs of the chunk are written.
+    # The marker records the settings of the chunk, so that chunks of runs with other settings are not skipped
+    dir_markers = os.path.join(DIR_AOI_OUTPUT, 'completed_chunks')
+    os.makedirs(dir_markers, exist_ok=True)
+    marker = dict(chunk_info, n_iteration=int(n_iteration), settings_sha256=_settings_sha256(chunk_settings),
+                  completed_at=time.time())
+    with atomic_output_path(os.path.join(dir_markers, 'chunk_%s.json' % int(n_iteration))) as tmp_file_path:
+        with open(tmp_file_path, 'w') as f:
+            json.dump(marker, f, indent=1)
+    return
+
+
+def completed_chunk_ids(DIR_AOI_OUTPUT: str, chunk_settings: dict):
+    # returns the ids of all chunks with a completion marker of the same settings
+    dir_markers = os.path.join(DIR_AOI_OUTPUT, 'completed_chunks')
+    if not os.path.isdir(dir_markers):
+        return set()
+    settings_sha256 = _settings_sha256(chunk_settings)
+    chunk_ids = set()
+    for file in os.listdir(dir_markers):
+        if file[-5:] != '.json':
+            continue
+        with open(os.path.join(dir_markers, file), 'r') as f:
+            marker = json.load(f)
+        if marker['settings_sha256'] == settings_sha256:
+            chunk_ids.add(marker['n_iteration'])
+    return chunk_ids
+
+
+def remove_stale_chunk_outputs(DIR_AOI_OUTPUT: str, chunk_settings: dict, SUB_FOLDER_LIST: list):
+    # removes the outputs of all chunks without a completion marker of the settings, e.g. chunks 15 - 19 of an earlier
+    # run with 20 chunks, so that they are not stitched into the results. Removes the per-chunk json files, the shards
+    # (npy_shards) and the completion markers of other settings. The .npy files of single buildings (npy_raw) can not be
+    # assigned to chunks and are kept, they are overwritten or not listed in the filename mapping.
+    # Do not call while other workers write to the same folder
+    completed_chunks = completed_chunk_ids(DIR_AOI_OUTPUT, chunk_settings)
+    stale_file_paths = []
+    for subdir in SUB_FOLDER_LIST:
+        dir_path = os.path.join(DIR_AOI_OUTPUT, subdir)
+        if subdir == 'npy_raw' or not os.path.isdir(dir_path):
+            continue
+        # <subdir>_<AOI>_<n_iteration>.json / .geojson
+        for file in os.listdir(dir_path):
+            n_iteration = os.path.splitext(file)[0].rsplit('_', 1)[-1]
+            if n_iteration.isdigit() and int(n_iteration) not in completed_chunks:
+                stale_file_paths.append(os.path.join(dir_path, file))
+    # shard_<n_iteration>_<n_batch>.npy / _index.json
+    dir_shards = os.path.join(DIR_AOI_OUTPUT, 'npy_shards')
+    if os.path.isdir(dir_shards):
+        for file in os.listdir(dir_shards):
+            file_name_parts = file.split('_')
+            if file_name_parts[0] == 'shard' and len(file_name_parts) > 2 and file_name_parts[1].isdigit() \
+                    and int(file_name_parts[1]) not in completed_chunks:
+                stale_file_paths.append(os.path.join(dir_shards, file))
+    # chunk_<n_iteration>.json
+    dir_markers = os.path.join(DIR_AOI_OUTPUT, 'completed_chunks')
+    if os.path.isdir(dir_markers):
+        stale_file_paths += [os.path.join(dir_markers, file) for file in os.listdir(dir_markers)
+                             if file[-5:] == '.json' and file[6:-5].isdigit()
+                             and int(file[6:-5]) not in completed_chunks]
+    for file_path in stale_file_paths:
+        os.remove(file_path)
+    if len(stale_file_paths) > 0:
+        print('removed %s output files of chunks of other settings' % len(stale_file_paths))
+    return len(stale_file_paths)
+
+
+def remove_temporary_output_files(DIR_AOI_OUTPUT: str):
+    # removes temporary files left by an interrupted run. Do not call while other workers write to the same folder
+    for dir_path, dir_names, file_names in os.walk(DIR_AOI_OUTPUT):
+        for file in file_names:
+            if file[-4:] == '.tmp':
+                os.remove(os.path.join(dir_path, file))
     return
 
 
@@ -553,13 +1364,14 @@ def output_folder_setup(dir_outputs: str, area_of_interest_code: str, SUB_FOLDER
     # create area of interest folder
     DIR_AOI_OUTPUT = os.path.join(dir_outputs, area_of_interest_code)
     if os.path.isdir(DIR_AOI_OUTPUT):
-        print('output for this area of interest already exists. delete or choose other area code')
+        print('output for this area of interest already exists. Completed chunks of the same settings are skipped, '
+              'outputs of chunks of other settings are removed before the results are stitched')
     else:
         os.mkdir(DIR_AOI_OUTPUT)
-        # create sub-folders for point cloud data and meta data
-        for subdir in SUB_FOLDER_LIST:
-            dir_path = os.path.join(DIR_AOI_OUTPUT, subdir)
-            if not os.path.isdir(dir_path): os.mkdir(dir_path)
+    # create sub-folders for point cloud data and meta data
+    for subdir in SUB_FOLDER_LIST:
+        dir_path = os.path.join(DIR_AOI_OUTPUT, subdir)
+        if not os.path.isdir(dir_path): os.mkdir(dir_path)
     return DIR_AOI_OUTPUT
 
 
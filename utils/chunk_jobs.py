@@ -0,0 +1,230 @@
+import contextlib
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import psycopg2
+
+from sqlalchemy.engine import make_url
+
+# Job table for processing the chunks of footprints with several workers (processes, possibly on several machines
+# sharing the output directory). Every chunk is a job. Workers claim pending jobs under a time-limited lease, renew the
+# leases of their jobs while working (heartbeat) and mark the jobs as done. Jobs of crashed workers are claimed again
+# as soon as their lease has expired.
+# The job table is stored in the database (job_store is a postgresql url, e.g. config.DATABASE_URL) or in a SQLite file
+# (job_store is a file path or a sqlite url). Leases are compared with the clocks of the workers, so lease_seconds has
+# to be much larger than the clock differences between machines.
+
+CHUNK_JOB_TABLE = 'chunk_jobs'
+
+
+def default_worker_id():
+    return '%s_%s' % (socket.gethostname(), os.getpid())
+
+
+def chunk_job_name(area_of_interest_code: str, chunk_settings: dict):
+    # jobs of runs with other chunk settings (e.g. other chunk bounds) get another job name, so that their status is
+    # not taken over
+    settings_sha256 = hashlib.sha256(json.dumps(chunk_settings, sort_keys=True).encode()).hexdigest()
+    return '%s_%s' % (area_of_interest_code, settings_sha256[:12])
+
+
+def _job_store_connection(job_store: str):
+    # returns the backend ('postgresql' or 'sqlite') and a connection to the job store. Urls of other databases raise a
+    # ValueError, so that a url is never taken as the path of a SQLite file
+    if '://' not in job_store:
+        return 'sqlite', sqlite3.connect(job_store, timeout=60)
+    url = make_url(job_store)
+    if url.get_backend_name() in ['postgresql', 'postgres']:
+        # psycopg2 takes libpq urls without driver name (e.g. postgresql+psycopg2://)
+        return 'postgresql', psycopg2.connect(url.set(drivername='postgresql').render_as_string(hide_password=False))
+    if url.get_backend_name() == 'sqlite' and url.database:
+        return 'sqlite', sqlite3.connect(url.database, timeout=60)
+    raise ValueError('unsupported chunk job store %s, use a postgresql url or a SQLite file path'
+                     % url.render_as_string(hide_password=True))
+
+
+def _execute(job_store: str, sql: str, params=(), many: bool = False):
+    # executes one statement in its own transaction and returns the fetched rows and the number of changed rows
+    backend, connection = _job_store_connection(job_store)
+    if backend == 'sqlite':
+        sql = sql.replace('%s', '?')
+    try:
+        cursor = connection.cursor()
+        if many:
+            cursor.executemany(sql, params)
+        else:
+            cursor.execute(sql, params)
+        rows = cursor.fetchall() if cursor.description is not None else []
+        rowcount = cursor.rowcount
+        connection.commit()
+    finally:
+        connection.close()
+    return rows, rowcount
+
+
+def create_chunk_jobs(job_store: str, job_name: str, chunk_ids):
+    # adds a pending job per chunk. chunk_ids are the chunks to be processed, i.e. the chunks without completion marker.
+    # Existing jobs of these chunks are pending again with no attempts (e.g. done jobs whose outputs have been deleted
+    # or failed jobs), except jobs running under a valid lease of another worker
+    sql_create_table = (
+            """
+            create table if not exists %s (
+                job_name text not null,
+                n_iteration integer not null,
+                status text not null,
+                worker_id text,
+                lease_expires double precision,
+                attempts integer not null default 0,
+                primary key (job_name, n_iteration)
+            )""" % CHUNK_JOB_TABLE
+    )
+    sql_insert_job = (
+            """
+            insert into %s (job_name, n_iteration, status) values (%%s, %%s, 'pending')
+            on conflict do nothing""" % CHUNK_JOB_TABLE
+    )
+    sql_reset_job = (
+            """
+            update %s set status = 'pending', worker_id = null, lease_expires = null, attempts = 0
+            where job_name = %%s and n_iteration = %%s and not (status = 'running' and lease_expires >= %%s)"""
+            % CHUNK_JOB_TABLE
+    )
+    _execute(job_store, sql_create_table)
+    _execute(job_store, sql_insert_job, [(job_name, int(chunk_id)) for chunk_id in chunk_ids], many=True)
+    now = time.time()
+    _execute(job_store, sql_reset_job, [(job_name, int(chunk_id), now) for chunk_id in chunk_ids], many=True)
+    return
+
+
+def wait_for_chunk_jobs(job_store: str, job_name: str, poll_seconds: float = 30):
+    # waits until the jobs of job_name have been created (create_chunk_jobs of the first worker). Additional workers
+    # may be started before the first worker has created the job table
+    sql_count_jobs = """select count(*) from %s where job_name = %%s""" % CHUNK_JOB_TABLE
+    while True:
+        try:
+            rows, _ = _execute(job_store, sql_count_jobs, (job_name,))
+            if rows[0][0] > 0:
+                return
+        except (sqlite3.OperationalError, psycopg2.ProgrammingError):
+            # the job table does not exist yet
+            pass
+        print('Waiting for the first worker to create the chunk jobs')
+        time.sleep(poll_seconds)
+
+
+def claim_chunk_jobs(job_store: str, job_name: str, worker_id: str, lease_seconds: float = 900,
+                     max_attempts: int = 3, poll_seconds: float = 30):
+    # yields the chunk ids claimed by the worker. A job is claimed if it is pending or if the lease of its worker has
+    # expired. While other workers hold leases, the generator waits for them to finish or to expire.
+    # Jobs which have been claimed max_attempts times without being done are marked as failed.
+    sql_select_claimable = (
+            """
+            select n_iteration, attempts from %s
+            where job_name = %%s and attempts < %%s
+                and (status = 'pending' or (status = 'running' and lease_expires < %%s))
+            order by n_iteration
+            limit 1""" % CHUNK_JOB_TABLE
+    )
+    # the attempts condition makes sure, that the job has not been claimed by another worker in the meantime
+    sql_claim = (
+            """
+            update %s set status = 'running', worker_id = %%s, lease_expires = %%s, attempts = attempts + 1
+            where job_name = %%s and n_iteration = %%s and attempts = %%s and status <> 'done'""" % CHUNK_JOB_TABLE
+    )
+    # also jobs which have been released after the last attempt
+    sql_fail_expired = (
+            """
+            update %s set status = 'failed', worker_id = null, lease_expires = null
+            where job_name = %%s and attempts >= %%s
+                and (status = 'pending' or (status = 'running' and lease_expires < %%s))""" % CHUNK_JOB_TABLE
+    )
+    sql_count_leased = (
+            """
+            select count(*) from %s
+            where job_name = %%s and status = 'running' and lease_expires >= %%s""" % CHUNK_JOB_TABLE
+    )
+    while True:
+        now = time.time()
+        rows, _ = _execute(job_store, sql_select_claimable, (job_name, max_attempts, now))
+        if len(rows) == 1:
+            n_iteration, attempts = rows[0]
+            _, rowcount = _execute(job_store, sql_claim,
+                                   (worker_id, now + lease_seconds, job_name, n_iteration, attempts))
+            if rowcount == 1:
+                yield int(n_iteration)
+            continue
+        _execute(job_store, sql_fail_expired, (job_name, max_attempts, now))
+        rows, _ = _execute(job_store, sql_count_leased, (job_name, now))
+        if rows[0][0] == 0:
+            return
+        time.sleep(poll_seconds)
+
+
+def renew_chunk_leases(job_store: str, job_name: str, worker_id: str, lease_seconds: float = 900):
+    # extends the leases of all running jobs of the worker
+    sql_renew = (
+            """
+            update %s set lease_expires = %%s
+            where job_name = %%s and worker_id = %%s and status = 'running'""" % CHUNK_JOB_TABLE
+    )
+    _, rowcount = _execute(job_store, sql_renew, (time.time() + lease_seconds, job_name, worker_id))
+    return rowcount
+
+
+@contextlib.contextmanager
+def chunk_lease_heartbeat(job_store: str, job_name: str, worker_id: str, lease_seconds: float = 900,
+                          heartbeat_seconds: float = 60):
+    # renews the leases of the worker every heartbeat_seconds in a background thread while the context is active
+    stop_event = threading.Event()
+
+    def heartbeat():
+        while not stop_event.wait(heartbeat_seconds):
+            try:
+                renew_chunk_leases(job_store, job_name, worker_id, lease_seconds)
+            except Exception as error:
+                # the lease is only lost if the renewal fails until the lease expires
+                print('Chunk lease renewal failed: %s' % error)
+
+    heartbeat_thread = threading.Thread(target=heartbeat, name='chunk_lease_heartbeat', daemon=True)
+    heartbeat_thread.start()
+    try:
+        yield
+    finally:
+        stop_event.set()
+        heartbeat_thread.join()
+
+
+def complete_chunk_job(job_store: str, job_name: str, n_iteration: int, worker_id: str):
+    # marks the job as done, if the worker still holds it
+    sql_complete = (
+            """
+            update %s set status = 'done', lease_expires = null
+            where job_name = %%s and n_iteration = %%s and worker_id = %%s and status = 'running'""" % CHUNK_JOB_TABLE
+    )
+    _, rowcount = _execute(job_store, sql_complete, (job_name, int(n_iteration), worker_id))
+    return rowcount == 1
+
+
+def release_chunk_jobs(job_store: str, job_name: str, worker_id: str, max_attempts: int = 3):
+    # returns the running jobs of the worker to the pending jobs, e.g. if the worker stops because of an error.
+    # Jobs which have been claimed max_attempts times are marked as failed (see claim_chunk_jobs)
+    sql_release = (
+            """
+            update %s set status = case when attempts >= %%s then 'failed' else 'pending' end,
+                worker_id = null, lease_expires = null
+            where job_name = %%s and worker_id = %%s and status = 'running'""" % CHUNK_JOB_TABLE
+    )
+    _, rowcount = _execute(job_store, sql_release, (max_attempts, job_name, worker_id))
+    return rowcount
+
+
+def chunk_job_progress(job_store: str, job_name: str):
+    # number of jobs per status
+    sql_progress = """select status, count(*) from %s where job_name = %%s group by status""" % CHUNK_JOB_TABLE
+    rows, _ = _execute(job_store, sql_progress, (job_name,))
+    return {status: count for status, count in rows}
@@ -0,0 +1,152 @@
+import queue
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+# marks the end of the chunks in the queue, one per consumer
+_END_OF_CHUNKS = object()
+# marks the end of the batches in the queue of prefetch_batches
+_END_OF_BATCHES = object()
+
+
+def run_chunk_pipeline(chunk_ids, fetch_chunk, process_chunk, prefetch_depth: int = 1, num_workers: int = 1):
+    # Runs fetch_chunk(chunk_id) for all chunks in a producer thread and process_chunk(chunk_id, fetched_chunk) in
+    # num_workers consumer threads, so that the next chunks are fetched (e.g. from the database) while the previous
+    # chunks are processed. Fetched chunks wait in a queue of prefetch_depth entries, so that at most
+    # prefetch_depth + num_workers + 1 chunks are held in memory at the same time.
+    # Chunks are processed in order if num_workers is 1. The first error of a thread stops the pipeline and is raised,
+    # chunks which are already fetched are not processed anymore.
+    chunk_queue = queue.Queue(maxsize=max(prefetch_depth, 1))
+    stop_event = threading.Event()
+    producer_errors = []
+
+    def put(item):
+        # waits for space in the queue, but gives up when the pipeline is stopped
+        while not stop_event.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for chunk_id in chunk_ids:
+                if stop_event.is_set():
+                    break
+                fetched_chunk = fetch_chunk(chunk_id)
+                if not put((chunk_id, fetched_chunk)):
+                    break
+        except BaseException as error:
+            producer_errors.append(error)
+            stop_event.set()
+        finally:
+            for n_worker in range(num_workers):
+                put(_END_OF_CHUNKS)
+        return
+
+    def consumer():
+        while True:
+            try:
+                item = chunk_queue.get(timeout=0.5)
+            except queue.Empty:
+                if stop_event.is_set():
+                    return
+                continue
+            if item is _END_OF_CHUNKS:
+                return
+            if stop_event.is_set():
+                # another thread failed: the queue is drained without processing the remaining chunks, so that the
+                # producer is not blocked
+                continue
+            chunk_id, fetched_chunk = item
+            try:
+                process_chunk(chunk_id, fetched_chunk)
+            except BaseException:
+                stop_event.set()
+                raise
+            # release the processed chunk before waiting for the next one
+            del item, fetched_chunk
+
+    producer_thread = threading.Thread(target=producer, name='chunk_producer', daemon=True)
+    producer_thread.start()
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='chunk_consumer') as executor:
+        consumer_futures = [executor.submit(consumer) for n_worker in range(num_workers)]
+        consumer_errors = [future.exception() for future in consumer_futures]
+    producer_thread.join()
+
+    for error in producer_errors + consumer_errors:
+        if error is not None:
+            raise error
+    return
+
+
+def prefetch_batches(batches, prefetch_depth: int = 2):
+    # reads the batches of an iterable (e.g. a generator reading a server-side database cursor) in a background thread,
+    # which starts immediately and reads up to prefetch_depth batches in advance. Returns a generator of the batches.
+    # Used in fetch_chunk, the query of a streamed chunk runs while the previous chunks are processed.
+    # An error of the background thread is raised by the generator. If the generator is closed before the end, the
+    # background thread stops and closes the iterable
+    batch_queue = queue.Queue(maxsize=max(prefetch_depth, 1))
+    stop_event = threading.Event()
+
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                batch_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            for batch in batches:
+                if not put((batch, None)):
+                    return
+            put((_END_OF_BATCHES, None))
+        except BaseException as error:
+            put((_END_OF_BATCHES, error))
+        finally:
+            if hasattr(batches, 'close'):
+                batches.close()
+
+    def batch_generator():
+        try:
+            while True:
+                batch, error = batch_queue.get()
+                if batch is _END_OF_BATCHES:
+                    if error is not None:
+                        raise error
+                    return
+                yield batch
+        finally:
+            stop_event.set()
+
+    reader_thread = threading.Thread(target=reader, name='batch_prefetch', daemon=True)
+    reader_thread.start()
+    generator = batch_generator()
+    # also stops the background thread if the generator is discarded without being started
+    weakref.finalize(generator, stop_event.set)
+    return generator
+
+
+def point_budget_chunk_bounds(estimated_points, max_points_per_chunk: float, max_footprints_per_chunk: int):
+    # cuts footprints (ordered by id_fp_chunks = 1, 2, ...) into chunks of at most max_points_per_chunk estimated
+    # points and at most max_footprints_per_chunk footprints. A footprint exceeding the budget gets its own chunk.
+    # Returns (fp_num_start, fp_num_end) per chunk, the chunk contains id_fp_chunks > fp_num_start and <= fp_num_end
+    chunk_bounds = []
+    fp_num_start = 0
+    num_points_chunk = 0
+    for n_footprint, num_points in enumerate(estimated_points):
+        num_footprints_chunk = n_footprint - fp_num_start
+        if num_footprints_chunk > 0 and (num_points_chunk + num_points > max_points_per_chunk or
+                                         num_footprints_chunk >= max_footprints_per_chunk):
+            chunk_bounds.append((fp_num_start, n_footprint))
+            fp_num_start = n_footprint
+            num_points_chunk = 0
+        num_points_chunk += num_points
+    if len(estimated_points) > fp_num_start:
+        chunk_bounds.append((fp_num_start, len(estimated_points)))
+    return chunk_bounds
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+from utils.utils import pointcloud_to_numpy
+
+
+class PointCloudBatch:
+    # Building point clouds of a batch of buildings in columnar form: the x, y, z coordinates of all buildings in one
+    # flat float64 array of shape (n, 3), the points of building i are points[offsets[i]:offsets[i + 1]].
+    # info holds one row of metadata per building (id_fp, geom_fp, z_min, num_p_in_pc, ...) in the order of the points.
+    # The point clouds of single buildings are views of the flat array, no per-point python objects are created.
+
+    def __init__(self, points: np.ndarray, offsets: np.ndarray, info: pd.DataFrame):
+        assert len(offsets) == len(info) + 1, 'offsets must have one entry more than info'
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.info = info.reset_index(drop=True)
+
+    @classmethod
+    def from_pointclouds(cls, pointcloud_list: list, info: pd.DataFrame):
+        # concatenates the point clouds (numpy arrays or shapely multipoints) in the order of info
+        pointcloud_list = [pointcloud_to_numpy(pointcloud).reshape(-1, 3) for pointcloud in pointcloud_list]
+        offsets = np.zeros(len(pointcloud_list) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(points) for points in pointcloud_list])
+        points = np.concatenate(pointcloud_list) if len(pointcloud_list) > 0 else np.empty((0, 3))
+        return cls(points, offsets, info)
+
+    @classmethod
+    def from_gdf(cls, gdf: pd.DataFrame):
+        # converts a (geo)dataframe of building point clouds (point cloud in column geom, one row per building)
+        return cls.from_pointclouds(list(gdf.geom), gdf.drop(columns='geom'))
+
+    def __len__(self):
+        return len(self.info)
+
+    def num_points(self):
+        # number of points per building
+        return np.diff(self.offsets)
+
+    def building_index(self):
+        # index of the building of every point
+        return np.repeat(np.arange(len(self)), self.num_points())
+
+    def pointcloud(self, i: int):
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+    def pointclouds(self):
+        # list of the point clouds of all buildings (views of the flat array)
+        return [self.pointcloud(i) for i in range(len(self))]
+
+    def to_gdf(self):
+        # dataframe with one row per building and the point cloud (numpy array view) in column geom
+        return self.info.assign(geom=pd.Series(self.pointclouds(), index=self.info.index, dtype=object))
+
+
+def unique_points_per_building(points: np.ndarray, building_index: np.ndarray, num_buildings: int):
+    # removes duplicate points of every building in one pass over all points. Points are sorted by building, then
+    # x, y, z like np.unique(points, axis=0) per building. Returns the unique points and the offsets of the buildings
+    order = np.lexsort((points[:, 2], points[:, 1], points[:, 0], building_index))
+    points = points[order]
+    building_index = building_index[order]
+    is_first = np.ones(len(points), dtype=bool)
+    is_first[1:] = (building_index[1:] != building_index[:-1]) | (points[1:] != points[:-1]).any(axis=1)
+    offsets = np.zeros(num_buildings + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(building_index[is_first], minlength=num_buildings))
+    return points[is_first], offsets
+
+
+def normalize_pointcloud_batch(points: np.ndarray, offsets: np.ndarray, scaling_factor=1000,
+                               random_sample_size: int = None, seed=None, allow_fewer_points: bool = False):
+    # normalises the point clouds of several buildings at once, like normalize_geom per building: the points of every
+    # building are shifted to the building's minimum x, y, z and divided by the scaling factor.
+    # scaling_factor: one factor for all buildings, an array with one factor per building or None (largest extent of
+    # every building, coordinates between 0 and 1)
+    # random_sample_size: None returns the normalised points of shape (n, 3) (same offsets). Otherwise
+    # random_sample_size points are drawn without replacement per building in one pass and an array of shape
+    # (buildings, random_sample_size, 3) is returned. Buildings with fewer points raise a ValueError or are sampled
+    # with replacement (allow_fewer_points).
+    # seed: seed or numpy generator of the random samples
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    num_points = np.diff(offsets)
+    if (num_points == 0).any():
+        raise ValueError('all point clouds need at least one point')
+    min_xyz = np.minimum.reduceat(points, offsets[:-1], axis=0)
+    if scaling_factor is None:
+        scaling_factor = np.maximum((np.maximum.reduceat(points, offsets[:-1], axis=0) - min_xyz).max(axis=1), 1e-9)
+    scaling_factor = np.broadcast_to(np.asarray(scaling_factor, dtype=np.float64), num_points.shape)
+
+    if random_sample_size is None:
+        building_index = np.repeat(np.arange(len(num_points)), num_points)
+        return (points - min_xyz[building_index]) / scaling_factor[building_index, None]
+
+    has_fewer_points = num_points < random_sample_size
+    if has_fewer_points.any() and not allow_fewer_points:
+        raise ValueError('point clouds with fewer points than random_sample_size')
+    rng = np.random.default_rng(seed)
+    # random key per point, sorted within every building. The first random_sample_size points of every building in
+    # this order are a sample without replacement. Random values are below 0.5, so keys never round to the next building
+    keys = np.repeat(np.arange(len(num_points), dtype=np.float64), num_points) + 0.5 * rng.random(len(points))
+    order = np.argsort(keys)
+    sample_positions = offsets[:-1, None] + np.arange(random_sample_size)[None, :]
+    sample_idx = order[np.minimum(sample_positions, len(points) - 1)]
+    if has_fewer_points.any():
+        # sample with replacement
+        random_positions = np.floor(rng.random((has_fewer_points.sum(), random_sample_size)) *
+                                    num_points[has_fewer_points, None]).astype(np.int64)
+        sample_idx[has_fewer_points] = offsets[:-1][has_fewer_points, None] + random_positions
+    return (points[sample_idx] - min_xyz[:, None, :]) / scaling_factor[:, None, None]
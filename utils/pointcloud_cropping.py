@@ -0,0 +1,119 @@
+import laspy
+import shapely
+import shapely.geometry
+import shapely.vectorized
+
+import numpy as np
+import pandas as pd
+
+
+def read_tile_points_in_bounds(las_file_path: str, bounds: tuple, chunk_size: int = 5000000):
+    # reads the x, y, z coordinates of all points of a LAS/LAZ tile within bounds (min_x, min_y, max_x, max_y).
+    # The tile is read in chunks, so that only the selected points are kept in memory
+    min_x, min_y, max_x, max_y = bounds
+    xyz_list = []
+    with laspy.open(las_file_path) as las_reader:
+        scales = las_reader.header.scales
+        offsets = las_reader.header.offsets
+        for points in las_reader.chunk_iterator(chunk_size):
+            x = np.asarray(points.X) * scales[0] + offsets[0]
+            y = np.asarray(points.Y) * scales[1] + offsets[1]
+            in_bounds = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+            if in_bounds.any():
+                z = np.asarray(points.Z)[in_bounds] * scales[2] + offsets[2]
+                xyz_list.append(np.column_stack((x[in_bounds], y[in_bounds], z)))
+    if len(xyz_list) == 0:
+        return np.empty((0, 3))
+    return np.concatenate(xyz_list)
+
+
+def crop_points_to_polygons(xyz: np.ndarray, polygons: list):
+    # returns the points within every polygon as list of arrays. Points are sorted by x once and every polygon only
+    # tests the points in the x-range of its bounding box. Duplicate points are removed like in a geometric union.
+    sort_idx = np.argsort(xyz[:, 0], kind='stable')
+    xyz_sorted = xyz[sort_idx]
+    x_sorted = xyz_sorted[:, 0]
+
+    cropped_points_list = []
+    for polygon in polygons:
+        min_x, min_y, max_x, max_y = polygon.bounds
+        idx_start = np.searchsorted(x_sorted, min_x, side='left')
+        idx_end = np.searchsorted(x_sorted, max_x, side='right')
+        candidates = xyz_sorted[idx_start:idx_end]
+        candidates = candidates[(candidates[:, 1] >= min_y) & (candidates[:, 1] <= max_y)]
+        is_inside = points_in_polygon(polygon, candidates[:, 0], candidates[:, 1])
+        cropped_points_list.append(np.unique(candidates[is_inside], axis=0))
+    return cropped_points_list
+
+
+def points_in_polygon(polygon, x: np.ndarray, y: np.ndarray, num_cells: int = 64, min_points: int = 5000):
+    # tests which points are within the polygon. The bounding box of the polygon is divided into a grid of at most
+    # num_cells x num_cells cells, which are sorted into cells inside, outside and on the boundary of the polygon.
+    # Only points in boundary cells are tested one by one, points in the other cells take the result of their cell.
+    # Few points (less than min_points) are tested directly
+    if len(x) < min_points:
+        return shapely.vectorized.contains(polygon, x, y)
+    min_x, min_y, max_x, max_y = polygon.bounds
+    cell_size = max(max_x - min_x, max_y - min_y, 1e-6) / num_cells
+    nx = int((max_x - min_x) / cell_size) + 1
+    ny = int((max_y - min_y) / cell_size) + 1
+
+    # cells touched by the polygon boundary: boundary vertices sampled at most one cell size apart, so that every
+    # touched cell is a sampled cell or a neighbour of it
+    rings = [polygon.boundary] if polygon.boundary.geom_type == 'LineString' else list(polygon.boundary.geoms)
+    boundary_points = []
+    for ring in rings:
+        coords = np.asarray(ring.coords)[:, :2]
+        segment_lengths = np.hypot(*(coords[1:] - coords[:-1]).T)
+        num_samples = np.ceil(segment_lengths / cell_size).astype(int) + 1
+        fractions = np.concatenate([np.linspace(0, 1, n) for n in num_samples])
+        segment_idx = np.repeat(np.arange(len(segment_lengths)), num_samples)
+        segment_vectors = coords[segment_idx + 1] - coords[segment_idx]
+        boundary_points.append(coords[segment_idx] + fractions[:, None] * segment_vectors)
+    boundary_points = np.concatenate(boundary_points)
+    is_boundary_cell = np.zeros((nx + 2, ny + 2), dtype=bool)
+    bx = np.clip(((boundary_points[:, 0] - min_x) / cell_size).astype(int), 0, nx - 1) + 1
+    by = np.clip(((boundary_points[:, 1] - min_y) / cell_size).astype(int), 0, ny - 1) + 1
+    is_boundary_cell[bx, by] = True
+    # add neighbours of sampled cells
+    is_boundary_cell = np.logical_or.reduce([np.roll(np.roll(is_boundary_cell, dx, axis=0), dy, axis=1)
+                                             for dx in (-1, 0, 1) for dy in (-1, 0, 1)])[1:-1, 1:-1]
+    # cells not touched by the boundary are completely inside or outside, which is tested with the cell centres
+    cx, cy = np.meshgrid(min_x + (np.arange(nx) + 0.5) * cell_size, min_y + (np.arange(ny) + 0.5) * cell_size,
+                         indexing='ij')
+    is_inside_cell = shapely.vectorized.contains(polygon, cx.ravel(), cy.ravel()).reshape(nx, ny)
+
+    # points outside the bounding box are outside
+    in_bounds = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+    is_inside = np.zeros(len(x), dtype=bool)
+    px = np.minimum(((x[in_bounds] - min_x) / cell_size).astype(int), nx - 1)
+    py = np.minimum(((y[in_bounds] - min_y) / cell_size).astype(int), ny - 1)
+    on_boundary = is_boundary_cell[px, py]
+    is_inside_bounds = is_inside_cell[px, py]
+    idx_boundary = np.flatnonzero(in_bounds)[on_boundary]
+    is_inside_bounds[on_boundary] = shapely.vectorized.contains(polygon, x[idx_boundary], y[idx_boundary])
+    is_inside[in_bounds] = is_inside_bounds
+    return is_inside
+
+
+def building_pointcloud_information(id_fp_list: list, cropped_points_list: list, POINT_COUNT_THRESHOLD: int,
+                                    as_multipoint: bool = True):
+    # creates one row per building point cloud with more points than the threshold.
+    # The point cloud (geom) is a shapely multipoint or the numpy array of points (as_multipoint=False)
+    rows = []
+    for id_fp, points in zip(id_fp_list, cropped_points_list):
+        if len(points) <= POINT_COUNT_THRESHOLD:
+            continue
+        delta_x, delta_y, delta_z = points.max(axis=0) - points.min(axis=0)
+        rows.append({
+            'id_fp': id_fp,
+            'geom': shapely.geometry.MultiPoint(points) if as_multipoint else points,
+            'delta_x': delta_x,
+            'delta_y': delta_y,
+            'delta_z': delta_z,
+            'z_min': points[:, 2].min(),
+            'scaling_factor': max(delta_x, delta_y, delta_z),
+            'num_p_in_pc': len(points)
+        })
+    columns = ['id_fp', 'geom', 'delta_x', 'delta_y', 'delta_z', 'z_min', 'scaling_factor', 'num_p_in_pc']
+    return pd.DataFrame(rows, columns=columns)
@@ -0,0 +1,231 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils.utils import atomic_output_path
+
+# Sharded point cloud store: instead of one .npy file per building, the point clouds of many buildings (e.g. of one
+# chunk) are packed into one shard. A shard consists of
+# - <shard_name>.npy: the points of all buildings of the shard concatenated to one array of shape (n, 3)
+# - <shard_name>_index.json: per building the id_fp, the legacy .npy file name (footprint centroid) and the offsets,
+#   the points of building i are points[offsets[i]:offsets[i + 1]]
+# The index file is written after the points file, so a shard is only visible to readers when it is complete.
+#
+# Like in LAS files, the points can be stored quantised relative to a per-building origin (the centre of the building's
+# bounding box, a multiple of the scale): 'int32' or 'int16' store round((point - origin) / scale), 'float32' stores
+# point - origin. The origins and the scale are kept in the index. Decoded points are rounded to the decimals of the
+# scale, so the encoding is lossless for coordinates with at most these decimals (LiDAR points have centimetre
+# precision, floor points are rounded to 4 decimals). 'int16' only covers +-327 m around the origin at a scale of
+# 0.01, i.e. floor points are rounded to centimetres.
+
+SHARD_INDEX_SUFFIX = '_index.json'
+# storage data type and default scale (in meters) per encoding
+POINT_ENCODINGS = {
+    'float64': (np.float64, None),
+    'float32': (np.float32, 0.0001),
+    'int32': (np.int32, 0.0001),
+    'int16': (np.int16, 0.01)
+}
+# float32 local coordinates stay accurate to 0.05 mm within this distance (in meters) of the origin
+FLOAT32_MAX_LOCAL_COORDINATE = 1000
+
+
+def _scale_decimals(scale: float):
+    decimals = int(round(-np.log10(scale)))
+    assert np.isclose(scale, 10.0 ** -decimals), 'scale must be a power of ten, e.g. 0.01'
+    return decimals
+
+
+def encode_points(points: np.ndarray, offsets: np.ndarray, encoding: str = 'float64', scale: float = None):
+    # encodes the concatenated points of several buildings. Returns the encoded points, the origins (one per building)
+    # and the scale
+    storage_dtype, default_scale = POINT_ENCODINGS[encoding]
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if encoding == 'float64':
+        return points, np.zeros((len(offsets) - 1, 3)), None
+    scale = default_scale if scale is None else scale
+    _scale_decimals(scale)
+
+    # origin: centre of the bounding box of every building
+    num_points = np.diff(offsets)
+    origins = np.zeros((len(num_points), 3))
+    has_points = num_points > 0
+    if has_points.any():
+        min_xyz = np.minimum.reduceat(points, offsets[:-1][has_points], axis=0)
+        max_xyz = np.maximum.reduceat(points, offsets[:-1][has_points], axis=0)
+        origins[has_points] = np.round((min_xyz + max_xyz) / 2 / scale) * scale
+    local_points = points - np.repeat(origins, num_points, axis=0)
+
+    if encoding == 'float32':
+        if np.abs(local_points).max(initial=0) > FLOAT32_MAX_LOCAL_COORDINATE:
+            raise ValueError('building extent too large for float32 encoding, use int32')
+        return local_points.astype(np.float32), origins, scale
+    quantised_points = np.round(local_points / scale)
+    dtype_info = np.iinfo(storage_dtype)
+    if quantised_points.min(initial=0) < dtype_info.min or quantised_points.max(initial=0) > dtype_info.max:
+        raise ValueError('building extent too large for %s encoding with scale %s' % (encoding, scale))
+    return quantised_points.astype(storage_dtype), origins, scale
+
+
+def decode_points(encoded_points: np.ndarray, origin: np.ndarray, encoding: str = 'float64', scale: float = None):
+    # decodes the points of one building (or of several buildings with origin of shape (n, 3))
+    if encoding == 'float64':
+        return encoded_points
+    # integer multiples of the scale divided by the power of ten give the float64 value closest to the decimal value,
+    # like np.round(points, decimals), but faster
+    factor = 10.0 ** _scale_decimals(scale)
+    if encoding == 'float32':
+        quantised_points = np.rint(encoded_points.astype(np.float64) * factor)
+    else:
+        quantised_points = encoded_points.astype(np.float64)
+    quantised_points += np.round(np.asarray(origin) * factor)
+    return quantised_points / factor
+
+
+def write_pointcloud_shard(dir_store: str, shard_name: str, points: np.ndarray, offsets: np.ndarray,
+                           id_fp_list, file_name_list, encoding: str = 'float64', scale: float = None):
+    # writes the concatenated points of several buildings and their index as one shard.
+    # encoding: 'float64', 'float32', 'int32' or 'int16', scale: None uses the default scale of the encoding
+    assert len(offsets) == len(id_fp_list) + 1 == len(file_name_list) + 1, 'one offset per building plus one required'
+    encoded_points, origins, scale = encode_points(points, offsets, encoding, scale)
+    points_file_name = shard_name + '.npy'
+    with atomic_output_path(os.path.join(dir_store, points_file_name)) as tmp_file_path:
+        with open(tmp_file_path, 'wb') as f:
+            np.save(f, arr=np.ascontiguousarray(encoded_points))
+    shard_index = {
+        'points_file': points_file_name,
+        'encoding': encoding,
+        'scale': scale,
+        'id_fp': [int(id_fp) for id_fp in id_fp_list],
+        'file_name': [str(file_name) for file_name in file_name_list],
+        'offsets': [int(offset) for offset in offsets],
+        'origins': origins.tolist()
+    }
+    with atomic_output_path(os.path.join(dir_store, shard_name + SHARD_INDEX_SUFFIX)) as tmp_file_path:
+        with open(tmp_file_path, 'w') as f:
+            json.dump(shard_index, f)
+    return
+
+
+def remove_pointcloud_shards(dir_store: str, shard_name_prefix: str):
+    # removes the shards whose name starts with the prefix, e.g. the shards of a chunk before it is processed again
+    for file in os.listdir(dir_store):
+        if file.startswith(shard_name_prefix) and (file[-4:] == '.npy' or file.endswith(SHARD_INDEX_SUFFIX)):
+            os.remove(os.path.join(dir_store, file))
+    return
+
+
+def is_pointcloud_store(dir_path: str):
+    return any(file.endswith(SHARD_INDEX_SUFFIX) for file in os.listdir(dir_path))
+
+
+class PointCloudStoreReader:
+    # Random access to the building point clouds of a sharded store by id_fp or legacy file name in O(1).
+    # The shards are memory mapped when they are first accessed, so only the requested points are read from disk.
+    # Shards of all encodings can be mixed, point clouds are returned as float64 coordinates.
+    # If a building is contained in several shards, the shard with the last name (in sorted order) is used.
+
+    def __init__(self, dir_store: str):
+        self.dir_store = dir_store
+        index_files = sorted(file for file in os.listdir(dir_store) if file.endswith(SHARD_INDEX_SUFFIX))
+        self.points_files = []
+        self.encodings = []
+        self.scales = []
+        shard_idx, starts, stops, id_fp, file_names, origins = [], [], [], [], [], []
+        for n_shard, index_file in enumerate(index_files):
+            with open(os.path.join(dir_store, index_file), 'r') as f:
+                shard_index = json.load(f)
+            offsets = np.asarray(shard_index['offsets'], dtype=np.int64)
+            self.points_files.append(shard_index['points_file'])
+            # shards without encoding are float64 shards
+            self.encodings.append(shard_index.get('encoding', 'float64'))
+            self.scales.append(shard_index.get('scale'))
+            origins.append(np.asarray(shard_index.get('origins', np.zeros((len(offsets) - 1, 3))),
+                                      dtype=np.float64).reshape(-1, 3))
+            shard_idx.append(np.full(len(offsets) - 1, n_shard, dtype=np.int32))
+            starts.append(offsets[:-1])
+            stops.append(offsets[1:])
+            id_fp += shard_index['id_fp']
+            file_names += shard_index['file_name']
+        self.shard_idx = np.concatenate(shard_idx) if len(shard_idx) > 0 else np.empty(0, dtype=np.int32)
+        self.starts = np.concatenate(starts) if len(starts) > 0 else np.empty(0, dtype=np.int64)
+        self.stops = np.concatenate(stops) if len(stops) > 0 else np.empty(0, dtype=np.int64)
+        self.origins = np.concatenate(origins) if len(origins) > 0 else np.empty((0, 3))
+        self.id_fp = np.asarray(id_fp, dtype=np.int64)
+        self.file_names = file_names
+        # later entries overwrite earlier ones
+        self._row_by_id_fp = {fp: row for row, fp in enumerate(id_fp)}
+        self._row_by_file_name = {file_name: row for row, file_name in enumerate(file_names)}
+        self._shard_points = {}
+
+    def __len__(self):
+        return len(self.id_fp)
+
+    def __getstate__(self):
+        # memory mapped shards are opened again after pickling (e.g. in worker processes) instead of being copied
+        state = self.__dict__.copy()
+        state['_shard_points'] = {}
+        return state
+
+    def num_points(self):
+        # number of points per building
+        return self.stops - self.starts
+
+    def _points_of_shard(self, n_shard: int):
+        if n_shard not in self._shard_points:
+            self._shard_points[n_shard] = np.load(os.path.join(self.dir_store, self.points_files[n_shard]),
+                                                  mmap_mode='r')
+        return self._shard_points[n_shard]
+
+    def encoded_pointcloud(self, row: int):
+        # stored points of the building in row of the index (read-only memory mapped array of shape (n, 3))
+        return self._points_of_shard(self.shard_idx[row])[self.starts[row]:self.stops[row]]
+
+    def pointcloud(self, row: int):
+        # point cloud of the building in row of the index, array of shape (n, 3). For float64 shards, this is a
+        # read-only memory mapped array, otherwise the decoded points
+        n_shard = self.shard_idx[row]
+        return decode_points(self.encoded_pointcloud(row), self.origins[row], self.encodings[n_shard],
+                             self.scales[n_shard])
+
+    def row_of_id_fp(self, id_fp: int):
+        return self._row_by_id_fp[int(id_fp)]
+
+    def row_of_file_name(self, file_name: str):
+        return self._row_by_file_name[file_name]
+
+    def pointcloud_by_id_fp(self, id_fp: int):
+        return self.pointcloud(self.row_of_id_fp(id_fp))
+
+    def pointcloud_by_file_name(self, file_name: str):
+        return self.pointcloud(self.row_of_file_name(file_name))
+
+
+def convert_npy_raw_to_shards(dir_npy_raw: str, dir_store: str, file_path_filename_mapping: str = None,
+                              buildings_per_shard: int = 10000, encoding: str = 'float64', scale: float = None):
+    # packs the .npy files of a npy_raw folder into shards of buildings_per_shard buildings (see write_pointcloud_shard
+    # for encoding and scale).
+    # The id_fp of the buildings is taken from the filename mapping json (filename_mapping_<AOI>.json) if available,
+    # otherwise (or if the file is not in the mapping) id_fp is -1
+    npy_file_names = sorted(file for file in os.listdir(dir_npy_raw) if file[-4:] == '.npy')
+    id_fp_by_file_name = {}
+    if file_path_filename_mapping is not None:
+        df_mapping = pd.read_json(file_path_filename_mapping, orient='index')
+        df_mapping = df_mapping[df_mapping.num_p_in_pc.notna()].drop_duplicates('file_name')
+        id_fp_by_file_name = dict(zip(df_mapping.file_name, df_mapping.id_fp))
+    os.makedirs(dir_store, exist_ok=True)
+
+    num_shards = 0
+    for shard_start in range(0, len(npy_file_names), buildings_per_shard):
+        shard_file_names = npy_file_names[shard_start:shard_start + buildings_per_shard]
+        pointcloud_list = [np.load(os.path.join(dir_npy_raw, file)).reshape(-1, 3) for file in shard_file_names]
+        offsets = np.zeros(len(pointcloud_list) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(points) for points in pointcloud_list])
+        write_pointcloud_shard(dir_store, 'converted_%s' % num_shards, np.concatenate(pointcloud_list), offsets,
+                               [id_fp_by_file_name.get(file, -1) for file in shard_file_names], shard_file_names,
+                               encoding, scale)
+        num_shards += 1
+        print('converted %s out of %s point clouds' % (shard_start + len(shard_file_names), len(npy_file_names)))
+    return num_shards
@@ -0,0 +1,93 @@
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from shapely.geometry import box
+
+from utils.utils import read_las_header_info, atomic_output_path
+
+
+def build_tile_catalog(dir_tiles: str, file_path_catalog: str = None):
+    # Creates a catalog of all LAS/LAZ tiles in a directory by reading only the tile headers. A LAS file with a LAZ
+    # file of the same name (unpacked by earlier versions of the LiDAR import) is the same tile and is skipped.
+    # The catalog is persisted as json (default: tile_catalog.json in the tile directory). Tiles that did not change
+    # since the last run (same file size and modification time) are taken from the persisted catalog.
+    if file_path_catalog is None:
+        file_path_catalog = os.path.join(dir_tiles, 'tile_catalog.json')
+    catalog = {}
+    if os.path.isfile(file_path_catalog):
+        with open(file_path_catalog, 'r') as f:
+            catalog = json.load(f)
+
+    files = os.listdir(dir_tiles)
+    laz_files = set(file for file in files if file[-4:] == '.laz')
+    tile_files = sorted([file for file in files if file[-4:] == '.laz'
+                         or (file[-4:] == '.las' and file[:-4] + '.laz' not in laz_files)])
+    new_catalog = {}
+    for tile_file in tile_files:
+        file_stat = os.stat(os.path.join(dir_tiles, tile_file))
+        catalog_entry = catalog.get(tile_file)
+        if catalog_entry is None or catalog_entry['file_size'] != file_stat.st_size \
+                or catalog_entry['file_mtime'] != file_stat.st_mtime:
+            catalog_entry = read_las_header_info(os.path.join(dir_tiles, tile_file))
+            catalog_entry.update({'file_size': file_stat.st_size, 'file_mtime': file_stat.st_mtime})
+        new_catalog[tile_file] = catalog_entry
+
+    # write to a temporary file first, so that an interruption never leaves a truncated catalog
+    with atomic_output_path(file_path_catalog) as tmp_file_path:
+        with open(tmp_file_path, 'w') as f:
+            json.dump(new_catalog, f, indent=1)
+    print('tile catalog contains %s tiles' % len(new_catalog))
+
+    return tile_catalog_to_gdf(new_catalog, dir_tiles)
+
+
+def load_tile_catalog(file_path_catalog: str, dir_tiles: str = None):
+    # loads a persisted tile catalog without touching the tiles
+    with open(file_path_catalog, 'r') as f:
+        catalog = json.load(f)
+    if dir_tiles is None:
+        dir_tiles = os.path.dirname(file_path_catalog)
+    return tile_catalog_to_gdf(catalog, dir_tiles)
+
+
+def tile_catalog_to_gdf(catalog: dict, dir_tiles: str):
+    # one row per tile with the tile bounding box as geometry
+    file_names = list(catalog.keys())
+    bounds = np.array([catalog[file_name]['bounds'] for file_name in file_names]).reshape(-1, 6)
+    gdf_catalog = gpd.GeoDataFrame({
+        'file_name': file_names,
+        'file_path': [os.path.join(dir_tiles, file_name) for file_name in file_names],
+        'point_count': [catalog[file_name]['point_count'] for file_name in file_names],
+        'point_format': [catalog[file_name]['point_format'] for file_name in file_names],
+        'scales': [catalog[file_name]['scales'] for file_name in file_names],
+        'offsets': [catalog[file_name]['offsets'] for file_name in file_names],
+        'min_x': bounds[:, 0], 'min_y': bounds[:, 1], 'min_z': bounds[:, 2],
+        'max_x': bounds[:, 3], 'max_y': bounds[:, 4], 'max_z': bounds[:, 5],
+        'geometry': [box(b[0], b[1], b[3], b[4]) for b in bounds]
+    }, crs=27700)
+    return gdf_catalog
+
+
+def tiles_intersecting_geometry(gdf_catalog: gpd.GeoDataFrame, geom: shapely.geometry.base.BaseGeometry):
+    # uses the in-memory spatial index of the catalog to find tiles intersecting a footprint or area of interest
+    candidate_idx = list(gdf_catalog.sindex.intersection(geom.bounds))
+    gdf_candidates = gdf_catalog.iloc[sorted(candidate_idx)]
+    return gdf_candidates[gdf_candidates.intersects(geom)]
+
+
+def estimate_points_per_footprint(gdf_footprints: gpd.GeoDataFrame, gdf_catalog: gpd.GeoDataFrame,
+                                  BUILDING_BUFFER_METERS: float):
+    # estimates the number of LiDAR points within every buffered footprint (geom_fp) as buffered footprint area times
+    # the point density of the tiles at the footprint. Densities of overlapping tiles (e.g. several survey years) add up
+    gdf_density = gpd.GeoDataFrame(
+        {'density': np.asarray(gdf_catalog.point_count) / np.asarray(gdf_catalog.area)},
+        geometry=list(gdf_catalog.geometry), crs=gdf_catalog.crs)
+    buffered_footprints = gdf_footprints.geom_fp.buffer(BUILDING_BUFFER_METERS)
+    gdf_centroids = gpd.GeoDataFrame(geometry=list(buffered_footprints.centroid), crs=gdf_catalog.crs)
+    gdf_joined = gpd.sjoin(gdf_centroids, gdf_density, how='left', op='intersects')
+    density = gdf_joined.groupby(level=0).density.sum().reindex(gdf_centroids.index, fill_value=0)
+    return np.asarray(buffered_footprints.area) * np.asarray(density)
@@ -0,0 +1,154 @@
+import collections
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils.pointcloud_batch import normalize_pointcloud_batch
+from utils.pointcloud_store import is_pointcloud_store, PointCloudStoreReader
+
+# Reader of the generated building point clouds for training. The point clouds are read from a sharded point cloud
+# store (npy_shards) or from a folder of .npy files (npy_raw), both memory mapped. The labels of the filename mapping
+# (filename_mapping_<AOI>.json) are joined once into arrays with one entry per building.
+# Every building is normalised like in normalize_geom (shifted to its minimum x, y, z and divided by the scaling
+# factor) and sampled to a fixed number of points, batches are collated into arrays of shape (N, P, 3).
+
+EPC_RATINGS = ['A', 'B', 'C', 'D', 'E', 'F', 'G']
+
+
+def load_pointcloud_labels(file_path_filename_mapping: str, require_epc: bool = True):
+    # one row per point cloud file with id_fp, file_name, epc_rating and epc_efficiency. Buildings with several
+    # EPC entries keep the first entry. require_epc: dismiss buildings without EPC rating
+    df_mapping = pd.read_json(file_path_filename_mapping, orient='index')
+    df_mapping = df_mapping[df_mapping.num_p_in_pc.notna()]
+    df_mapping = df_mapping.assign(has_epc=df_mapping.epc_rating.notna())
+    df_mapping = df_mapping.sort_values('has_epc', ascending=False, kind='stable').drop_duplicates('file_name')
+    if require_epc:
+        df_mapping = df_mapping[df_mapping.has_epc]
+    df_labels = df_mapping[['id_fp', 'file_name', 'epc_rating', 'epc_efficiency']].sort_values('file_name')
+    return df_labels.reset_index(drop=True)
+
+
+class PointCloudDataset:
+    # dir_pointclouds: npy_shards or npy_raw folder of an area of interest
+    # num_points: number of points sampled per building. Buildings with fewer points are sampled with replacement
+    # sampling: 'random' (new sample in every epoch) or 'deterministic' (the same sample of a building in every epoch)
+    # scaling_factor: coordinates are divided by the scaling factor after the shift to the minimum x, y, z,
+    # None divides every building by its largest extent (coordinates between 0 and 1)
+
+    def __init__(self, dir_pointclouds: str, file_path_filename_mapping: str, num_points: int = 1024,
+                 sampling: str = 'random', scaling_factor: float = None, require_epc: bool = True, seed: int = 0):
+        assert sampling in ['random', 'deterministic'], 'sampling must be random or deterministic'
+        self.dir_pointclouds = dir_pointclouds
+        self.num_points = num_points
+        self.sampling = sampling
+        self.scaling_factor = scaling_factor
+        self.seed = seed
+        if is_pointcloud_store(dir_pointclouds):
+            self.pointcloud_store = PointCloudStoreReader(dir_pointclouds)
+            available_file_names = set(self.pointcloud_store.file_names)
+        else:
+            self.pointcloud_store = None
+            available_file_names = set(file for file in os.listdir(dir_pointclouds) if file[-4:] == '.npy')
+
+        # labels as arrays, one entry per building
+        df_labels = load_pointcloud_labels(file_path_filename_mapping, require_epc)
+        df_labels = df_labels[df_labels.file_name.isin(available_file_names)].reset_index(drop=True)
+        self.file_names = list(df_labels.file_name)
+        self.id_fp = df_labels.id_fp.to_numpy(dtype=np.int64)
+        self.epc_rating = df_labels.epc_rating.to_numpy(dtype=object)
+        # index of the rating in EPC_RATINGS, -1 without rating
+        self.epc_rating_class = np.array([EPC_RATINGS.index(rating) if rating in EPC_RATINGS else -1
+                                          for rating in self.epc_rating], dtype=np.int64)
+        self.epc_efficiency = df_labels.epc_efficiency.to_numpy(dtype=np.float32)
+        if self.pointcloud_store is not None:
+            self._store_rows = np.array([self.pointcloud_store.row_of_file_name(file_name)
+                                         for file_name in self.file_names], dtype=np.int64)
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def pointcloud(self, i: int):
+        # raw point cloud of building i (British National Grid coordinates)
+        if self.pointcloud_store is not None:
+            return self.pointcloud_store.pointcloud(self._store_rows[i])
+        return np.load(os.path.join(self.dir_pointclouds, self.file_names[i]), mmap_mode='r').reshape(-1, 3)
+
+    def sample(self, i: int, rng: np.random.Generator = None):
+        # normalised point cloud of building i with num_points points, shape (num_points, 3).
+        # rng: generator of random samples, None uses the generator of the dataset
+        points = np.asarray(self.pointcloud(i), dtype=np.float64)
+        min_xyz = points.min(axis=0)
+        if self.scaling_factor is None:
+            scaling_factor = max((points.max(axis=0) - min_xyz).max(), 1e-9)
+        else:
+            scaling_factor = self.scaling_factor
+        if self.sampling == 'deterministic':
+            rng = np.random.default_rng([self.seed, i])
+        elif rng is None:
+            rng = self._rng
+        sample_idx = rng.choice(len(points), size=self.num_points, replace=len(points) < self.num_points)
+        return ((points[sample_idx] - min_xyz) / scaling_factor).astype(np.float32)
+
+    def batch(self, building_idx, rng: np.random.Generator = None):
+        # collates the samples of the buildings into a dict of arrays, points of shape (N, num_points, 3)
+        building_idx = np.asarray(building_idx, dtype=np.int64)
+        if self.sampling == 'random' and len(building_idx) > 0:
+            # random samples of all buildings of the batch are drawn at once
+            pointcloud_list = [self.pointcloud(i) for i in building_idx]
+            offsets = np.zeros(len(pointcloud_list) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(pointcloud) for pointcloud in pointcloud_list])
+            points = normalize_pointcloud_batch(np.concatenate(pointcloud_list), offsets, self.scaling_factor,
+                                                self.num_points, self._rng if rng is None else rng,
+                                                allow_fewer_points=True).astype(np.float32)
+        else:
+            points = np.empty((len(building_idx), self.num_points, 3), dtype=np.float32)
+            for n, i in enumerate(building_idx):
+                points[n] = self.sample(i, rng)
+        return {
+            'points': points,
+            'id_fp': self.id_fp[building_idx],
+            'epc_rating_class': self.epc_rating_class[building_idx],
+            'epc_efficiency': self.epc_efficiency[building_idx]
+        }
+
+    def iterate_batches(self, batch_size: int = 32, shuffle: bool = True, drop_last: bool = False, epoch: int = 0,
+                        num_workers: int = 0, prefetch_batches: int = 4):
+        # yields the batches of one epoch. With num_workers > 0, batches are loaded in worker processes and at most
+        # prefetch_batches batches are loaded in advance. The samples of every batch are drawn with a generator seeded
+        # by seed, epoch and batch number, so the batches do not depend on the number of workers
+        building_idx = np.arange(len(self))
+        if shuffle:
+            np.random.default_rng([self.seed, epoch]).shuffle(building_idx)
+        num_batches = len(building_idx) // batch_size if drop_last else -(-len(building_idx) // batch_size)
+        batches_idx = [building_idx[n * batch_size:(n + 1) * batch_size] for n in range(num_batches)]
+        batch_seeds = [[self.seed, epoch, n] for n in range(num_batches)]
+
+        if num_workers == 0:
+            for batch_idx, batch_seed in zip(batches_idx, batch_seeds):
+                yield self.batch(batch_idx, np.random.default_rng(batch_seed))
+            return
+
+        with multiprocessing.Pool(num_workers, initializer=_init_dataset_worker, initargs=(self,)) as pool:
+            pending_batches = collections.deque()
+            for batch_idx, batch_seed in zip(batches_idx, batch_seeds):
+                pending_batches.append(pool.apply_async(_load_dataset_batch, (batch_idx, batch_seed)))
+                if len(pending_batches) >= max(prefetch_batches, num_workers):
+                    yield pending_batches.popleft().get()
+            while len(pending_batches) > 0:
+                yield pending_batches.popleft().get()
+
+
+# dataset of the worker process
+_worker_dataset = None
+
+
+def _init_dataset_worker(dataset: PointCloudDataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _load_dataset_batch(batch_idx, batch_seed):
+    return _worker_dataset.batch(batch_idx, np.random.default_rng(batch_seed))
@@ -1,3 +1,5 @@
+import contextlib
+import hashlib
 import os.path
 
 from geoalchemy2 import WKBElement
@@ -45,37 +47,93 @@ def _convert_las_to_numpy(las_data=None):
 
 
 def convert_multipoint_to_numpy(mp: shapely.geometry.MultiPoint = None):
-    mpl = list(mp)
-    lidar_numpy = np.array([(pt.x, pt.y, pt.z) for pt in mpl])
+    # decodes the coordinates from the wkb of the multipoint, without creating a shapely point per point.
+    # wkb of a multipoint: byte order (1 byte), geometry type (4 bytes), number of points (4 bytes), then per point
+    # byte order, geometry type and the x, y (, z) values
+    wkb = mp.wkb
+    byte_order = '<' if wkb[0] == 1 else '>'
+    num_points = int(np.frombuffer(wkb, dtype=byte_order + 'u4', count=1, offset=5)[0])
+    num_dims = 3 if mp.has_z else 2
+    if num_points == 0:
+        return np.empty((0, num_dims))
+    point_dtype = np.dtype([('byte_order', 'u1'), ('geometry_type', byte_order + 'u4'),
+                            ('xyz', byte_order + 'f8', (num_dims,))])
+    points = np.frombuffer(wkb, dtype=point_dtype, count=num_points, offset=9)
+    lidar_numpy = points['xyz'].astype(np.float64)
     return lidar_numpy
 
 
+def pointcloud_to_numpy(pointcloud=None):
+    # building point clouds are either shapely multipoints or numpy arrays of shape (n, 3), depending on fetch mode
+    if isinstance(pointcloud, np.ndarray):
+        return pointcloud
+    return convert_multipoint_to_numpy(pointcloud)
+
+
 def convert_numpy_to_multipoint(lidar_numpy: np.ndarray = None):
     assert lidar_numpy.shape[0] == 3, 'unexpected shape of array. expected shape is (3, :)'
     mp = shapely.geometry.MultiPoint(lidar_numpy)
     return mp
 
 
-def gdf_geometries_wkb_to_shape(gdf: gpd.GeoDataFrame = None):
-    # make sure gdf has fp_geom column
-    assert 'geom_fp' in gdf.columns
-    assert 'geom_uprn' in gdf.columns
-    # define wkb elements
-    gdf_geom_fp = gdf.geom_fp.apply(WKBElement)
-    gdf_geom_uprn = gdf.geom_uprn.apply(WKBElement)
-    # convert wkb elements to shapes
-    gdf_geom_fp = gdf_geom_fp.apply(to_shape)
-    # for uprn geom, we need to check, whether the geom is not nan. we do this by checking if uprn is nan.
-    gdf_geom_uprn = gdf[np.isnan(gdf.uprn)==False].geom_uprn.apply(WKBElement)
-    gdf_geom_uprn = gdf_geom_uprn.apply(to_shape)
-    # replace fp_geom column with shapes
-    gdf['geom_fp'] = gdf_geom_fp
-    gdf['geom_uprn'] = gdf_geom_uprn
+def wkb_columns_to_shape(gdf: gpd.GeoDataFrame, columns: list):
+    # converts wkb geometry columns into shapes, empty (null) geometries stay None
+    for column in columns:
+        is_geom = gdf[column].notna()
+        gdf[column] = gdf[column][is_geom].apply(WKBElement).apply(to_shape)
     return gdf
 
 
-def _sample_random_points(x: np.ndarray = None, random_sample_size: int = None):
-    rng = np.random.default_rng()
+@contextlib.contextmanager
+def atomic_output_path(file_path: str):
+    # yields a temporary file path to write to. The temporary file replaces file_path only after writing succeeded,
+    # so that an interruption never leaves a truncated file
+    tmp_file_path = '%s.%s.tmp' % (file_path, os.getpid())
+    try:
+        yield tmp_file_path
+        os.replace(tmp_file_path, file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+
+
+def hilbert_curve_index(x: np.ndarray, y: np.ndarray, order: int = 16):
+    # position of points on a Hilbert curve over their bounding box. Sorting by the index keeps nearby points together.
+    # The bounding box is divided into a grid of 2**order x 2**order cells
+    n = 2 ** order
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) == 0:
+        return np.zeros(0, dtype=np.int64)
+    extent = max(x.max() - x.min(), y.max() - y.min(), 1e-9)
+    xi = np.minimum(((x - x.min()) / extent * n).astype(np.int64), n - 1)
+    yi = np.minimum(((y - y.min()) / extent * n).astype(np.int64), n - 1)
+    d = np.zeros(len(xi), dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # rotate the quadrant, so that the curve is continuous
+        flip = ~ry & rx
+        xi = np.where(flip, n - 1 - xi, xi)
+        yi = np.where(flip, n - 1 - yi, yi)
+        xi, yi = np.where(~ry, yi, xi), np.where(~ry, xi, yi)
+        s //= 2
+    return d
+
+
+def hilbert_curve_order(geometries):
+    # indices of the geometries sorted by the position of their centroids on a Hilbert curve (see hilbert_curve_index).
+    # Geometries in the same cell keep their given order
+    centroids = gpd.GeoSeries(list(geometries)).centroid
+    hilbert_index = hilbert_curve_index(np.asarray(centroids.x), np.asarray(centroids.y))
+    return np.argsort(hilbert_index, kind='stable')
+
+
+def _sample_random_points(x: np.ndarray = None, random_sample_size: int = None, seed=None):
+    # seed: seed or numpy generator of the random sample, None draws a new sample in every run
+    rng = np.random.default_rng(seed)
     lidar_subset = rng.choice(a=x, size=random_sample_size, replace=False, axis=0)
     return lidar_subset
 
@@ -101,20 +159,42 @@ def subsample_las(original_las_data_filepath: str = None, random_sample_size: in
     return outfile
 
 
+def read_las_header_info(las_file_path: str = None):
+    # reads only the header of a LAS/LAZ file, the point records are not decompressed
+    with laspy.open(las_file_path) as las_reader:
+        header = las_reader.header
+        header_info = {
+            'point_count': int(header.point_count),
+            'bounds': [*[float(v) for v in header.mins], *[float(v) for v in header.maxs]],
+            'scales': [float(v) for v in header.scales],
+            'offsets': [float(v) for v in header.offsets],
+            'point_format': int(header.point_format.id)
+        }
+    return header_info
+
+
+def file_sha256(file_path: str = None, block_size: int = 2 ** 20):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
 def create_tile_bounding_box(original_las_data_filepath: str = None):
-    las_data = laspy.read(original_las_data_filepath)
-    min_x, min_y, min_z, max_x, max_y, max_z = [*las_data.header.min, *las_data.header.max]
+    min_x, min_y, min_z, max_x, max_y, max_z = read_las_header_info(original_las_data_filepath)['bounds']
     return box(minx=min_x, miny=min_y, maxx=max_x, maxy=max_y)
 
 
-def normalize_geom(geom: shapely.geometry = None, scaling_factor: int = 1000, random_sample_size: int = None):
+def normalize_geom(geom: shapely.geometry = None, scaling_factor: int = 1000, random_sample_size: int = None,
+                   seed=None):
     # convert multipoint to numpy array
-    lidar_numpy = convert_multipoint_to_numpy(geom)
+    lidar_numpy = pointcloud_to_numpy(geom).copy()
     # scale x, y, z coordinates (0, 1, 2) according to scaling factor
     for i in np.arange(0, 3):
         lidar_numpy[:, i] = (lidar_numpy[:, i] - lidar_numpy[:, i].min()) / scaling_factor
     # subsample numpy array
-    lidar_numpy = _sample_random_points(lidar_numpy, random_sample_size)
+    lidar_numpy = _sample_random_points(lidar_numpy, random_sample_size, seed)
 
     return lidar_numpy
 
@@ -5,6 +5,7 @@ import plotly.graph_objects as go
 
 from typing import List
 
+from utils.pointcloud_store import is_pointcloud_store, PointCloudStoreReader
 from utils.utils import point_cloud_xyz
 
 
@@ -76,7 +77,13 @@ def visualize_example_pointclouds(lidar_numpy_list: list, DIR_VISUALIZATION: str
 
 def batch_visualization(DIR_POINT_CLOUDS, DIR_SAVE, format: str = 'html', status_update: bool = False,
                         number_examples=None):
-    pc_file_names = os.listdir(DIR_POINT_CLOUDS)
+    # DIR_POINT_CLOUDS is a folder of .npy files or a sharded point cloud store
+    if is_pointcloud_store(DIR_POINT_CLOUDS):
+        pointcloud_store = PointCloudStoreReader(DIR_POINT_CLOUDS)
+        pc_file_names = pointcloud_store.file_names
+    else:
+        pointcloud_store = None
+        pc_file_names = os.listdir(DIR_POINT_CLOUDS)
     if number_examples == None:
         number_examples = len(pc_file_names)
     count = 0
@@ -86,8 +93,11 @@ def batch_visualization(DIR_POINT_CLOUDS, DIR_SAVE, format: str = 'html', status
                   str(count) + ' out of ' + str(number_examples))
         if count <= number_examples:
             count += 1
-            pc_file_path = os.path.join(DIR_POINT_CLOUDS, pc_file_name)
-            point_cloud_array = np.load(pc_file_path)
+            if pointcloud_store is not None:
+                point_cloud_array = np.array(pointcloud_store.pointcloud_by_file_name(pc_file_name))
+            else:
+                pc_file_path = os.path.join(DIR_POINT_CLOUDS, pc_file_name)
+                point_cloud_array = np.load(pc_file_path)
             # normalize pc array for visualization
             for i in np.arange(0, 3):
                 point_cloud_array[:, i] = (point_cloud_array[:, i] - point_cloud_array[:, i].min())